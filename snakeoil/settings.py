@@ -48,7 +48,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'snakeoil_webshop.middleware.MetricsMiddleware',
+    'snakeoil_webshop.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'snakeoil_webshop.middleware.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -83,12 +86,20 @@ WSGI_APPLICATION = 'snakeoil.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql', 
+        # The MySQL backend of Django, extended to limit and count the
+        # connections of each worker (see SNAKEOIL_DB_CONNECTIONS below).
+        'ENGINE': 'snakeoil_webshop.backends.mysql',
         'NAME': os.getenv("DB_NAME"),
         'USER': os.getenv("DB_USER"),
         'PASSWORD': os.getenv("DB_PASSWORD"),
         'HOST': os.getenv("DB_HOST"),
         'PORT': os.getenv("DB_PORT"),
+        # Keep connections open between requests for this many seconds. Keep it
+        # below the wait_timeout of the MySQL server. 0 closes the connection after
+        # every request. Connections are checked before they get reused, so ones
+        # dropped by the server are replaced instead of failing the request.
+        'CONN_MAX_AGE': int(os.getenv("DB_CONN_MAX_AGE", "300")),
+        'CONN_HEALTH_CHECKS': True,
         'OPTIONS': {
             # Enable MySQL strict mode. Should help maintain data integrity.
             'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
@@ -97,6 +108,85 @@ DATABASES = {
 }
 
 
+# Read replicas
+# Give the hosts of any MySQL replicas of the default database as a comma-separated
+# list. Catalog reads are spread over the replicas, everything else goes to the
+# primary (see snakeoil_webshop/routers.py). A client that has written something
+# reads from the primary for the next PIN_SECONDS so that it sees its own writes.
+
+for index, host in enumerate(filter(None, os.getenv("DB_REPLICA_HOSTS", "").split(","))):
+    DATABASES[f"replica{index}"] = dict(
+        DATABASES['default'],
+        HOST=host.strip(),
+        USER=os.getenv("DB_REPLICA_USER") or DATABASES['default']['USER'],
+        PASSWORD=os.getenv("DB_REPLICA_PASSWORD") or DATABASES['default']['PASSWORD'],
+        # Tests read the replicas from the test database of the primary.
+        TEST={'MIRROR': 'default'},
+    )
+
+DATABASE_ROUTERS = ['snakeoil_webshop.routers.PrimaryReplicaRouter']
+
+SNAKEOIL_REPLICAS = {
+    "ALIASES": [alias for alias in DATABASES if alias != 'default'],
+    "PIN_SECONDS": 5,
+}
+
+
+# Database connections
+# Each worker process may have at most MAX_PER_WORKER connections open at once,
+# across the primary and the replicas. A thread needing another one waits up to
+# WAIT_TIMEOUT seconds for one to close. None means no limit. Leave room for a
+# primary and a replica connection per thread. Openings, reuses and waits are
+# counted in the metrics.
+
+SNAKEOIL_DB_CONNECTIONS = {
+    "MAX_PER_WORKER": int(os.getenv("DB_MAX_CONNECTIONS_PER_WORKER", "0")) or None,
+    "WAIT_TIMEOUT": 10,
+}
+
+
+# Caches
+# Set CACHE_BACKEND and CACHE_LOCATION to share the cache between the worker
+# processes, e.g. 'django.core.cache.backends.redis.RedisCache' and
+# 'redis://127.0.0.1:6379' (requires the redis package). The default local
+# memory cache is private to each worker.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv("CACHE_BACKEND", 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv("CACHE_LOCATION", ""),
+    }
+}
+
+
+# Sessions
+# Sessions are read from the cache and written through to the database, so
+# reading one doesn't query the database and ending one (e.g. logging out)
+# takes effect on the server. Use a shared cache in production: with the local
+# memory cache, other workers may keep serving an ended session from their own
+# caches until it expires there. Setting SESSION_ENGINE to
+# 'django.contrib.sessions.backends.signed_cookies' keeps sessions in the
+# browser instead, which needs no cache or database at all but can't be
+# revoked before the cookie expires.
+
+SESSION_ENGINE = os.getenv("SESSION_ENGINE", 'django.contrib.sessions.backends.cached_db')
+
+
+# Authentication
+# The users of authenticated sessions and their permissions are kept in the
+# CACHE for TIMEOUT seconds, so that requests reach the view without querying
+# the user, group and permission tables. Changes made through the models are
+# applied at once; with a cache that isn't shared between the workers, other
+# workers may take up to TIMEOUT to see them.
+
+AUTHENTICATION_BACKENDS = ['snakeoil_webshop.auth.CachingModelBackend']
+
+SNAKEOIL_AUTH_CACHE = {
+    "CACHE": "default",
+    "TIMEOUT": 5 * 60,
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -136,6 +226,33 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
+# collectstatic adds content hashes to the file names, so that nginx can let
+# browsers cache them for good, and writes .gz (and .br, if the Brotli package
+# is installed) variants for nginx to serve as they are.
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'snakeoil_webshop.assets.CompressedManifestStaticFilesStorage',
+    },
+}
+
+STATICFILES_FINDERS = [
+    'django.contrib.staticfiles.finders.FileSystemFinder',
+    'django.contrib.staticfiles.finders.AppDirectoriesFinder',
+    'snakeoil_webshop.assets.BundleFinder',
+]
+
+# Static files served as one. Each bundle is the concatenation of the listed
+# static files, built into DIRECTORY when first requested or collected.
+SNAKEOIL_STATIC_BUNDLES = {
+    "DIRECTORY": None,
+    "BUNDLES": {
+        "snakeoil.bundle.js": ["jquery.min.js", "bootstrap/bootstrap.min.js", "snakeoil.js"],
+    },
+}
+
 
 LOGIN_REDIRECT_URL = "shop"
 LOGIN_URL = "login/"
@@ -145,4 +262,65 @@ LOGIN_URL = "login/"
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-CRISPY_TEMPLATE_PACK = 'bootstrap4'
\ No newline at end of file
+CRISPY_TEMPLATE_PACK = 'bootstrap4'
+
+
+# Product search
+# "auto" uses the full-text index of the database (MySQL FULLTEXT or SQLite FTS5)
+# when there is one. Set a dotted path to pick a backend class explicitly, e.g.
+# 'snakeoil_webshop.search.SubstringSearchBackend' for plain substring matching.
+
+SNAKEOIL_SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "auto")
+
+
+# Cached product JSON
+# Every worker keeps up to MAX_ENTRIES serialized products in memory. Set
+# SHARED_CACHE to the alias of an entry in CACHES to share them between workers.
+
+SNAKEOIL_PRODUCT_JSON_CACHE = {
+    "MAX_ENTRIES": 10000,
+    "SHARED_CACHE": os.getenv("PRODUCT_JSON_SHARED_CACHE") or None,
+}
+
+
+# Cached product tables
+# Rendered product tables are cached per catalog version, search and page in
+# the CACHE given here. The catalog version lives in the same cache, so it
+# must be shared between the workers for product edits to reach all of them.
+# Until then, TIMEOUT bounds how long a worker may serve an outdated table.
+
+SNAKEOIL_FRAGMENT_CACHE = {
+    "CACHE": "default",
+    "TIMEOUT": 5 * 60,
+}
+
+# Server-Timing instrumentation
+# A SAMPLE_RATE share of requests is timed (database, templates, serialization)
+# and gets a Server-Timing header if HEADER is set. Timed requests taking at least
+# LOG_THRESHOLD_MS or making at least LOG_QUERY_THRESHOLD queries are logged to the
+# 'snakeoil_webshop.timing' logger. Set a threshold to None to disable it.
+
+SNAKEOIL_SERVER_TIMING = {
+    "SAMPLE_RATE": float(os.getenv("SERVER_TIMING_SAMPLE_RATE", "1.0")),
+    "HEADER": os.getenv("SERVER_TIMING_HEADER", "true").lower() == "true",
+    "LOG_THRESHOLD_MS": 500,
+    "LOG_QUERY_THRESHOLD": 50,
+}
+
+
+# Prometheus metrics
+# Every worker process records its metrics in its own memory-mapped file in
+# DIRECTORY, and /metrics adds up the files of all workers. Empty the directory
+# when restarting the application server.
+
+SNAKEOIL_METRICS = {
+    "DIRECTORY": os.getenv("METRICS_DIR") or None,
+}
+
+
+# Checkout
+# Placed orders hold their stock for this many seconds. Unless the order is
+# confirmed in time, the stock is released by the release_expired_reservations
+# command or by the next checkout, whichever comes first.
+
+SNAKEOIL_RESERVATION_TIMEOUT = 15 * 60
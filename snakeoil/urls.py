@@ -21,18 +21,38 @@ from django.urls import path
 from snakeoil_webshop.views import (
     ShopView,
     AddToCartView,
+    AddToCartBatchView,
     ClearCartView,
+    CheckoutView,
+    OrderView,
+    ConfirmOrderView,
+    CancelOrderView,
     ShoppingCartView,
-    ProductManagementView
+    ProductManagementView,
+    CatalogExportView,
+    InventoryUpdateView,
+    PriceAdjustmentView,
+    CacheStatsView,
+    MetricsView
 )
 
 
 urlpatterns = [
     path("", ShopView.as_view(), name="shop"),
     path("manage/products/", permission_required('snakeoil_webshop.add_product')(ProductManagementView.as_view()), name="product-management"),
+    path("manage/products/export/", permission_required('snakeoil_webshop.add_product')(CatalogExportView.as_view()), name="catalog-export"),
+    path("manage/products/inventory/", InventoryUpdateView.as_view(), name="inventory-update"),
+    path("manage/products/prices/", PriceAdjustmentView.as_view(), name="price-adjustment"),
     path("cart/", ShoppingCartView.as_view(), name="shopping-cart"),
     path("cart/add/", AddToCartView.as_view(), name="add-to-cart"),
+    path("cart/add/batch/", AddToCartBatchView.as_view(), name="add-to-cart-batch"),
     path("cart/clear/", ClearCartView.as_view(), name="clear-cart"),
+    path("checkout/", CheckoutView.as_view(), name="checkout"),
+    path("orders/<int:pk>/", OrderView.as_view(), name="order"),
+    path("orders/<int:pk>/confirm/", ConfirmOrderView.as_view(), name="confirm-order"),
+    path("orders/<int:pk>/cancel/", CancelOrderView.as_view(), name="cancel-order"),
+    path("stats/cache/", CacheStatsView.as_view(), name="cache-stats"),
+    path("metrics", MetricsView.as_view(), name="metrics"),
 
     path("admin/", admin.site.urls),
     path("login/", LoginView.as_view(template_name="login.html"), name="login"),
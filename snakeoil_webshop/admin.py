@@ -1,6 +1,30 @@
 from django.contrib import admin
-from django.db.models import Sum, F
-from snakeoil_webshop.models import Product, ShoppingCart, ShoppingCartItem
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
+
+from snakeoil_webshop import carts
+from snakeoil_webshop.models import Order, OrderLine, Product, ShoppingCart, ShoppingCartItem
+from snakeoil_webshop.pagination import estimate_table_rows
+from snakeoil_webshop.search import get_search_backend
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Counts unfiltered changelists from the table statistics of the
+    database instead of scanning the whole table. Filtered changelists
+    and databases without statistics are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, "query", None)
+        if query is not None and not query.where:
+            estimate = estimate_table_rows(self.object_list.model, self.object_list.db)
+            if estimate is not None:
+                return estimate
+
+        return super().count
+
 
 
 class ProductAdmin(admin.ModelAdmin):
@@ -10,40 +34,99 @@ class ProductAdmin(admin.ModelAdmin):
         'created',
         'updated',
         'price',
-        'num_in_stock'
+        'num_in_stock',
+        'stock_shards'
     ]
-    readonly_fields = ['created', 'updated']
+    # Sharded stock is changed with the shard_stock command.
+    readonly_fields = ['created', 'updated', 'stock_shards']
     list_display = ['__str__', 'created', 'updated', 'price', 'num_in_stock']
 
+    # Searching goes through the full-text index, see get_search_results().
+    # The fields listed here only enable the search box and autocompletion.
+    search_fields = ['sku', 'name']
+    ordering = ['sku']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_readonly_fields(self, request, obj=None):
+        """
+        The stock of a sharded product is held by its shards, and
+        num_in_stock only displays their total as of the last fold.
+        """
+        if obj is not None and obj.stock_shards:
+            return self.readonly_fields + ['num_in_stock']
+
+        return self.readonly_fields
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+
+        return get_search_backend().search(queryset, search_term), False
+
 
 class ShoppingCartItemInline(admin.StackedInline):
     model = ShoppingCartItem
-    extra = 3
+    extra = 0
+    # A plain select would list the whole catalog for every item.
+    autocomplete_fields = ['product']
 
 
 class ShoppingCartAdmin(admin.ModelAdmin):    
 
-    fields = ['user', 'item_count', 'total_price']
-    readonly_fields = ['item_count', 'total_price']
-    list_display = ['__str__', 'item_count', 'total_price']
+    fields = ['user', 'item_count', 'total_price', 'last_activity']
+    readonly_fields = ['item_count', 'total_price', 'last_activity']
+    list_display = ['__str__', 'item_count', 'total_price', 'last_activity']
+    list_select_related = ['user']
+    raw_id_fields = ['user']
+    search_fields = ['user__username']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     inlines = [ShoppingCartItemInline]
 
+    # The running totals are stored on the cart,
+    # so listing them doesn't aggregate the items.
+    @admin.display(description="Item count", ordering='num_items')
     def item_count(self, obj):
-        total_num_items = obj.shopping_cart_items.aggregate(
-            total_num_items=Sum('num_items')
-        ).get('total_num_items', 0)
-        
-        return total_num_items
+        return obj.num_items
 
+    @admin.display(description="Total price", ordering='total_price')
     def total_price(self, obj):
-        total_price = obj.shopping_cart_items.aggregate(
-            total_price=Sum(
-                F('product__price')*F('num_items')
-            )
-        ).get('total_price', 0.00)
+        return obj.total_price
+
+    def save_related(self, request, form, formsets, change):
+        """
+        Items edited through the inline don't maintain the running
+        totals of the cart, so recount them after saving.
+        """
+        super().save_related(request, form, formsets, change)
+        carts.recalculate_totals(form.instance)
+
+
+class OrderLineInline(admin.TabularInline):
+    model = OrderLine
+    extra = 0
+    can_delete = False
+    readonly_fields = ['product', 'sku', 'name', 'price', 'num_items']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product')
+
+
+class OrderAdmin(admin.ModelAdmin):
 
-        return total_price        
+    # Changing an order here would bypass the stock bookkeeping
+    # in stock.py, so orders are read-only.
+    fields = ['user', 'status', 'created', 'expires', 'num_items', 'total_price']
+    readonly_fields = fields
+    list_display = ['__str__', 'status', 'created', 'expires', 'num_items', 'total_price']
+    list_filter = ['status']
+    list_select_related = ['user']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    inlines = [OrderLineInline]
 
 
 admin.site.register(Product, ProductAdmin)
-admin.site.register(ShoppingCart, ShoppingCartAdmin)
\ No newline at end of file
+admin.site.register(ShoppingCart, ShoppingCartAdmin)
+admin.site.register(Order, OrderAdmin)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class SnakeoilWebshopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'snakeoil_webshop'
+
+    def ready(self):
+        # Connect the signal handlers keeping derived data in sync with the models.
+        import snakeoil_webshop.signals  # noqa: F401
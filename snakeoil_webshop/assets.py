@@ -0,0 +1,142 @@
+import gzip
+import os
+import tempfile
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+
+try:
+    import brotli
+except ImportError:
+    # Without the Brotli package, only gzip variants are written.
+    brotli = None
+
+
+DEFAULT_BUILD_DIRECTORY = os.path.join(tempfile.gettempdir(), "snakeoil-bundles")
+
+# Files worth compressing. Images and web fonts other
+# than the legacy formats are compressed already.
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".svg", ".ttf", ".eot", ".ico", ".json", ".map", ".txt", ".webmanifest"}
+
+# Smaller files gain less from compression than the response headers cost.
+MIN_COMPRESS_SIZE = 256
+
+# A compressed variant is only kept if it's at most this big relative to the original.
+MAX_COMPRESSED_RATIO = 0.9
+
+
+def bundle_options():
+    return getattr(settings, "SNAKEOIL_STATIC_BUNDLES", {})
+
+
+class BundleFinder(finders.BaseFinder):
+    """
+    Finds the bundles listed in the SNAKEOIL_STATIC_BUNDLES setting, each the
+    concatenation of other static files. The bundles are built on demand into
+    a directory of their own, so runserver serves them like any static file
+    and collectstatic collects them for hashing and compression.
+    """
+
+    # Finders live as long as the process, so read the settings on every use.
+    @property
+    def bundles(self):
+        return bundle_options().get("BUNDLES", {})
+
+    @property
+    def storage(self):
+        return FileSystemStorage(location=bundle_options().get("DIRECTORY") or DEFAULT_BUILD_DIRECTORY)
+
+    def check(self, **kwargs):
+        return []
+
+    def find(self, path, all=False):
+        if path not in self.bundles:
+            return []
+
+        full_path = self.build(path)
+        return [full_path] if all else full_path
+
+    def list(self, ignore_patterns):
+        storage = self.storage
+        for name in self.bundles:
+            self.build(name)
+            yield name, storage
+
+    def build(self, name):
+        """
+        Write the bundle of the given name, unless it's up to date already.
+        Returns the path of the bundle file.
+        """
+        parts = []
+        for source in self.bundles[name]:
+            path = finders.find(source)
+            if path is None:
+                raise FileNotFoundError(f"The static file {source} of the bundle {name} was not found.")
+            with open(path, "rb") as f:
+                parts.append(f.read().rstrip())
+
+        # The semicolon ends the last statement of a script that omitted it.
+        separator = b";\n" if name.endswith(".js") else b"\n"
+        content = separator.join(parts) + b"\n"
+
+        storage = self.storage
+        if storage.exists(name):
+            with storage.open(name) as f:
+                if f.read() == content:
+                    return storage.path(name)
+            storage.delete(name)
+        storage.save(name, ContentFile(content))
+
+        return storage.path(name)
+
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Adds content hashes to the names of the collected static files, so
+    that they can be cached forever, and writes gzip and Brotli compressed
+    variants next to each hashed file for nginx to serve as they are.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        hashed_names = set()
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if isinstance(hashed_name, str):
+                hashed_names.add(hashed_name)
+            yield name, hashed_name, processed
+
+        if dry_run:
+            return
+
+        for hashed_name in sorted(hashed_names):
+            self.compress(hashed_name)
+
+    def compress(self, name):
+        if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+            return
+
+        with self.open(name) as f:
+            content = f.read()
+        if len(content) < MIN_COMPRESS_SIZE:
+            return
+
+        # Leave the timestamp out so that rebuilds produce identical files.
+        variants = {".gz": gzip.compress(content, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants[".br"] = brotli.compress(content)
+
+        for suffix, compressed in variants.items():
+            if len(compressed) <= len(content) * MAX_COMPRESSED_RATIO:
+                self.delete(name + suffix)
+                self._save(name + suffix, ContentFile(compressed))
+
+    def stored_name(self, name):
+        # Until collectstatic has written the manifest, e.g. in tests,
+        # refer to the static files by their plain names.
+        if not self.hashed_files:
+            return name
+
+        return super().stored_name(name)
@@ -0,0 +1,96 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+
+
+DEFAULT_AUTH_CACHE = "default"
+DEFAULT_AUTH_TIMEOUT = 5 * 60
+
+USER_KEY_PREFIX = "auth-user"
+PERMISSIONS_KEY_PREFIX = "auth-permissions"
+# Changes to groups and their permissions may concern any number of users,
+# so they move every user's cached permissions to a new version at once.
+PERMISSIONS_VERSION_KEY = "auth-permissions-version"
+
+
+def auth_cache_options():
+    options = getattr(settings, "SNAKEOIL_AUTH_CACHE", {})
+    return (
+        caches[options.get("CACHE", DEFAULT_AUTH_CACHE)],
+        options.get("TIMEOUT", DEFAULT_AUTH_TIMEOUT)
+    )
+
+
+def get_permissions_version():
+    cache, timeout = auth_cache_options()
+    version = cache.get(PERMISSIONS_VERSION_KEY)
+    if version is None:
+        # Start from the clock for the same reason as the catalog version.
+        cache.add(PERMISSIONS_VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(PERMISSIONS_VERSION_KEY)
+
+    return version
+
+
+def bump_permissions_version():
+    """
+    Forget the cached permissions of every user, e.g. after
+    changing the permissions of a group or its members.
+    """
+    cache, timeout = auth_cache_options()
+    try:
+        return cache.incr(PERMISSIONS_VERSION_KEY)
+    except ValueError:
+        cache.add(PERMISSIONS_VERSION_KEY, time.time_ns(), timeout=None)
+        return cache.incr(PERMISSIONS_VERSION_KEY)
+
+
+def permissions_key(user_id):
+    return f"{PERMISSIONS_KEY_PREFIX}:{get_permissions_version()}:{user_id}"
+
+
+def forget_user(user_id):
+    """
+    Drop the cached copy of the user and their permissions.
+    Call this after writing the user in any way that bypasses the signals.
+    """
+    cache, timeout = auth_cache_options()
+    cache.delete_many([f"{USER_KEY_PREFIX}:{user_id}", permissions_key(user_id)])
+
+
+class CachingModelBackend(ModelBackend):
+    """
+    The model backend of Django, keeping the users of authenticated
+    sessions and their permissions in the cache. The signals in signals.py
+    drop the cached entries when users, groups or permissions change.
+    """
+
+    def get_user(self, user_id):
+        cache, timeout = auth_cache_options()
+        key = f"{USER_KEY_PREFIX}:{user_id}"
+        user = cache.get(key)
+
+        if user is None:
+            user = super().get_user(user_id)
+            if user is None:
+                return None
+            cache.set(key, user, timeout=timeout)
+
+        return user if self.user_can_authenticate(user) else None
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+
+        if not hasattr(user_obj, "_perm_cache"):
+            cache, timeout = auth_cache_options()
+            key = permissions_key(user_obj.pk)
+            permissions = cache.get(key)
+            if permissions is None:
+                permissions = super().get_all_permissions(user_obj)
+                cache.set(key, permissions, timeout=timeout)
+            user_obj._perm_cache = permissions
+
+        return user_obj._perm_cache
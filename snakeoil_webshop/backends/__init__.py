@@ -0,0 +1,128 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import OperationalError
+
+from snakeoil_webshop import metrics
+
+
+# Defaults for the SNAKEOIL_DB_CONNECTIONS setting.
+DEFAULT_MAX_PER_WORKER = None
+DEFAULT_WAIT_TIMEOUT = 10
+
+# Connection events counted in the metrics.
+OPENED = "opened"
+REUSED = "reused"
+CLOSED = "closed"
+WAITED = "waited"
+TIMED_OUT = "timed_out"
+
+
+def get_options():
+    return getattr(settings, "SNAKEOIL_DB_CONNECTIONS", {})
+
+
+class ConnectionSlots:
+    """
+    Limits how many database connections the threads of this process
+    may have open at once, across all databases. A thread wanting to open
+    a connection beyond the limit waits for another one to close.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout):
+        """
+        Take a slot, waiting at most timeout seconds for one to free up.
+        Returns the number of seconds waited.
+        """
+        with self.condition:
+            if self.limit is None or self.in_use < self.limit:
+                self.in_use += 1
+                return 0.0
+
+            start = time.perf_counter()
+            if not self.condition.wait_for(lambda: self.in_use < self.limit, timeout):
+                raise OperationalError(
+                    f"Timed out waiting for one of the {self.limit} database connections of this worker."
+                )
+            self.in_use += 1
+            return time.perf_counter() - start
+
+    def release(self):
+        with self.condition:
+            self.in_use -= 1
+            self.condition.notify()
+
+
+
+# The connection slots of this process, created on first use.
+process_slots = None
+process_slots_lock = threading.Lock()
+
+
+def get_slots():
+    global process_slots
+
+    with process_slots_lock:
+        if process_slots is None:
+            process_slots = ConnectionSlots(get_options().get("MAX_PER_WORKER", DEFAULT_MAX_PER_WORKER))
+        return process_slots
+
+
+def reset_slots():
+    """
+    Forget the connection slots of this process, e.g. after changing the limit.
+    Connections open at the time give their slots back to the old limit.
+    """
+    global process_slots
+
+    with process_slots_lock:
+        process_slots = None
+
+
+class ManagedConnectionMixin:
+    """
+    Mixed into the DatabaseWrapper of a Django backend, see the mysql
+    and sqlite3 packages next to this module. Every connection takes a
+    slot of the process while it's open, and openings, closings and waits
+    for a slot, including ones that timed out, are counted in the metrics. Reuses of persistent connections
+    are counted by the request_started handler in signals.py.
+    """
+
+    slots = None
+
+    def get_new_connection(self, conn_params):
+        slots = get_slots()
+        try:
+            waited = slots.acquire(get_options().get("WAIT_TIMEOUT", DEFAULT_WAIT_TIMEOUT))
+        except OperationalError:
+            metrics.db_connections.inc(alias=self.alias, event=TIMED_OUT)
+            raise
+        if waited:
+            metrics.db_connections.inc(alias=self.alias, event=WAITED)
+            metrics.db_connection_wait.observe(waited, alias=self.alias)
+
+        try:
+            connection = super().get_new_connection(conn_params)
+        except BaseException:
+            slots.release()
+            raise
+
+        self.slots = slots
+        metrics.db_connections.inc(alias=self.alias, event=OPENED)
+
+        return connection
+
+    def _close(self):
+        try:
+            super()._close()
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+                self.slots = None
+                metrics.db_connections.inc(alias=self.alias, event=CLOSED)
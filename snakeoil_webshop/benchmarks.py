@@ -0,0 +1,440 @@
+import contextlib
+import json
+import os
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+
+from django.contrib.auth.models import Group, Permission, User
+from django.core.cache import caches
+from django.db import OperationalError, connection, connections
+from django.db.models import Sum
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from snakeoil_webshop import carts, helpers, stock
+from snakeoil_webshop.forms import ProductSearchForm
+from snakeoil_webshop.management.commands import add_demo_users, generate_load_fixture
+from snakeoil_webshop.models import OrderLine, Product
+from snakeoil_webshop.pagination import NEXT, KeysetPaginator
+from snakeoil_webshop.search import get_search_backend
+from snakeoil_webshop.serializers import product_json_cache
+
+
+DEFAULT_ITERATIONS = 20
+
+# The metrics recorded for every scenario. Latencies are in milliseconds,
+# memory in kibibytes.
+P50 = "p50_ms"
+P95 = "p95_ms"
+QUERIES = "queries"
+PEAK_MEMORY = "peak_memory_kib"
+METRICS = [P50, P95, QUERIES, PEAK_MEMORY]
+LATENCIES = [P50, P95]
+
+# Differences this small are noise rather than regressions,
+# however large they are relative to the baseline.
+NOISE_FLOOR = {P50: 1.0, P95: 2.0, QUERIES: 0, PEAK_MEMORY: 64.0}
+
+# How many products the benchmark customer keeps in their cart.
+CART_SIZE = 20
+
+BENCHMARK_CUSTOMER_USERNAME = "benchmark.customer"
+BENCHMARK_MANAGER_USERNAME = "benchmark.manager"
+
+
+class BenchmarkData:
+    """
+    A seeded data set of the given size, meaning the number of products,
+    plus logged in clients for a customer and a shop manager to drive
+    the views with.
+    """
+
+    def __init__(self, size, seed=0):
+        generate_load_fixture.Command().handle(
+            products=size,
+            users=max(1, size // 10),
+            cart_items=size,
+            seed=seed,
+            silent=True
+        )
+
+        customer, created = User.objects.get_or_create(username=BENCHMARK_CUSTOMER_USERNAME)
+        manager, created = User.objects.get_or_create(username=BENCHMARK_MANAGER_USERNAME)
+        managers, created = Group.objects.get_or_create(name=add_demo_users.Command.MANAGERS_GROUP_NAME)
+        managers.permissions.add(Permission.objects.get(codename="add_product"))
+        managers.user_set.add(manager)
+
+        self.customer = customer
+        self.customer_client = Client()
+        self.customer_client.force_login(customer)
+        self.manager_client = Client()
+        self.manager_client.force_login(manager)
+
+        self.product_ids = list(Product.objects.order_by('pk').values_list('pk', flat=True)[:CART_SIZE])
+
+        # A cursor into the middle of the catalog, sorted by name.
+        products = ProductSearchForm({"sort_by": ProductSearchForm.NAME_ASC}).filter_results()
+        middle = products[size // 2] if size > 1 else products.first()
+        self.deep_cursor = KeysetPaginator(products).cursor_for(middle, NEXT)
+
+        self.fill_cart()
+
+
+    def fill_cart(self):
+        products = carts.lookup_products(self.product_ids)
+        carts.add_many_to_cart(self.customer, [(product, 1) for product in products.values()])
+
+
+
+#############
+# SCENARIOS #
+#############
+
+def shop(data):
+    return data.customer_client.get(reverse("shop"))
+
+
+def shop_search(data):
+    return data.customer_client.post(reverse("shop"), {
+        "search_string": "snake oil",
+        "sort_by": ProductSearchForm.NAME_ASC
+    })
+
+
+def shop_deep_page(data):
+    return data.customer_client.get(reverse("shop"), {
+        "sort_by": ProductSearchForm.NAME_ASC,
+        "cursor": data.deep_cursor
+    })
+
+
+def product_management(data):
+    return data.manager_client.get(reverse("product-management"))
+
+
+def shopping_cart(data):
+    return data.customer_client.get(reverse("shopping-cart"))
+
+
+def add_to_cart(data):
+    return data.customer_client.post(reverse("add-to-cart"), {"pk": data.product_ids[0], "num_items": 1})
+
+
+def clear_cart(data):
+    return data.customer_client.get(reverse("clear-cart"))
+
+
+def clear_caches(data=None):
+    """
+    Empty every cache the views read from, so that the next request
+    renders and queries everything from scratch.
+    """
+    for cache in caches.all():
+        cache.clear()
+    product_json_cache.clear()
+
+
+# (name, request, preparation) triples. The preparation isn't timed.
+# The warm scenarios measure the steady state, where the caches are
+# filled by the first request. The cold ones measure the request that
+# has to fill them, which is what a customer sees after every catalog
+# change or cache eviction.
+SCENARIOS = [
+    ("shop", shop, None),
+    ("shop_cold", shop, clear_caches),
+    ("shop_search", shop_search, None),
+    ("shop_deep_page", shop_deep_page, None),
+    ("shop_deep_page_cold", shop_deep_page, clear_caches),
+    ("product_management", product_management, None),
+    ("shopping_cart", shopping_cart, None),
+    ("shopping_cart_cold", shopping_cart, clear_caches),
+    ("add_to_cart", add_to_cart, None),
+    ("clear_cart", clear_cart, BenchmarkData.fill_cart),
+]
+
+
+@contextlib.contextmanager
+def test_database():
+    """
+    Run the block against a freshly migrated test database, which is
+    destroyed afterwards. The other databases, i.e. the read replicas,
+    point at the test database for the duration too, so the reads the
+    router sends to them see the seeded data rather than the real data.
+    """
+    setup_test_environment()
+    old_name = connection.settings_dict["NAME"]
+    mirrors = {
+        alias: dict(connections[alias].settings_dict)
+        for alias in connections if alias != connection.alias
+    }
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    for alias in mirrors:
+        connections[alias].close()
+        connections[alias].settings_dict.update(connection.settings_dict)
+    try:
+        yield
+    finally:
+        for alias, settings_dict in mirrors.items():
+            connections[alias].close()
+            connections[alias].settings_dict.clear()
+            connections[alias].settings_dict.update(settings_dict)
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def run_benchmarks(size, iterations=DEFAULT_ITERATIONS, seed=0):
+    """
+    Seed a data set of the given size into the current database, which
+    should be empty, and measure every scenario against it. Returns a
+    dictionary mapping scenario names to their metrics.
+    """
+    clear_caches()
+    get_search_backend.cache_clear()
+
+    data = BenchmarkData(size, seed=seed)
+
+    return {
+        name: measure(data, request, prepare, iterations)
+        for name, request, prepare in SCENARIOS
+    }
+
+
+def measure(data, request, prepare, iterations):
+    """
+    Send the request the given number of times, plus once for warming up
+    the caches. The preparation, if any, runs before every request, so a
+    scenario that clears the caches measures cold requests only. Memory is measured on a separate run because tracing
+    the allocations slows everything else down.
+    """
+    latencies = []
+    num_queries = 0
+
+    for i in range(iterations + 1):
+        if prepare is not None:
+            prepare(data)
+
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            response = request(data)
+            elapsed = time.perf_counter() - start
+
+        if response.status_code >= 400:
+            raise RuntimeError(f"{request.__name__} failed with status {response.status_code}.")
+
+        if i > 0:
+            latencies.append(elapsed * 1000)
+            num_queries = max(num_queries, count_queries(context))
+
+    if prepare is not None:
+        prepare(data)
+    tracemalloc.start()
+    try:
+        request(data)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        P50: round(statistics.median(latencies), 2),
+        P95: round(percentile(latencies, 95), 2),
+        QUERIES: num_queries,
+        PEAK_MEMORY: round(peak / 1024, 1),
+    }
+
+
+def count_queries(context):
+    # Transaction control statements are logged on some databases but not
+    # on others, so they are left out to keep the counts comparable.
+    return sum(
+        1 for query in context.captured_queries
+        if query["sql"].split(" ", 1)[0].upper() not in ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")
+    )
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+
+#############
+# BASELINES #
+#############
+
+def load_baseline(path, vendor):
+    """
+    Return the baseline recorded on the given kind of database, e.g.
+    "mysql", or None if there isn't one. The query counts differ between
+    databases, so each has its own.
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, encoding="utf-8") as f:
+        return json.load(f).get(vendor)
+
+
+def save_baseline(path, vendor, results):
+    """
+    Store the results as the baseline of the given kind of database,
+    keeping the baselines of the others.
+    """
+    baselines = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            baselines = json.load(f)
+    baselines[vendor] = results
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def find_regressions(results, baseline, threshold, check_latency=False):
+    """
+    Compare the results of a run against a baseline, both of the form
+    {size: {scenario: {metric: value}}}. Query counts are exact, so any
+    increase is a regression. Memory regresses when it grows by more than
+    the given fraction and the noise floor. So does latency, but latencies
+    depend on the machine, so they are only compared if asked to, against
+    a baseline recorded on the same machine. Returns a list of descriptions.
+    """
+    regressions = []
+    compared = METRICS if check_latency else [metric for metric in METRICS if metric not in LATENCIES]
+
+    for size, scenarios in results.items():
+        for name, metrics in scenarios.items():
+            expected = baseline.get(size, {}).get(name)
+            if expected is None:
+                continue
+
+            for metric in compared:
+                if metric not in expected:
+                    continue
+                if metric == QUERIES:
+                    limit = expected[metric]
+                else:
+                    limit = expected[metric] * (1 + threshold) + NOISE_FLOOR[metric]
+                if metrics[metric] > limit:
+                    regressions.append(
+                        f"{name} at size {size}: {metric} {metrics[metric]} > {expected[metric]} in the baseline"
+                    )
+
+    return regressions
+
+
+
+############
+# CHECKOUT #
+############
+
+def run_checkout_benchmark(num_workers=8, num_products=3, stock_per_product=100, orders_per_worker=50,
+                           num_shards=0, seed=0):
+    """
+    Have many workers check out carts of the same few products at once,
+    each in its own thread and database connection, until the stock runs
+    out. The stock of the products is split over the given number of
+    shards, if any. Returns the throughput and checks that nothing was
+    oversold: the stock taken from each product must equal the items
+    reserved for it.
+    """
+    # Several runs may share a database, so name the rows after the run.
+    sku_prefix = f"HOT-{num_shards}-"
+    username_prefix = f"checkout.{num_shards}.worker."
+    products = [
+        Product(sku=f"{sku_prefix}{i:03}", name=f"Hot snake oil {i}", description="In high demand.",
+                price="9.99", num_in_stock=stock_per_product)
+        for i in range(num_products)
+    ]
+    for product in products:
+        product.refresh_name_sort_key()
+    Product.objects.bulk_create(products)
+    User.objects.bulk_create([User(username=f"{username_prefix}{i}") for i in range(num_workers)])
+    # Not every database reports the keys of bulk created rows.
+    products = list(Product.objects.filter(sku__startswith=sku_prefix).order_by('pk'))
+    users = list(User.objects.filter(username__startswith=username_prefix).order_by('pk'))
+    if num_shards:
+        for product in products:
+            stock.set_stock_shards(product, num_shards)
+    snapshots = list(carts.lookup_products([product.pk for product in products]).values())
+
+    outcomes = {"placed": 0, "refused": 0, "retries": 0}
+    errors = []
+    lock = threading.Lock()
+
+    def work(user, worker_random):
+        try:
+            for i in range(orders_per_worker):
+                picked = worker_random.sample(snapshots, min(2, len(snapshots)))
+                outcome, retries = checkout_with_retries(
+                    user,
+                    [(product, worker_random.randint(1, 3)) for product in picked]
+                )
+                with lock:
+                    outcomes[outcome] += 1
+                    outcomes["retries"] += retries
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [
+        threading.Thread(target=work, args=(user, random.Random(seed * 1000 + i)))
+        for i, user in enumerate(users)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+
+    reserved = dict(
+        OrderLine.objects.filter(product__in=products).values_list('product').annotate(Sum('num_items'))
+    )
+    oversold = 0
+    for product in Product.objects.filter(pk__in=[product.pk for product in products]):
+        left = stock.available_stock(product)
+        if left < 0 or stock_per_product - left != reserved.get(product.pk, 0):
+            oversold += 1
+
+    return {
+        "workers": num_workers,
+        "shards": num_shards,
+        "checkouts": outcomes["placed"] + outcomes["refused"],
+        "orders_placed": outcomes["placed"],
+        "orders_refused": outcomes["refused"],
+        "retries": outcomes["retries"],
+        "seconds": round(elapsed, 2),
+        "checkouts_per_second": round((outcomes["placed"] + outcomes["refused"]) / elapsed, 1),
+        "oversold_products": oversold,
+    }
+
+
+def checkout_with_retries(user, additions, max_attempts=200):
+    """
+    Fill the user's cart and check it out. Transactions that lose a lock
+    conflict (a deadlock on MySQL, a locked table on SQLite) are retried.
+    Returns the outcome ("placed" or "refused") and the number of retries.
+    """
+    for attempt in range(max_attempts):
+        try:
+            # Start from an empty cart, whatever became of the last attempt.
+            carts.clear_cart(helpers.find_active_cart_for_user(user))
+            carts.add_many_to_cart(user, additions)
+            stock.place_order(user)
+            return "placed", attempt
+        except stock.InsufficientStockError:
+            return "refused", attempt
+        except OperationalError:
+            # Back off with some jitter so that the losers don't collide again.
+            time.sleep(random.uniform(0.5, 1.5) * 0.001 * 2 ** min(attempt, 5))
+
+    raise RuntimeError(f"Checkout of {user.username} kept failing.")
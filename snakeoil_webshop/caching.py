@@ -0,0 +1,250 @@
+import hashlib
+import json
+import threading
+import time
+
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Max
+
+from snakeoil_webshop import metrics, routers
+from snakeoil_webshop.models import Product
+
+
+# Defaults for the SNAKEOIL_PRODUCT_JSON_CACHE setting.
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_SHARED_CACHE = None
+DEFAULT_SHARED_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Defaults for the SNAKEOIL_FRAGMENT_CACHE setting.
+DEFAULT_FRAGMENT_CACHE = "default"
+DEFAULT_FRAGMENT_TIMEOUT = 5 * 60
+
+CATALOG_VERSION_KEY = "catalog-version"
+CATALOG_LAST_MODIFIED_KEY_PREFIX = "catalog-last-modified"
+FRAGMENT_KEY_PREFIX = "fragment"
+
+# Hit and miss counts of the fragment cache in this process.
+HITS = "hits"
+MISSES = "misses"
+fragment_cache_stats = Counter()
+fragment_cache_stats_lock = threading.Lock()
+
+
+class LRUCache:
+    """
+    A bounded in-process mapping that forgets the least recently
+    used entries once it's full. Safe to share between threads.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+
+class ProductJSONCache:
+    """
+    Caches the JSON representation of products under a key made of the
+    primary key and the 'updated' timestamp of the product. Editing a
+    product changes its key, so stale entries are never served and never
+    need to be invalidated; they just age out of the caches.
+
+    Lookups go to a bounded in-process LRU first and then, if one has
+    been configured, to a Django cache shared between the workers.
+    """
+
+    KEY_PREFIX = "product-json"
+
+    def __init__(self, serialize, max_entries=DEFAULT_MAX_ENTRIES, shared_cache=DEFAULT_SHARED_CACHE,
+                 shared_cache_timeout=DEFAULT_SHARED_CACHE_TIMEOUT):
+        self.serialize = serialize
+        self.local = LRUCache(max_entries)
+        self.shared_cache = shared_cache
+        self.shared_cache_timeout = shared_cache_timeout
+
+    @classmethod
+    def from_settings(cls, serialize):
+        options = getattr(settings, "SNAKEOIL_PRODUCT_JSON_CACHE", {})
+        return cls(
+            serialize,
+            max_entries=options.get("MAX_ENTRIES", DEFAULT_MAX_ENTRIES),
+            shared_cache=options.get("SHARED_CACHE", DEFAULT_SHARED_CACHE),
+            shared_cache_timeout=options.get("SHARED_CACHE_TIMEOUT", DEFAULT_SHARED_CACHE_TIMEOUT)
+        )
+
+    def key(self, product):
+        return f"{self.KEY_PREFIX}:{product.pk}:{product.updated.timestamp():.6f}"
+
+    def get(self, product):
+        """
+        Return the JSON representation of a single product.
+        """
+        return self.get_many([product])[product.pk]
+
+    def get_many(self, products):
+        """
+        Return a dictionary mapping the primary keys of the given products
+        to their JSON representations. Entries missing from the local LRU
+        are fetched from the shared tier in a single lookup, and anything
+        still missing is serialized and stored in both tiers.
+        """
+        results = {}
+        missing = {}
+
+        for product in products:
+            key = self.key(product)
+            cached = self.local.get(key)
+            if cached is None:
+                missing[key] = product
+            else:
+                results[product.pk] = cached
+
+        if not missing:
+            return results
+
+        if self.shared_cache is not None:
+            for key, cached in caches[self.shared_cache].get_many(list(missing)).items():
+                product = missing.pop(key)
+                self.local.set(key, cached)
+                results[product.pk] = cached
+
+        serialized = {}
+        for key, product in missing.items():
+            json_string = self.serialize(product)
+            self.local.set(key, json_string)
+            serialized[key] = json_string
+            results[product.pk] = json_string
+
+        if serialized and self.shared_cache is not None:
+            caches[self.shared_cache].set_many(serialized, timeout=self.shared_cache_timeout)
+
+        return results
+
+    def clear(self):
+        """
+        Empty the local tier. The shared tier is left alone as its
+        entries are versioned anyway.
+        """
+        self.local.clear()
+
+
+
+def fragment_cache_options():
+    options = getattr(settings, "SNAKEOIL_FRAGMENT_CACHE", {})
+    return (
+        caches[options.get("CACHE", DEFAULT_FRAGMENT_CACHE)],
+        options.get("TIMEOUT", DEFAULT_FRAGMENT_TIMEOUT)
+    )
+
+
+def get_catalog_version():
+    """
+    Return the current version of the product catalog. The version changes
+    whenever any product is written, which makes every cached fragment
+    rendered from the old catalog unreachable.
+    """
+    cache, timeout = fragment_cache_options()
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # Start from the clock rather than from zero. If the counter gets
+        # evicted, it must not return to a value it has already had while
+        # fragments rendered under that value may still be around.
+        cache.add(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+
+    return version
+
+
+def bump_catalog_version():
+    """
+    Move the catalog to a new version. Call this after writing
+    products in any way that bypasses the Product signals.
+    """
+    cache, timeout = fragment_cache_options()
+    try:
+        return cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        # The counter didn't exist yet or was evicted.
+        cache.add(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
+        return cache.incr(CATALOG_VERSION_KEY)
+
+
+def get_catalog_last_modified():
+    """
+    Return the time the most recently updated product was updated,
+    or None if there are no products. Computed once per catalog version.
+    """
+    cache, timeout = fragment_cache_options()
+    key = f"{CATALOG_LAST_MODIFIED_KEY_PREFIX}:{get_catalog_version()}"
+    last_modified = cache.get(key)
+
+    if last_modified is None:
+        with routers.read_from_primary():
+            last_modified = Product.objects.aggregate(last_modified=Max('updated'))['last_modified']
+        cache.set(key, last_modified, timeout=timeout)
+
+    return last_modified
+
+
+def fragment_key(name, **parameters):
+    """
+    Build a cache key for a rendered fragment from its name, the catalog
+    version and whatever parameters it was rendered with.
+    """
+    digest = hashlib.md5(
+        json.dumps(parameters, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+    return f"{FRAGMENT_KEY_PREFIX}:{name}:{get_catalog_version()}:{digest}"
+
+
+def get_or_render_fragment(key, render):
+    """
+    Return the fragment cached under the given key. On a miss, call
+    render() to produce the fragment and cache it.
+    """
+    cache, timeout = fragment_cache_options()
+    fragment = cache.get(key)
+
+    if fragment is not None:
+        count_fragment_lookup(HITS)
+        return fragment
+
+    count_fragment_lookup(MISSES)
+    with routers.read_from_primary():
+        fragment = render()
+    cache.set(key, fragment, timeout=timeout)
+
+    return fragment
+
+
+def count_fragment_lookup(outcome):
+    with fragment_cache_stats_lock:
+        fragment_cache_stats[outcome] += 1
+    metrics.fragment_cache_lookups.inc(outcome=outcome)
@@ -0,0 +1,434 @@
+import json
+import time
+
+from collections import namedtuple
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, router, transaction
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from snakeoil_webshop import metrics, routers
+from snakeoil_webshop.models import Product, ShoppingCart, ShoppingCartItem
+
+# Import the whole serializers module to extend Product with the as_json method.
+import snakeoil_webshop.serializers  # type: ignore
+
+
+# The little we need to know about a product to put it into a cart.
+ProductSnapshot = namedtuple("ProductSnapshot", ["pk", "price", "json"])
+
+PRODUCT_SNAPSHOT_KEY_PREFIX = "product-snapshot"
+PRODUCT_SNAPSHOT_TIMEOUT = 5 * 60
+MISSING_PRODUCT = "missing"
+MISSING_PRODUCT_TIMEOUT = 30
+
+# Upsert syntaxes. SQLite and PostgreSQL use ON CONFLICT, MySQL uses
+# ON DUPLICATE KEY UPDATE.
+ON_CONFLICT = "on_conflict"
+ON_DUPLICATE_KEY = "on_duplicate_key"
+UPSERT_DIALECTS = {
+    "mysql": ON_DUPLICATE_KEY,
+    "sqlite": ON_CONFLICT,
+    "postgresql": ON_CONFLICT,
+}
+
+CART_TABLE = ShoppingCart._meta.db_table
+ITEM_TABLE = ShoppingCartItem._meta.db_table
+
+CART_UPSERT_SQL = {
+    ON_CONFLICT: (
+        f"INSERT INTO {CART_TABLE} (user_id, num_items, total_price, version, last_activity) "
+        f"VALUES (%s, %s, %s, 1, %s) "
+        f"ON CONFLICT (user_id) DO UPDATE SET "
+        f"num_items = {CART_TABLE}.num_items + excluded.num_items, "
+        f"total_price = {CART_TABLE}.total_price + excluded.total_price, "
+        f"version = {CART_TABLE}.version + 1, "
+        f"last_activity = excluded.last_activity"
+    ),
+    ON_DUPLICATE_KEY: (
+        f"INSERT INTO {CART_TABLE} (user_id, num_items, total_price, version, last_activity) "
+        f"VALUES (%s, %s, %s, 1, %s) "
+        f"ON DUPLICATE KEY UPDATE "
+        f"num_items = num_items + VALUES(num_items), "
+        f"total_price = total_price + VALUES(total_price), "
+        f"version = version + 1, "
+        f"last_activity = VALUES(last_activity), "
+        f"id = LAST_INSERT_ID(id)"
+    ),
+}
+
+# Inserts any number of (cart, product, count) rows at once. The
+# placeholder rows are filled in by item_upsert_sql().
+ITEM_INSERT_SQL = f"INSERT INTO {ITEM_TABLE} (shopping_cart_id, product_id, num_items) VALUES "
+ITEM_UPSERT_SUFFIX = {
+    ON_CONFLICT: (
+        f" ON CONFLICT (shopping_cart_id, product_id) DO UPDATE SET "
+        f"num_items = {ITEM_TABLE}.num_items + excluded.num_items"
+    ),
+    ON_DUPLICATE_KEY: " ON DUPLICATE KEY UPDATE num_items = num_items + VALUES(num_items)",
+}
+
+
+def item_upsert_sql(dialect, num_rows):
+    return ITEM_INSERT_SQL + ", ".join(["(%s, %s, %s)"] * num_rows) + ITEM_UPSERT_SUFFIX[dialect]
+
+
+# Expressions for aggregating the items of a cart from scratch.
+ITEM_COUNT = Coalesce(Sum('shopping_cart_items__num_items'), 0)
+ITEM_PRICE = Coalesce(
+    Sum(F('shopping_cart_items__product__price') * F('shopping_cart_items__num_items')),
+    Decimal("0.00")
+)
+
+
+def lookup_product(product_id):
+    """
+    Return a ProductSnapshot of the product with the given ID, or None if
+    there is no such product. Snapshots are cached, and the Product signals
+    drop the cached snapshot whenever the product is saved or deleted.
+    """
+    return lookup_products([product_id]).get(product_id)
+
+
+def lookup_products(product_ids):
+    """
+    Return a dictionary mapping the given product IDs to ProductSnapshots.
+    IDs of products that don't exist are left out. Cached snapshots are
+    fetched in one cache lookup and the rest in one query.
+    """
+    keys = {f"{PRODUCT_SNAPSHOT_KEY_PREFIX}:{product_id}": product_id for product_id in product_ids}
+    snapshots = {}
+
+    for key, snapshot in cache.get_many(list(keys)).items():
+        snapshots[keys.pop(key)] = snapshot
+
+    if keys:
+        # The snapshots outlive the request, so don't fill them from a lagging replica.
+        with routers.read_from_primary():
+            products = list(Product.objects.filter(pk__in=set(keys.values())))
+        for product in products:
+            snapshots[product.pk] = ProductSnapshot(product.pk, product.price, product.as_json())
+
+        to_cache = {
+            key: snapshots.get(product_id, MISSING_PRODUCT)
+            for key, product_id in keys.items()
+        }
+        cache.set_many(
+            {key: value for key, value in to_cache.items() if value != MISSING_PRODUCT},
+            timeout=PRODUCT_SNAPSHOT_TIMEOUT
+        )
+        # Remember missing products too, but not for long.
+        cache.set_many(
+            {key: value for key, value in to_cache.items() if value == MISSING_PRODUCT},
+            timeout=MISSING_PRODUCT_TIMEOUT
+        )
+
+    return {
+        product_id: snapshot
+        for product_id, snapshot in snapshots.items()
+        if snapshot != MISSING_PRODUCT
+    }
+
+
+def forget_product(product_id):
+    forget_products([product_id])
+
+
+def forget_products(product_ids):
+    """
+    Drop the cached snapshots of the given products. Call this after
+    writing products in any way that bypasses the Product signals.
+    """
+    cache.delete_many([f"{PRODUCT_SNAPSHOT_KEY_PREFIX}:{product_id}" for product_id in product_ids])
+
+
+def reprice_carts(product_ids, chunk_size=1000):
+    """
+    Recompute the total prices of the carts holding any of the given
+    products from the current prices of their items. Call this after
+    changing the prices of products, since the stored totals only follow
+    the items put into and taken out of the carts. Each chunk of products
+    is handled in one UPDATE statement.
+    """
+    product_ids = list(product_ids)
+
+    for start in range(0, len(product_ids), chunk_size):
+        cart_ids = (
+            ShoppingCartItem.objects
+            .filter(product_id__in=product_ids[start:start + chunk_size])
+            .values('shopping_cart_id')
+        )
+        ShoppingCart.objects.filter(pk__in=Subquery(cart_ids)).update(
+            total_price=Coalesce(Subquery(item_sum(F('product__price') * F('num_items'))), Decimal("0.00")),
+            version=F('version') + 1
+        )
+
+
+def recount_carts(cart_ids, chunk_size=1000):
+    """
+    Recompute both totals of the given carts from their items, e.g. after
+    items were deleted from under them. Each chunk of carts is handled in
+    one UPDATE statement.
+    """
+    cart_ids = list(cart_ids)
+
+    for start in range(0, len(cart_ids), chunk_size):
+        ShoppingCart.objects.filter(pk__in=cart_ids[start:start + chunk_size]).update(
+            num_items=Coalesce(Subquery(item_sum(F('num_items'))), 0),
+            total_price=Coalesce(Subquery(item_sum(F('product__price') * F('num_items'))), Decimal("0.00")),
+            version=F('version') + 1
+        )
+
+
+def item_sum(expression):
+    """
+    A subquery summing the given expression over the items of the cart
+    being updated.
+    """
+    return (
+        ShoppingCartItem.objects
+        .filter(shopping_cart=OuterRef('pk'))
+        .values('shopping_cart')
+        .annotate(total=Sum(expression))
+        .values('total')
+    )
+
+
+def add_to_cart(user, product, num_items):
+    """
+    Put the given number of items of the given product (a ProductSnapshot)
+    into the user's cart. See add_many_to_cart().
+    """
+    return add_many_to_cart(user, [(product, num_items)])
+
+
+def add_many_to_cart(user, additions):
+    """
+    Put items into the user's cart, creating the cart if necessary. The
+    additions are (ProductSnapshot, number of items) pairs. Both the cart
+    totals and the item counts are incremented by the database in upsert
+    statements, so concurrent additions can't overwrite each other, and
+    all the additions are applied in a single transaction.
+
+    That takes two statements on databases with INSERT ... RETURNING.
+    MySQL has no way to return the updated totals from an upsert, so
+    there it takes a third one to read them back.
+
+    Every addition must be for at least one item, or ValueError is raised.
+
+    Returns the user's ShoppingCart with its updated totals.
+    """
+    if any(num_items < 1 for product, num_items in additions):
+        raise ValueError("Every addition must be for at least one item.")
+
+    # Merge additions of the same product. A single upsert statement
+    # may not touch the same row twice.
+    counts = {}
+    for product, num_items in additions:
+        counts[product.pk] = counts.get(product.pk, 0) + num_items
+
+    num_items = sum(counts.values())
+    price = sum((product.price * n for product, n in additions), Decimal("0.00"))
+
+    connection = connections[router.db_for_write(ShoppingCart)]
+    dialect = UPSERT_DIALECTS.get(connection.vendor, ON_CONFLICT)
+    now = timezone.now()
+    cart_parameters = [user.pk, num_items, price, connection.ops.adapt_datetimefield_value(now)]
+
+    with transaction.atomic(using=connection.alias, savepoint=False):
+        with connection.cursor() as cursor:
+            if connection.features.can_return_columns_from_insert:
+                # Create or update the cart and read the new totals back
+                # in a single statement.
+                cursor.execute(
+                    CART_UPSERT_SQL[dialect] + " RETURNING id, num_items, total_price, version",
+                    cart_parameters
+                )
+                cart_id, total_num_items, total_price, version = cursor.fetchone()
+            else:
+                # MySQL can't return the updated row, but it can be told
+                # to report the ID of the cart that was updated.
+                cursor.execute(CART_UPSERT_SQL[dialect], cart_parameters)
+                cart_id = cursor.lastrowid
+                cursor.execute(
+                    f"SELECT num_items, total_price, version FROM {CART_TABLE} WHERE id = %s",
+                    [cart_id]
+                )
+                total_num_items, total_price, version = cursor.fetchone()
+
+            parameters = []
+            for product_id, count in counts.items():
+                parameters.extend([cart_id, product_id, count])
+            cursor.execute(item_upsert_sql(dialect, len(counts)), parameters)
+
+    metrics.cart_mutations.inc(operation="add")
+
+    return ShoppingCart(
+        pk=cart_id,
+        user=user,
+        num_items=total_num_items,
+        total_price=Decimal(total_price).quantize(Decimal("0.01")),
+        version=version,
+        last_activity=now
+    )
+
+
+def clear_cart(shopping_cart):
+    """
+    Remove every item from the given cart and reset its totals.
+    A cart that hasn't been saved yet is empty already.
+    """
+    if shopping_cart.pk is None:
+        return
+
+    with transaction.atomic():
+        shopping_cart.shopping_cart_items.all().delete()
+        ShoppingCart.objects.filter(pk=shopping_cart.pk).update(
+            num_items=0,
+            total_price=Decimal("0.00"),
+            version=F('version') + 1,
+            last_activity=timezone.now()
+        )
+
+    metrics.cart_mutations.inc(operation="clear")
+
+    shopping_cart.num_items = 0
+    shopping_cart.total_price = Decimal("0.00")
+
+
+def recalculate_totals(shopping_cart):
+    """
+    Recompute the totals of a single cart from its items, e.g. after the
+    items were edited through some path that doesn't maintain the totals.
+    """
+    with transaction.atomic():
+        # Lock the cart so that no items get added while we're counting.
+        # Concurrent additions then apply their increments on top of ours.
+        ShoppingCart.objects.select_for_update().filter(pk=shopping_cart.pk).exists()
+
+        totals = ShoppingCart.objects.filter(pk=shopping_cart.pk).aggregate(
+            num_items=ITEM_COUNT,
+            total_price=ITEM_PRICE
+        )
+        totals["total_price"] = Decimal(totals["total_price"]).quantize(Decimal("0.01"))
+        ShoppingCart.objects.filter(pk=shopping_cart.pk).update(version=F('version') + 1, **totals)
+
+    metrics.cart_mutations.inc(operation="recalculate")
+
+    shopping_cart.num_items = totals["num_items"]
+    shopping_cart.total_price = totals["total_price"]
+
+
+def reconcile_totals(batch_size=1000):
+    """
+    Compare the stored totals of every cart against its items, one batch
+    of carts at a time, and fix the carts that have drifted. Every change
+    made through this module and the Product signals keeps the totals
+    right, so drift means that something wrote the items behind their
+    back, e.g. raw SQL or a database console.
+
+    Yields (number of carts checked, number of carts fixed) per batch.
+    """
+    last_pk = 0
+    while True:
+        batch = list(
+            ShoppingCart.objects
+            .filter(pk__gt=last_pk)
+            .order_by('pk')
+            .annotate(actual_num_items=ITEM_COUNT, actual_total_price=ITEM_PRICE)
+            .values('pk', 'num_items', 'total_price', 'actual_num_items', 'actual_total_price')
+            [:batch_size]
+        )
+        if not batch:
+            return
+
+        num_fixed = 0
+        for cart in batch:
+            actual_total_price = Decimal(cart['actual_total_price']).quantize(Decimal("0.01"))
+            if cart['num_items'] == cart['actual_num_items'] and cart['total_price'] == actual_total_price:
+                continue
+
+            # Recount under a lock rather than writing the numbers we just
+            # read, in case items were added in the meantime.
+            recalculate_totals(ShoppingCart(pk=cart['pk']))
+            num_fixed += 1
+
+        last_pk = batch[-1]['pk']
+        yield len(batch), num_fixed
+
+
+def purge_stale_carts(cutoff, batch_size=500, pause=0.1, max_replica_lag=None, archive=None):
+    """
+    Delete the carts that haven't been changed since the given cutoff time,
+    along with their items, oldest first and one short transaction per batch.
+    Carts changed while a batch is being deleted are left alone. The job may
+    be stopped at any time: running it again continues from the oldest
+    stale cart still left.
+
+    Between the batches the job sleeps for pause seconds and, if
+    max_replica_lag is given, waits until the replicas have caught up to
+    within that many seconds. If archive is a file, every cart is written
+    into it as a line of JSON before the batch is committed, so a cart may
+    appear twice in the archive if the job is interrupted.
+
+    Yields (number of carts deleted, number of items deleted) per batch.
+    """
+    while True:
+        with transaction.atomic():
+            cart_ids = list(
+                ShoppingCart.objects
+                .select_for_update(skip_locked=True)
+                .filter(last_activity__lt=cutoff)
+                .order_by('last_activity', 'pk')
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            if not cart_ids:
+                return
+
+            if archive is not None:
+                archive_carts(cart_ids, archive)
+
+            # Neither model has delete signals, so the carts and their items
+            # are deleted in one statement each without loading them.
+            _, deleted = ShoppingCart.objects.filter(pk__in=cart_ids).delete()
+            num_carts = deleted.get(ShoppingCart._meta.label, 0)
+            num_items = deleted.get(ShoppingCartItem._meta.label, 0)
+
+        metrics.cart_mutations.inc(num_carts, operation="purge")
+        yield num_carts, num_items
+
+        time.sleep(pause)
+        if max_replica_lag is not None:
+            routers.wait_for_replicas(max_replica_lag)
+
+
+def archive_carts(cart_ids, archive):
+    """
+    Write the given carts and the SKUs of their items
+    into the archive file, one JSON object per line.
+    """
+    items = {}
+    for item in (
+        ShoppingCartItem.objects
+        .filter(shopping_cart_id__in=cart_ids)
+        .values('shopping_cart_id', 'product__sku', 'num_items')
+    ):
+        items.setdefault(item['shopping_cart_id'], []).append(
+            {"sku": item['product__sku'], "num_items": item['num_items']}
+        )
+
+    for cart in (
+        ShoppingCart.objects
+        .filter(pk__in=cart_ids)
+        .order_by('last_activity', 'pk')
+        .values('pk', 'user_id', 'num_items', 'total_price', 'version', 'last_activity')
+    ):
+        cart["items"] = items.get(cart['pk'], [])
+        archive.write(json.dumps(cart, cls=DjangoJSONEncoder) + "\n")
+
+    # Make sure the carts are on disk before they are deleted.
+    archive.flush()
@@ -0,0 +1,210 @@
+import csv
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from snakeoil_webshop.forms import ProductImportForm, ProductValidationMixin
+from snakeoil_webshop.models import Product
+
+
+# Supported file formats.
+CSV = "csv"
+JSONL = "jsonl"
+FORMATS = [CSV, JSONL]
+
+CONTENT_TYPES = {
+    CSV: "text/csv",
+    JSONL: "application/x-ndjson",
+}
+
+# The fields that can be exported. By default the fields of the import
+# are exported, so that an export can be imported as it is.
+EXPORT_FIELDS = ['sku', 'name', 'description', 'price', 'num_in_stock', 'stock_shards', 'created', 'updated']
+DEFAULT_EXPORT_FIELDS = list(ProductImportForm.base_fields)
+
+# How many products to read per query when exporting.
+DEFAULT_EXPORT_CHUNK_SIZE = 2000
+
+
+def guess_format(path):
+    """
+    Guess the file format from the file name. Defaults to CSV.
+    """
+    if path.endswith(".gz"):
+        path = path[:-len(".gz")]
+
+    if path.endswith((".jsonl", ".ndjson", ".json")):
+        return JSONL
+
+    return CSV
+
+
+def read_rows(stream, file_format):
+    """
+    Yield (row number, row dictionary) pairs from the given text stream
+    one at a time, so that files of any size can be processed. Rows that
+    can't even be parsed are yielded with None in place of the dictionary.
+    """
+    if file_format == CSV:
+        for row_number, row in enumerate(csv.DictReader(stream), start=1):
+            yield row_number, row
+
+    elif file_format == JSONL:
+        row_number = 0
+        for line in stream:
+            if not line.strip():
+                continue
+            row_number += 1
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield row_number, row if isinstance(row, dict) else None
+
+    else:
+        raise ValueError(f"Unknown file format: {file_format}")
+
+
+class RowValidator(ProductValidationMixin):
+    """
+    Validates product definitions with the fields and the validation
+    rules of the product forms. Building a whole form for every row of
+    a large import would cost more than the database writes, so the same
+    form fields are reused for every row instead.
+    """
+
+    fields = ProductImportForm.base_fields
+
+    def validate(self, row):
+        """
+        Return the cleaned data of the given row and a dictionary of
+        error messages, which is empty if the row is valid.
+        """
+        self.cleaned_data = {}
+        errors = {}
+
+        for name, field in self.fields.items():
+            try:
+                self.cleaned_data[name] = field.clean(field.widget.value_from_datadict(row, {}, name))
+                clean_field = getattr(self, f"clean_{name}", None)
+                if clean_field is not None:
+                    self.cleaned_data[name] = clean_field()
+            except ValidationError as e:
+                errors[name] = e.messages
+
+        return self.cleaned_data, errors
+
+
+def validate_rows(numbered_rows):
+    """
+    Validate a list of (row number, row dictionary) pairs with the same
+    rules as the product creation form. Returns a list of valid product
+    definitions and a list of (row number, row, errors) rejections.
+
+    This is a plain module-level function so that it can be run in
+    a pool of worker processes.
+    """
+    validator = RowValidator()
+    valid = []
+    rejected = []
+
+    for row_number, row in numbered_rows:
+        if row is None:
+            rejected.append((row_number, row, {"__all__": ["The row could not be parsed."]}))
+            continue
+
+        cleaned_data, errors = validator.validate(row)
+        if errors:
+            rejected.append((row_number, row, errors))
+        else:
+            valid.append(cleaned_data)
+
+    return valid, rejected
+
+
+
+def parse_export_fields(value):
+    """
+    Turn a comma-separated list of field names into a list of fields
+    to export. An empty value gives the default fields.
+    """
+    fields = [name.strip() for name in (value or "").split(",") if name.strip()]
+    if not fields:
+        return DEFAULT_EXPORT_FIELDS
+
+    unknown = [name for name in fields if name not in EXPORT_FIELDS]
+    if unknown:
+        raise ValueError(
+            f"Unknown fields: {', '.join(unknown)}. The fields that can be exported are: {', '.join(EXPORT_FIELDS)}."
+        )
+
+    return fields
+
+
+def export_chunks(fields, chunk_size=None, using=None):
+    """
+    Yield the values of the given fields of every product as lists of
+    tuples, in the order of the primary key, reading chunk_size products
+    per query. Each query seeks past the last product of the previous one,
+    so memory use stays flat and no query holds a cursor or a snapshot
+    open for the whole export, whatever the size of the catalog.
+    """
+    chunk_size = chunk_size or DEFAULT_EXPORT_CHUNK_SIZE
+    products = Product.objects.using(using) if using else Product.objects
+    last_pk = 0
+
+    while True:
+        chunk = list(
+            products.filter(pk__gt=last_pk)
+            .order_by('pk')
+            .values_list('pk', *fields)[:chunk_size]
+        )
+        if not chunk:
+            return
+
+        last_pk = chunk[-1][0]
+        yield [row[1:] for row in chunk]
+
+
+class LineBuffer:
+    """
+    A file-like object that hands back what is written into it,
+    for turning csv.writer into a generator of lines.
+    """
+
+    def write(self, value):
+        return value
+
+
+
+def write_csv(chunks, fields):
+    writer = csv.writer(LineBuffer())
+    yield writer.writerow(fields)
+    for chunk in chunks:
+        yield "".join(writer.writerow(row) for row in chunk)
+
+
+def write_jsonl(chunks, fields):
+    for chunk in chunks:
+        yield "".join(
+            json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + "\n"
+            for row in chunk
+        )
+
+
+WRITERS = {
+    CSV: write_csv,
+    JSONL: write_jsonl,
+}
+
+
+def export_products(file_format, fields=None, chunk_size=None, using=None):
+    """
+    Yield the catalog in the given file format as pieces of text,
+    one piece per chunk of products read from the database.
+    """
+    fields = fields or DEFAULT_EXPORT_FIELDS
+
+    return WRITERS[file_format](export_chunks(fields, chunk_size, using), fields)
+
@@ -1,17 +1,18 @@
 from django import forms
-from django.db.models import Q
 
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Submit
-from django.forms import widgets
 
 from snakeoil_webshop.models import Product
+from snakeoil_webshop.search import RELEVANCE, get_search_backend
 
 
 class ProductSearchForm(forms.Form):
     """
-    A simple form for searching products by SKU (product code) or name.
-    Allows the user to choose whether to sort the results by price or name.
+    A simple form for searching products by SKU (product code) or name,
+    and optionally by description. Allows the user to choose whether to
+    sort the results by relevance, price or name, and to narrow them down
+    to a price range or to the products in stock.
     """
     #############
     # CONSTANTS #
@@ -22,14 +23,34 @@ class ProductSearchForm(forms.Form):
     NAME_DESC = "-name"
     PRICE_ASC = "price"
     PRICE_DESC = "-price"
+    BEST_MATCH = f"-{RELEVANCE}"
+
+    # Names of the search fields, e.g. for building query strings.
+    SEARCH_STRING = "search_string"
+    SORT_BY = "sort_by"
+    SEARCH_DESCRIPTION = "search_description"
+    MIN_PRICE = "min_price"
+    MAX_PRICE = "max_price"
+    IN_STOCK_ONLY = "in_stock_only"
 
     SORTING_CHOICES = [
         (NAME_ASC, "Name, A-Z"),
         (NAME_DESC, "Name, Z-A"),
         (PRICE_ASC, "Price, low first"),
         (PRICE_DESC, "Price, high first"),
+        (BEST_MATCH, "Best match"),
     ]
 
+    # The orderings behind the sorting choices. Each of them is backed
+    # by an index of the Product model, so pages are read in index order.
+    ORDERINGS = {
+        NAME_ASC: "name_sort_key",
+        NAME_DESC: "-name_sort_key",
+        PRICE_ASC: "price",
+        PRICE_DESC: "-price",
+        BEST_MATCH: BEST_MATCH,
+    }
+
 
     #################
     # SEARCH FIELDS #
@@ -42,6 +63,35 @@ class ProductSearchForm(forms.Form):
         help_text="Search for products by name or product code."
     )
 
+    # Whether to look for the search string in the product descriptions too.
+    search_description = forms.BooleanField(
+        label="Also search descriptions",
+        required=False
+    )
+
+    # Limits for the price of the products, either or both may be left out.
+    min_price = forms.DecimalField(
+        label="Lowest price",
+        required=False,
+        min_value=0,
+        decimal_places=2,
+        max_digits=8
+    )
+
+    max_price = forms.DecimalField(
+        label="Highest price",
+        required=False,
+        min_value=0,
+        decimal_places=2,
+        max_digits=8
+    )
+
+    # Whether to leave out the products that are sold out.
+    in_stock_only = forms.BooleanField(
+        label="Only products in stock",
+        required=False
+    )
+
     # A list of available ways to sort the results.
     sort_by = forms.ChoiceField(
         label="Sort by",
@@ -72,15 +122,33 @@ class ProductSearchForm(forms.Form):
             # quickly to show the validation errors.
             return Product.objects.none()
 
-        results = Product.objects.all()            
+        results = Product.objects.all()
+
+        min_price = self.cleaned_data.get("min_price")
+        if min_price is not None:
+            results = results.filter(price__gte=min_price)
+
+        max_price = self.cleaned_data.get("max_price")
+        if max_price is not None:
+            results = results.filter(price__lte=max_price)
+
+        if self.cleaned_data.get("in_stock_only"):
+            results = results.filter(num_in_stock__gt=0)
 
         search_string = self.cleaned_data.get("search_string", "")
+        sort_by = self.cleaned_data.get("sort_by", self.NAME_ASC)
+
         if search_string:
-            q = Q(sku__icontains=search_string) | Q(name__icontains=search_string)
-            results = results.filter(q)
+            results = get_search_backend().search(
+                results,
+                search_string,
+                include_description=self.cleaned_data.get("search_description", False)
+            )
+        elif sort_by == self.BEST_MATCH:
+            # Without a search string everything is an equally good match.
+            sort_by = self.NAME_ASC
 
-        sort_by = self.cleaned_data.get("sort_by", self.NAME_ASC)
-        results = results.order_by(sort_by)
+        results = results.order_by(self.ORDERINGS[sort_by])
 
         return results
 
@@ -91,13 +159,60 @@ class ProductSearchForm(forms.Form):
         Called when a fresh empty form is presented
         to the user.
         """
-        results = Product.objects.all().order_by(self.NAME_ASC)
+        results = Product.objects.all().order_by(self.ORDERINGS[self.NAME_ASC])
 
         return results
 
 
+    def search_parameters(self):
+        """
+        Return the validated search criteria as a dictionary suitable
+        for a query string, so that the same search can be repeated
+        when moving between the pages of the results.
+        """
+        if not self.is_bound or not self.is_valid():
+            return {}
+
+        return {
+            self.SEARCH_STRING: self.cleaned_data.get(self.SEARCH_STRING, ""),
+            self.SORT_BY: self.cleaned_data.get(self.SORT_BY, self.NAME_ASC),
+            self.SEARCH_DESCRIPTION: self.cleaned_data.get(self.SEARCH_DESCRIPTION, False),
+            self.MIN_PRICE: self.cleaned_data.get(self.MIN_PRICE) or "",
+            self.MAX_PRICE: self.cleaned_data.get(self.MAX_PRICE) or "",
+            self.IN_STOCK_ONLY: self.cleaned_data.get(self.IN_STOCK_ONLY, False),
+        }
+
+
+
+class ProductValidationMixin:
+    """
+    Validation rules shared by every form that defines products.
+    """
+
+    def clean_price(self):
+        """
+        Make sure the given price isn't negative.
+        """
+        price = self.cleaned_data.get("price")
+        if price is not None and price < 0:
+            raise forms.ValidationError("The price of a product cannot be negative.")
+
+        return price
+
+
+    def clean_num_in_stock(self):
+        """
+        Make sure the given number of items in stock isn't negative.
+        """
+        num_in_stock = self.cleaned_data.get("num_in_stock")
+        if num_in_stock is not None and num_in_stock < 0:
+            raise forms.ValidationError("The stock count of a product cannot be negative.")
+
+        return num_in_stock
+
+
 
-class ProductCreationForm(forms.ModelForm):
+class ProductCreationForm(ProductValidationMixin, forms.ModelForm):
     """
     This form collects the details necessary for adding a new
     product into the web shop's database.
@@ -127,36 +242,66 @@ class ProductCreationForm(forms.ModelForm):
         self.helper.add_input(Submit('submit', 'Add product', css_class='btn-success'))
 
 
-    def clean_price(self):
+    def give_all_results(self):
         """
-        Make sure the given price isn't negative.
+        Return all product definitions in the reverse update order,
+        i.e. the last product modified comes up first.
         """
-        price = self.cleaned_data.get("price")
-        if price < 0:
-            raise forms.ValidationError("The price of a product cannot be negative.")
+        results = Product.objects.all().order_by('-updated')
 
-        return price
+        return results
 
 
-    def clean_num_in_stock(self):
-        """
-        Make sure the given number of items in stock isn't negative.
-        """
-        num_in_stock = self.cleaned_data.get("num_in_stock")
-        if num_in_stock < 0:
-            raise forms.ValidationError("The stock count of a product cannot be negative.")
 
-        return num_in_stock
+class ProductImportForm(ProductValidationMixin, forms.ModelForm):
+    """
+    Validates a single row of a bulk product import. Existing products
+    with the same SKU are meant to be overwritten, so the uniqueness of
+    the SKU isn't checked. That also keeps validation free of queries.
+    """
+    class Meta:
+        model = Product
+        fields = [
+            'sku',
+            'name',
+            'description',
+            'price',
+            'num_in_stock',
+        ]
 
 
-    def give_all_results(self):
-        """
-        Return all product definitions in the reverse update order,
-        i.e. the last product modified comes up first.
-        """
-        results = Product.objects.all().order_by('-updated')
+    def validate_unique(self):
+        pass
 
-        return results
+
+
+class InventoryChangeForm(ProductValidationMixin, forms.Form):
+    """
+    Validates a single row of a bulk inventory update. The product is
+    identified by its SKU, and the stock count, the price or both are
+    set to the given values.
+    """
+    sku = forms.SlugField()
+    num_in_stock = forms.IntegerField(required=False)
+    price = forms.DecimalField(required=False, decimal_places=2, max_digits=8)
+
+
+
+class PriceAdjustmentForm(forms.Form):
+    """
+    Validates a relative price change, e.g. raising prices by 5 % or
+    lowering them by 1.00, applied to the products matching a search.
+    """
+    percent = forms.DecimalField(required=False, min_value=-100, max_value=1000, decimal_places=2)
+    amount = forms.DecimalField(required=False, decimal_places=2, max_digits=8)
+
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if (cleaned_data.get("percent") is None) == (cleaned_data.get("amount") is None):
+            raise forms.ValidationError("Give either a percentage or an amount to change the prices by.")
+
+        return cleaned_data
 
 
 
@@ -167,5 +312,6 @@ class AddToCartForm(forms.Form):
     """
     # The product ID.
     pk = forms.IntegerField()
-    # How many items to add?
-    num_items = forms.IntegerField(required=False)
\ No newline at end of file
+    # How many items to add? At least one: the counts are added to the
+    # cart as they are, so anything less would take items away.
+    num_items = forms.IntegerField(required=False, min_value=1)
\ No newline at end of file
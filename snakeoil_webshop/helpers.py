@@ -3,9 +3,32 @@ from snakeoil_webshop.models import ShoppingCart
 def find_active_cart_for_user(user):
     """
     Returns the active ShoppingCart of the given User.
-    Right now every user has at most just one cart,
-    so we will also create a cart here if it does not
-    exist yet.
+    Right now every user has at most just one cart. If
+    the user doesn't have one yet, an empty unsaved cart
+    is returned instead: nothing is written to the database
+    until the first item gets added (see carts.add_many_to_cart).
     """
-    active_cart, created = ShoppingCart.objects.get_or_create(user=user)
-    return active_cart
+    try:
+        return ShoppingCart.objects.get(user=user)
+    except ShoppingCart.DoesNotExist:
+        return ShoppingCart(user=user)
+
+
+def get_request_cart(request):
+    """
+    Returns the active ShoppingCart of the requesting user,
+    loading it at most once per request.
+    """
+    if not hasattr(request, "_cached_shopping_cart"):
+        request._cached_shopping_cart = find_active_cart_for_user(request.user)
+    return request._cached_shopping_cart
+
+
+def get_cart_items(shopping_cart):
+    """
+    Returns the items of the given cart with their products.
+    A cart that hasn't been saved yet has no items to query.
+    """
+    if shopping_cart.pk is None:
+        return []
+    return shopping_cart.shopping_cart_items.select_related("product")
@@ -0,0 +1,111 @@
+import contextlib
+import contextvars
+import time
+
+from collections import OrderedDict
+
+from django.db import connections
+
+
+# Names of the timings collected for every instrumented request.
+DB = "db"
+TEMPLATE = "template"
+JSON = "json"
+CART_SUMMARY = "cart_summary"
+
+# The timings of the request being handled in the current thread or task,
+# or None if the request isn't being instrumented.
+current_timings = contextvars.ContextVar("snakeoil_request_timings", default=None)
+
+
+class RequestTimings:
+    """
+    Accumulates the time spent and the number of calls made
+    under each name while handling a single request.
+    """
+
+    def __init__(self):
+        self.durations = OrderedDict()
+        self.counts = OrderedDict()
+
+    def add(self, name, duration):
+        self.durations[name] = self.durations.get(name, 0.0) + duration
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def duration_ms(self, name):
+        return self.durations.get(name, 0.0) * 1000
+
+    def count(self, name):
+        return self.counts.get(name, 0)
+
+    def items(self):
+        return [(name, self.duration_ms(name), self.count(name)) for name in self.durations]
+
+
+
+@contextlib.contextmanager
+def collect():
+    """
+    Collect the timings of everything timed inside the block
+    and hand them out as a RequestTimings object.
+    """
+    timings = RequestTimings()
+    token = current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        current_timings.reset(token)
+
+
+@contextlib.contextmanager
+def instrument_request():
+    """
+    Collect the timings of a request, including the time spent in queries
+    on every database connection. Nested uses share the outermost collector.
+    """
+    timings = current_timings.get()
+    if timings is not None:
+        yield timings
+        return
+
+    with contextlib.ExitStack() as stack:
+        timings = stack.enter_context(collect())
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(time_query))
+        yield timings
+
+
+@contextlib.contextmanager
+def timed(name):
+    """
+    Add the time spent inside the block to the current request's timings.
+    Does next to nothing when the request isn't being instrumented.
+    """
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def record(name, duration):
+    """
+    Add an already measured duration to the current request's timings.
+    """
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(name, duration)
+
+
+def time_query(execute, sql, params, many, context):
+    """
+    A database execute wrapper timing every query.
+    See connection.execute_wrapper().
+    """
+    with timed(DB):
+        return execute(sql, params, many, context)
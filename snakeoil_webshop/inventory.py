@@ -0,0 +1,182 @@
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, IntegerField, Value, When
+from django.db.models.functions import Greatest, Least, Now, Round
+
+from snakeoil_webshop import caching, carts, stock
+from snakeoil_webshop.catalog_io import RowValidator
+from snakeoil_webshop.forms import InventoryChangeForm
+from snakeoil_webshop.models import Product
+
+
+# How many products to update per statement.
+DEFAULT_CHUNK_SIZE = 1000
+
+UNKNOWN_SKU = "No product has this SKU."
+NOTHING_TO_CHANGE = "Give the number of items in stock, the price or both."
+
+PRICE_FIELD = Product._meta.get_field('price')
+# The largest price the price column holds, 999999.99.
+MAX_PRICE = (
+    Decimal(10 ** (PRICE_FIELD.max_digits - PRICE_FIELD.decimal_places))
+    - Decimal(1).scaleb(-PRICE_FIELD.decimal_places)
+)
+
+
+class ChangeValidator(RowValidator):
+    """
+    Validates inventory changes with the fields and rules of the InventoryChangeForm.
+    """
+
+    fields = InventoryChangeForm.base_fields
+
+
+
+def validate_changes(numbered_rows):
+    """
+    Validate a list of (row number, row dictionary) pairs describing
+    inventory changes. Returns a list of (row number, change) pairs for
+    the valid rows and a list of (row number, row, errors) rejections.
+    """
+    validator = ChangeValidator()
+    valid = []
+    rejected = []
+
+    for row_number, row in numbered_rows:
+        if not isinstance(row, dict):
+            rejected.append((row_number, row, {"__all__": ["The row could not be parsed."]}))
+            continue
+
+        cleaned_data, errors = validator.validate(row)
+        if not errors and cleaned_data["num_in_stock"] is None and cleaned_data["price"] is None:
+            errors = {"__all__": [NOTHING_TO_CHANGE]}
+
+        if errors:
+            rejected.append((row_number, row, errors))
+        else:
+            valid.append((row_number, cleaned_data))
+
+    return valid, rejected
+
+
+def apply_changes(numbered_changes, chunk_size=None):
+    """
+    Set the stock counts and prices of the products named by the given
+    (row number, change) pairs, as returned by validate_changes(). Each
+    chunk of products is updated with one UPDATE statement picking the
+    new values by SKU, and all the chunks are applied in one transaction.
+    If the same SKU appears more than once, the last change wins.
+
+    The stock of sharded products is spread over their shards instead.
+
+    Returns the number of products updated and a list of
+    (row number, change, errors) for the changes naming no product.
+    """
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    by_sku = {}
+    for row_number, change in numbered_changes:
+        by_sku[change["sku"]] = (row_number, change)
+
+    skus = list(by_sku)
+    updated_ids = []
+    repriced_ids = []
+    rejected = []
+
+    with transaction.atomic():
+        for start in range(0, len(skus), chunk_size):
+            chunk = {sku: by_sku[sku][1] for sku in skus[start:start + chunk_size]}
+            products = {
+                sku: (pk, num_shards)
+                for sku, pk, num_shards in Product.objects.filter(sku__in=list(chunk)).values_list(
+                    'sku', 'pk', 'stock_shards'
+                )
+            }
+
+            for sku in chunk.keys() - products.keys():
+                row_number, change = by_sku[sku]
+                rejected.append((row_number, change, {"sku": [UNKNOWN_SKU]}))
+
+            plain = {sku: change for sku, change in chunk.items() if sku in products}
+            sharded = {sku: change for sku, change in plain.items() if products[sku][1]}
+            for sku, change in sharded.items():
+                if change["num_in_stock"] is not None:
+                    pk, num_shards = products[sku]
+                    stock.set_stock_shards(Product(pk=pk), num_shards, change["num_in_stock"])
+                    # Only the price is left to set below.
+                    plain[sku] = dict(change, num_in_stock=None)
+
+            update_chunk(plain)
+            updated_ids.extend(products[sku][0] for sku in plain)
+            repriced_ids.extend(products[sku][0] for sku, change in plain.items() if change["price"] is not None)
+
+        carts.reprice_carts(repriced_ids)
+
+    # The updates bypass the Product signals.
+    if updated_ids:
+        carts.forget_products(updated_ids)
+        caching.bump_catalog_version()
+
+    rejected.sort(key=lambda rejection: rejection[0])
+
+    return len(updated_ids), rejected
+
+
+def update_chunk(changes):
+    """
+    Apply the given changes, a dictionary keyed by SKU, in one statement.
+    """
+    new_values = {}
+
+    stock_whens = [
+        When(sku=sku, then=Value(change["num_in_stock"]))
+        for sku, change in changes.items() if change["num_in_stock"] is not None
+    ]
+    if stock_whens:
+        new_values["num_in_stock"] = Case(*stock_whens, default=F('num_in_stock'), output_field=IntegerField())
+
+    price_whens = [
+        When(sku=sku, then=Value(change["price"]))
+        for sku, change in changes.items() if change["price"] is not None
+    ]
+    if price_whens:
+        new_values["price"] = Case(*price_whens, default=F('price'), output_field=price_output_field())
+
+    if new_values:
+        Product.objects.filter(sku__in=list(changes)).update(updated=Now(), **new_values)
+
+
+def adjust_prices(queryset, percent=None, amount=None):
+    """
+    Change the prices of the products in the given queryset by a percentage
+    or by an amount, rounded to cents, in a single UPDATE statement. The
+    new prices are kept between zero and MAX_PRICE, since strict databases
+    refuse values that don't fit the column. Returns the number of products
+    updated.
+    """
+    if percent is not None:
+        new_price = Round(F('price') * Value(1 + Decimal(percent) / 100), 2)
+    else:
+        new_price = F('price') + Value(Decimal(amount))
+    new_price = Least(
+        Greatest(new_price, Value(Decimal("0.00")), output_field=price_output_field()),
+        Value(MAX_PRICE),
+        output_field=price_output_field()
+    )
+
+    with transaction.atomic():
+        # The cached snapshots of the products have to be dropped afterwards,
+        # so find out which they are. Locking them keeps the set the same.
+        product_ids = list(queryset.select_for_update().order_by().values_list('pk', flat=True))
+        num_updated = queryset.order_by().update(price=new_price, updated=Now())
+        carts.reprice_carts(product_ids)
+
+    if product_ids:
+        carts.forget_products(product_ids)
+        caching.bump_catalog_version()
+
+    return num_updated
+
+
+def price_output_field():
+    return DecimalField(max_digits=PRICE_FIELD.max_digits, decimal_places=PRICE_FIELD.decimal_places)
@@ -34,7 +34,8 @@ class Command(BaseCommand):
         shop_manager = self.update_user(self.MANAGER_USERNAME, options)
         manager_group, created = Group.objects.get_or_create(name=self.MANAGERS_GROUP_NAME)
         manager_group.permissions.add(
-            Permission.objects.get(codename="add_product")
+            Permission.objects.get(codename="add_product"),
+            Permission.objects.get(codename="change_product")
         )
         manager_group.user_set.add(shop_manager)
 
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from snakeoil_webshop import inventory
+from snakeoil_webshop.forms import PriceAdjustmentForm, ProductSearchForm
+
+
+class Command(BaseCommand):
+    SILENT = "silent"
+
+    help = (
+        "Change the prices of the products matching a search by a percentage or an amount, "
+        "e.g. --percent 5 --search 'snake oil' raises the matching prices by 5 %. Prices are "
+        "rounded to cents and never go below zero. Without a search, every price is changed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--percent", help="Change the prices by this many percent, e.g. 5 or -10.")
+        parser.add_argument("--amount", help="Change the prices by this amount, e.g. 1.50 or -0.50.")
+        parser.add_argument("--search", default="", help="Only change the products matching this search.")
+        parser.add_argument("--search-description", action="store_true", help="Search the descriptions too.")
+        parser.add_argument("--min-price", help="Only change prices of at least this much.")
+        parser.add_argument("--max-price", help="Only change prices of at most this much.")
+        parser.add_argument("--in-stock-only", action="store_true", help="Only change the products in stock.")
+
+
+    def handle(self, *args, **options):
+        adjustment_form = PriceAdjustmentForm({
+            "percent": options.get("percent"),
+            "amount": options.get("amount"),
+        })
+        search_form = ProductSearchForm({
+            ProductSearchForm.SEARCH_STRING: options.get("search", ""),
+            ProductSearchForm.SORT_BY: ProductSearchForm.NAME_ASC,
+            ProductSearchForm.SEARCH_DESCRIPTION: options.get("search_description", False),
+            ProductSearchForm.MIN_PRICE: options.get("min_price"),
+            ProductSearchForm.MAX_PRICE: options.get("max_price"),
+            ProductSearchForm.IN_STOCK_ONLY: options.get("in_stock_only", False),
+        })
+        if not adjustment_form.is_valid() or not search_form.is_valid():
+            errors = dict(adjustment_form.errors, **search_form.errors)
+            raise CommandError(" ".join(message for messages in errors.values() for message in messages))
+
+        num_updated = inventory.adjust_prices(
+            search_form.filter_results(),
+            percent=adjustment_form.cleaned_data["percent"],
+            amount=adjustment_form.cleaned_data["amount"]
+        )
+
+        if not options.get(self.SILENT, False):
+            self.stdout.write(self.style.SUCCESS(f"Changed the prices of {num_updated} products."))
@@ -0,0 +1,81 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.text import compress_sequence
+
+from snakeoil_webshop import catalog_io
+
+
+class Command(BaseCommand):
+    SILENT = "silent"
+
+    help = (
+        "Export the product catalog as a CSV or JSONL file, or to standard output if the path "
+        "is '-'. The products are read and written a chunk at a time, so the catalog can be "
+        "of any size. Paths ending in .gz are compressed with gzip."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The file to write, or '-' for standard output.")
+        parser.add_argument(
+            "--format",
+            choices=catalog_io.FORMATS,
+            help="The file format. Guessed from the file name by default."
+        )
+        parser.add_argument(
+            "--fields",
+            help=(
+                f"Comma-separated names of the fields to export, out of: {', '.join(catalog_io.EXPORT_FIELDS)}. "
+                f"By default the fields read by import_products are exported."
+            )
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=catalog_io.DEFAULT_EXPORT_CHUNK_SIZE,
+            help="How many products to read per query."
+        )
+        parser.add_argument(
+            "--gzip",
+            action="store_true",
+            help="Compress the output with gzip even if the path doesn't end in .gz."
+        )
+
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options.get("format") or catalog_io.guess_format(path)
+        chunk_size = options.get("chunk_size", catalog_io.DEFAULT_EXPORT_CHUNK_SIZE)
+        compress = options.get("gzip", False) or path.endswith(".gz")
+
+        if chunk_size < 1:
+            raise CommandError("The chunk size must be positive.")
+        try:
+            fields = catalog_io.parse_export_fields(options.get("fields"))
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        start = time.monotonic()
+        pieces = catalog_io.export_products(file_format, fields, chunk_size)
+
+        if compress:
+            stream = sys.stdout.buffer if path == "-" else open(path, "wb")
+            pieces = compress_sequence(piece.encode("utf-8") for piece in pieces)
+        else:
+            stream = sys.stdout if path == "-" else open(path, "w", newline="", encoding="utf-8")
+
+        try:
+            for piece in pieces:
+                stream.write(piece)
+        finally:
+            if path == "-":
+                stream.flush()
+            else:
+                stream.close()
+
+        # Don't mix the report into the exported data.
+        if not options.get(self.SILENT, False) and path != "-":
+            self.stdout.write(self.style.SUCCESS(
+                f"Exported the catalog into {path} in {time.monotonic() - start:.1f} s."
+            ))
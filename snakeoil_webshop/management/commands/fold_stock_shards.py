@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from snakeoil_webshop import stock
+
+
+class Command(BaseCommand):
+    SILENT = "silent"
+
+    help = (
+        "Copy the total stock of every product with sharded stock into the stock count "
+        "shown in the shop, and spread the stock evenly over the shards again. Run this "
+        "periodically, e.g. every minute, while products are sharded."
+    )
+
+    def handle(self, *args, **options):
+        num_changed = stock.fold_stock_shards()
+
+        if not options.get(self.SILENT, False):
+            self.stdout.write(self.style.SUCCESS(f"Updated the displayed stock of {num_changed} products."))
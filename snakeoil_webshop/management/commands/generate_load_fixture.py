@@ -0,0 +1,299 @@
+import itertools
+import random
+import time
+
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from snakeoil_webshop import caching
+from snakeoil_webshop.models import Product, ShoppingCart, ShoppingCartItem, make_name_sort_key
+from snakeoil_webshop.search import get_search_backend
+
+
+class Command(BaseCommand):
+    SILENT = "silent"
+
+    DEFAULT_BATCH_SIZE = 5000
+    DEFAULT_PASSWORD = "snake-oil-load-test"
+    DEFAULT_PREFIX = "load"
+
+    # The average number of different products in a generated cart.
+    MEAN_PRODUCTS_PER_CART = 5
+
+    # Word lists for making up product names.
+    ADJECTIVES = [
+        "Clear", "Turbid", "Thick", "Potent", "Bubbling", "Ancient", "Fizzy", "Smoky", "Golden",
+        "Murky", "Glowing", "Sparkling", "Pungent", "Soothing", "Volatile", "Mellow", "Bitter",
+        "Fermented", "Crystalline", "Royal", "Wild", "Distilled", "Concentrated", "Cloudy",
+    ]
+    SNAKES = [
+        "snake", "viper", "cobra", "python", "adder", "mamba", "boa", "rattlesnake", "asp",
+        "serpent", "anaconda", "krait", "taipan", "sidewinder",
+    ]
+    PRODUCTS = [
+        "oil", "tonic", "elixir", "balm", "ointment", "extract", "essence", "salve", "syrup",
+        "liniment", "tincture", "remedy",
+    ]
+    CLAIMS = [
+        "Cures most ailments.", "Recommended by nobody in particular.", "May cause mild glowing.",
+        "Shake well before use.", "Not for internal use, probably.", "Harvested under a full moon.",
+        "Keep away from open flames.", "Results may vary considerably.", "Smells faintly of regret.",
+    ]
+
+    help = (
+        "Generate a production-sized synthetic data set for load testing and benchmarks: "
+        "products, customer accounts and filled shopping carts. All generated accounts "
+        "share one password, which is hashed only once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=0, help="How many products to generate.")
+        parser.add_argument("--users", type=int, default=0, help="How many customer accounts to generate.")
+        parser.add_argument(
+            "--cart-items",
+            type=int,
+            default=0,
+            help="How many cart items to spread over the carts of the generated users."
+        )
+        parser.add_argument("--seed", type=int, default=0, help="Seed for the random number generator.")
+        parser.add_argument(
+            "--prefix",
+            default=self.DEFAULT_PREFIX,
+            help="Prefix for the generated SKUs and usernames. Existing rows with the same names are kept."
+        )
+        parser.add_argument(
+            "--password",
+            default=self.DEFAULT_PASSWORD,
+            help="The password shared by all generated accounts."
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=self.DEFAULT_BATCH_SIZE,
+            help="How many rows to insert per statement."
+        )
+
+
+    def handle(self, *args, **options):
+        self.silent = options.get(self.SILENT, False)
+        self.random = random.Random(options.get("seed", 0))
+        self.prefix = options.get("prefix", self.DEFAULT_PREFIX)
+        self.batch_size = options.get("batch_size", self.DEFAULT_BATCH_SIZE)
+
+        num_products = options.get("products", 0)
+        num_users = options.get("users", 0)
+        num_cart_items = options.get("cart_items", 0)
+
+        if min(num_products, num_users, num_cart_items) < 0 or self.batch_size < 1:
+            raise CommandError("The counts must not be negative and the batch size must be positive.")
+
+        if num_products:
+            self.timed("products", num_products, self.generate_products, num_products)
+        if num_users:
+            password = options.get("password", self.DEFAULT_PASSWORD)
+            self.timed("users", num_users, self.generate_users, num_users, password)
+        if num_cart_items:
+            self.timed("cart items", num_cart_items, self.generate_carts, num_cart_items)
+
+
+    def timed(self, noun, requested, function, *args):
+        """
+        Run one of the generators and report how many rows it actually
+        inserted. That can be fewer than requested if rows with the same
+        names already exist or there aren't enough products or users.
+        """
+        start = time.monotonic()
+        inserted = function(*args)
+        elapsed = time.monotonic() - start
+
+        if not self.silent:
+            message = f"Generated {inserted} {noun} in {elapsed:.1f} s."
+            if inserted < requested:
+                self.stdout.write(self.style.WARNING(f"{message} {requested} were requested."))
+            else:
+                self.stdout.write(self.style.SUCCESS(message))
+
+
+    def batches(self, iterable):
+        iterator = iter(iterable)
+        while True:
+            batch = list(itertools.islice(iterator, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+    ############
+    # PRODUCTS #
+    ############
+
+    def generate_products(self, count):
+        generated = Product.objects.filter(sku__startswith=self.prefix.upper())
+        num_before = generated.count()
+
+        for batch in self.batches(self.make_product(i) for i in range(count)):
+            Product.objects.bulk_create(batch, ignore_conflicts=True)
+
+        # bulk_create() bypasses the Product signals.
+        get_search_backend().rebuild_index()
+        caching.bump_catalog_version()
+
+        return generated.count() - num_before
+
+
+    def make_product(self, i):
+        name = " ".join([
+            self.random.choice(self.ADJECTIVES),
+            self.random.choice(self.SNAKES),
+            self.random.choice(self.PRODUCTS),
+        ])
+
+        return Product(
+            sku=f"{self.prefix.upper()}{i:07}",
+            name=name,
+            name_sort_key=make_name_sort_key(name),
+            description=" ".join(self.random.sample(self.CLAIMS, 3)),
+            price=self.random_price(),
+            num_in_stock=self.random_stock_count()
+        )
+
+
+    def random_price(self):
+        """
+        Prices are log-normally distributed: mostly around 20 €,
+        with a long tail of expensive products.
+        """
+        price = min(self.random.lognormvariate(3.0, 0.8), 99999.0)
+        return Decimal(f"{max(price, 0.5):.2f}")
+
+
+    def random_stock_count(self):
+        """
+        About one product in ten is sold out. The rest have
+        exponentially distributed stock counts.
+        """
+        if self.random.random() < 0.1:
+            return 0
+        return int(self.random.expovariate(1 / 200)) + 1
+
+
+    #########
+    # USERS #
+    #########
+
+    def generate_users(self, count, password):
+        # Hashing the password is deliberately slow, so do it only once.
+        password_hash = make_password(password)
+        generated = User.objects.filter(username__startswith=f"{self.prefix}.customer.")
+        num_before = generated.count()
+
+        users = (
+            User(username=f"{self.prefix}.customer.{i:07}", password=password_hash)
+            for i in range(count)
+        )
+        for batch in self.batches(users):
+            User.objects.bulk_create(batch, ignore_conflicts=True)
+
+        return generated.count() - num_before
+
+
+    #########
+    # CARTS #
+    #########
+
+    def generate_carts(self, num_cart_items):
+        """
+        Fill the carts of the generated users. The number of different
+        products per cart is geometrically distributed, and popular
+        products end up in many more carts than others.
+        """
+        products = list(
+            Product.objects.filter(sku__startswith=self.prefix.upper()).order_by('pk').values_list('pk', 'price')
+        )
+        user_ids = list(
+            User.objects.filter(username__startswith=f"{self.prefix}.customer.")
+            .filter(shoppingcart__isnull=True)
+            .order_by('pk')
+            .values_list('pk', flat=True)
+        )
+        if not products or not user_ids:
+            raise CommandError("Generate products and users before generating cart items.")
+
+        # Zipf-like popularity: the k'th product is picked with weight 1/k.
+        cumulative_weights = list(itertools.accumulate(1 / k for k in range(1, len(products) + 1)))
+        num_carts = min(len(user_ids), -(-num_cart_items // self.MEAN_PRODUCTS_PER_CART))
+        self.random.shuffle(user_ids)
+
+        remaining = num_cart_items
+        carts_left = num_carts
+        for batch in self.batches(user_ids[:num_carts]):
+            carts = []
+            items_by_user = {}
+
+            for user_id in batch:
+                num_products = min(self.random_cart_size(remaining, carts_left), len(products))
+                carts_left -= 1
+                if num_products < 1:
+                    break
+                picked = self.pick_products(products, cumulative_weights, num_products)
+                items = [(product_id, price, self.random.choice([1, 1, 1, 2, 2, 3, 5])) for product_id, price in picked]
+                remaining -= len(items)
+
+                items_by_user[user_id] = items
+                carts.append(ShoppingCart(
+                    user_id=user_id,
+                    num_items=sum(n for _, _, n in items),
+                    total_price=sum((price * n for _, price, n in items), Decimal("0.00")),
+                    version=1
+                ))
+
+            with transaction.atomic():
+                ShoppingCart.objects.bulk_create(carts)
+                cart_ids = dict(
+                    ShoppingCart.objects.filter(user_id__in=list(items_by_user)).values_list('user_id', 'pk')
+                )
+                ShoppingCartItem.objects.bulk_create([
+                    ShoppingCartItem(shopping_cart_id=cart_ids[user_id], product_id=product_id, num_items=n)
+                    for user_id, items in items_by_user.items()
+                    for product_id, _, n in items
+                ])
+
+            if remaining < 1:
+                break
+
+        return num_cart_items - remaining
+
+
+    def random_cart_size(self, remaining, carts_left):
+        """
+        Spread the remaining items over the remaining carts: the sizes are
+        random around the average, every cart gets at least one item and
+        the last cart takes whatever is left.
+        """
+        if carts_left <= 1:
+            return remaining
+        mean = remaining / carts_left
+        size = int(self.random.expovariate(1 / mean)) + 1 if mean > 1 else 1
+        return min(size, remaining - (carts_left - 1))
+
+
+    def pick_products(self, products, cumulative_weights, count):
+        """
+        Pick the given number of different products, favouring the popular ones.
+        """
+        picked = set(self.random.choices(products, cum_weights=cumulative_weights, k=count))
+        for _ in range(3):
+            if len(picked) >= count:
+                break
+            picked.update(self.random.choices(products, cum_weights=cumulative_weights, k=count - len(picked)))
+
+        # Top up rare misses from the products not picked yet.
+        if len(picked) < count:
+            unpicked = [product for product in products if product not in picked]
+            picked.update(self.random.sample(unpicked, count - len(picked)))
+
+        return picked
@@ -0,0 +1,195 @@
+import itertools
+import json
+import sys
+import time
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from snakeoil_webshop import caching, carts, catalog_io, stock
+from snakeoil_webshop.models import Product
+from snakeoil_webshop.search import get_search_backend
+
+
+class Command(BaseCommand):
+    SILENT = "silent"
+
+    DEFAULT_BATCH_SIZE = 5000
+
+    # The fields overwritten when a product with the same SKU already exists.
+    UPDATE_FIELDS = ['name', 'name_sort_key', 'description', 'price', 'num_in_stock', 'updated']
+
+    help = (
+        "Import products from a CSV or JSONL file, or from standard input if the path is '-'. "
+        "The file is streamed, so it can be of any size. Rows are validated like in the product "
+        "creation form and upserted by SKU in batches. Rejected rows are reported."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The file to import, or '-' for standard input.")
+        parser.add_argument(
+            "--format",
+            choices=catalog_io.FORMATS,
+            help="The file format. Guessed from the file name by default."
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=self.DEFAULT_BATCH_SIZE,
+            help="How many rows to validate and write at a time."
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=0,
+            help="Validate the rows in this many worker processes. By default validation runs inline."
+        )
+        parser.add_argument(
+            "--rejects",
+            help="Write the rejected rows and the reasons for rejecting them into this JSONL file."
+        )
+
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options.get("format") or catalog_io.guess_format(path)
+        batch_size = options.get("batch_size", self.DEFAULT_BATCH_SIZE)
+        self.silent = options.get(self.SILENT, False)
+
+        if batch_size < 1:
+            raise CommandError("The batch size must be positive.")
+
+        stream = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+        rejects_file = open(options["rejects"], "w", encoding="utf-8") if options.get("rejects") else None
+
+        self.num_imported = 0
+        self.num_rejected = 0
+        self.start = time.monotonic()
+
+        try:
+            rows = catalog_io.read_rows(stream, file_format)
+            for valid, rejected in self.validated_batches(rows, batch_size, options.get("workers", 0)):
+                self.write_batch(valid)
+                self.report_rejects(rejected, rejects_file)
+                self.report_progress()
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            if rejects_file is not None:
+                rejects_file.close()
+
+        if not self.silent:
+            self.stdout.write(self.style.SUCCESS(
+                f"Imported {self.num_imported} products, rejected {self.num_rejected} rows "
+                f"in {time.monotonic() - self.start:.1f} s."
+            ))
+
+
+    @staticmethod
+    def batches(rows, batch_size):
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+    def validated_batches(self, rows, batch_size, num_workers):
+        """
+        Yield the (valid, rejected) results of validating the rows batch by
+        batch, in order. With worker processes, only a couple of batches per
+        worker are read ahead so that memory use stays bounded.
+        """
+        batches = self.batches(rows, batch_size)
+
+        if num_workers < 1:
+            for batch in batches:
+                yield catalog_io.validate_rows(batch)
+            return
+
+        # Forked workers shouldn't inherit an open database connection.
+        if not connection.in_atomic_block:
+            connection.close()
+
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=django.setup) as executor:
+            in_flight = deque()
+            for batch in batches:
+                in_flight.append(executor.submit(catalog_io.validate_rows, batch))
+                if len(in_flight) >= 2 * num_workers:
+                    yield in_flight.popleft().result()
+
+            while in_flight:
+                yield in_flight.popleft().result()
+
+
+    def write_batch(self, product_definitions):
+        """
+        Insert or update the given products in one statement.
+        """
+        if not product_definitions:
+            return
+
+        # If the batch has the same SKU twice, the last row wins.
+        by_sku = {definition["sku"]: definition for definition in product_definitions}
+        products = [Product(**definition) for definition in by_sku.values()]
+        for product in products:
+            product.refresh_name_sort_key()
+
+        with transaction.atomic():
+            Product.objects.bulk_create(
+                products,
+                update_conflicts=True,
+                # MySQL always resolves conflicts on every unique key and
+                # refuses to be told which ones.
+                unique_fields=['sku'] if connection.features.supports_update_conflicts_with_target else None,
+                update_fields=self.UPDATE_FIELDS
+            )
+
+            # bulk_create() bypasses the Product signals, so bring the
+            # derived data up to date here.
+            written = list(
+                Product.objects.filter(sku__in=list(by_sku)).only('pk', 'sku', 'name', 'description', 'stock_shards')
+            )
+            get_search_backend().index_products(written)
+            carts.reprice_carts([product.pk for product in written])
+
+            # The stock of sharded products is held by their shards, and
+            # the upsert only wrote the displayed count. Spread it over them.
+            for product in written:
+                if product.stock_shards:
+                    stock.set_stock_shards(
+                        product,
+                        product.stock_shards,
+                        num_in_stock=by_sku[product.sku]["num_in_stock"]
+                    )
+
+        carts.forget_products([product.pk for product in written])
+        caching.bump_catalog_version()
+
+        self.num_imported += len(products)
+
+
+    def report_rejects(self, rejected, rejects_file):
+        self.num_rejected += len(rejected)
+
+        for row_number, row, errors in rejected:
+            if rejects_file is not None:
+                rejects_file.write(json.dumps({"row": row_number, "data": row, "errors": errors}) + "\n")
+            elif not self.silent:
+                self.stderr.write(f"Row {row_number} rejected: {json.dumps(errors)}")
+
+
+    def report_progress(self):
+        if self.silent:
+            return
+
+        elapsed = time.monotonic() - self.start
+        rate = self.num_imported / elapsed if elapsed > 0 else 0
+        self.stdout.write(
+            f"{self.num_imported} imported, {self.num_rejected} rejected ({rate:.0f} products/s)"
+        )
@@ -0,0 +1,91 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from snakeoil_webshop import carts
+
+
+class Command(BaseCommand):
+    SILENT = "silent"
+
+    DEFAULT_DAYS = 30
+    DEFAULT_BATCH_SIZE = 500
+
+    help = (
+        "Delete the shopping carts nobody has changed in a while, along with their items, "
+        "in small batches with pauses in between. Safe to stop at any time; running it again "
+        "continues where it left off. Run this periodically, e.g. from cron, once a night."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=self.DEFAULT_DAYS,
+            help="Delete the carts that haven't been changed in this many days."
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=self.DEFAULT_BATCH_SIZE,
+            help="How many carts to delete per transaction."
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0.1,
+            help="How many seconds to sleep between batches."
+        )
+        parser.add_argument(
+            "--max-replica-lag",
+            type=float,
+            help="Between batches, wait until the read replicas are at most this many seconds behind."
+        )
+        parser.add_argument(
+            "--archive",
+            help="Append the deleted carts and their items into this JSONL file."
+        )
+
+
+    def handle(self, *args, **options):
+        days = options.get("days", self.DEFAULT_DAYS)
+        batch_size = options.get("batch_size", self.DEFAULT_BATCH_SIZE)
+        silent = options.get(self.SILENT, False)
+
+        if days < 0:
+            raise CommandError("The number of days can't be negative.")
+        if batch_size < 1:
+            raise CommandError("The batch size must be positive.")
+
+        cutoff = timezone.now() - datetime.timedelta(days=days)
+        archive = open(options["archive"], "a", encoding="utf-8") if options.get("archive") else None
+
+        total_carts = 0
+        total_items = 0
+        start = time.monotonic()
+
+        try:
+            for num_carts, num_items in carts.purge_stale_carts(
+                cutoff,
+                batch_size=batch_size,
+                pause=options.get("pause", 0.1),
+                max_replica_lag=options.get("max_replica_lag"),
+                archive=archive
+            ):
+                total_carts += num_carts
+                total_items += num_items
+                if not silent and options.get("verbosity", 1) > 1:
+                    self.stdout.write(f"Deleted {total_carts} carts and {total_items} items so far.")
+        finally:
+            if archive is not None:
+                archive.close()
+
+        if not silent:
+            elapsed = time.monotonic() - start
+            rate = (total_carts + total_items) / elapsed if elapsed else 0.0
+            self.stdout.write(self.style.SUCCESS(
+                f"Deleted {total_carts} shopping carts and {total_items} items older than {days} days "
+                f"in {elapsed:.1f} s ({rate:.0f} rows per second)."
+            ))
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from snakeoil_webshop.search import get_search_backend
+
+
+class Command(BaseCommand):
+    SILENT = "silent"
+
+    help = "Rebuild the full-text product search index from the product table."
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+
+        start = time.monotonic()
+        num_indexed = backend.rebuild_index()
+        elapsed = time.monotonic() - start
+
+        if not options.get(self.SILENT, False):
+            self.stdout.write(self.style.SUCCESS(
+                f"{type(backend).__name__}: indexed {num_indexed} products in {elapsed:.1f} s."
+            ))
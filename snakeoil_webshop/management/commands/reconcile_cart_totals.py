@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from snakeoil_webshop import carts
+
+
+class Command(BaseCommand):
+    SILENT = "silent"
+
+    help = (
+        "Compare the stored item count and total price of every shopping cart against "
+        "the items in the cart and fix any carts that have drifted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="How many carts to check per query."
+        )
+
+    def handle(self, *args, **options):
+        total_checked = 0
+        total_fixed = 0
+
+        for num_checked, num_fixed in carts.reconcile_totals(batch_size=options.get("batch_size", 1000)):
+            total_checked += num_checked
+            total_fixed += num_fixed
+
+        if not options.get(self.SILENT, False):
+            self.stdout.write(self.style.SUCCESS(
+                f"Checked {total_checked} shopping carts, fixed the totals of {total_fixed}."
+            ))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from snakeoil_webshop import stock
+
+
+class Command(BaseCommand):
+    SILENT = "silent"
+
+    help = (
+        "Return the stock of orders that were not confirmed before their reservations "
+        "expired. Run this periodically, e.g. from cron, every minute or so."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="How many expired orders to look up per query."
+        )
+
+    def handle(self, *args, **options):
+        num_released = stock.release_expired_reservations(batch_size=options.get("batch_size", 100))
+
+        if not options.get(self.SILENT, False):
+            self.stdout.write(self.style.SUCCESS(f"Released the stock of {num_released} expired orders."))
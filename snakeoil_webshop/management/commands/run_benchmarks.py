@@ -0,0 +1,123 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from snakeoil_webshop import benchmarks
+
+
+class Command(BaseCommand):
+    SILENT = "silent"
+
+    DEFAULT_SIZES = "1000,10000"
+    DEFAULT_BASELINE = os.path.join("benchmarks", "baseline.json")
+    DEFAULT_THRESHOLD = 0.5
+
+    help = (
+        "Drive the shop, product management, shopping cart, add to cart and clear cart views "
+        "through the test client on seeded data sets of several sizes. Records latency "
+        "percentiles, SQL query counts and peak memory per request and fails if the query counts "
+        "or memory regressed past the baseline of the configured kind of database, and the "
+        "latencies too if asked to. Runs in a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default=self.DEFAULT_SIZES,
+            help="Comma-separated numbers of products to benchmark with."
+        )
+        parser.add_argument(
+            "--iterations",
+            type=int,
+            default=benchmarks.DEFAULT_ITERATIONS,
+            help="How many times to send each request."
+        )
+        parser.add_argument("--seed", type=int, default=0, help="Seed for generating the data sets.")
+        parser.add_argument(
+            "--baseline",
+            default=self.DEFAULT_BASELINE,
+            help="The JSON file holding the baseline results."
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=self.DEFAULT_THRESHOLD,
+            help=(
+                "How much latency and memory may grow over the baseline before it counts as a "
+                "regression, as a fraction. Query counts may never grow."
+            )
+        )
+        parser.add_argument(
+            "--check-latency",
+            action="store_true",
+            help=(
+                "Compare the latencies against the baseline too. Only meaningful if the "
+                "baseline was recorded on this machine."
+            )
+        )
+        parser.add_argument(
+            "--update-baseline",
+            action="store_true",
+            help=(
+                "Store the results as the new baseline of the configured kind of database "
+                "instead of comparing against it."
+            )
+        )
+
+
+    def handle(self, *args, **options):
+        self.silent = options.get(self.SILENT, False)
+
+        try:
+            sizes = [int(size) for size in options.get("sizes", self.DEFAULT_SIZES).split(",")]
+        except ValueError:
+            raise CommandError("The sizes must be a comma-separated list of integers.")
+        iterations = options.get("iterations", benchmarks.DEFAULT_ITERATIONS)
+        if iterations < 1 or min(sizes) < 1:
+            raise CommandError("The sizes and the number of iterations must be positive.")
+
+        # Fail before spending minutes on the benchmarks if there's nothing to compare against.
+        baseline_path = options.get("baseline", self.DEFAULT_BASELINE)
+        update_baseline = options.get("update_baseline", False)
+        baseline = None if update_baseline else benchmarks.load_baseline(baseline_path, connection.vendor)
+        if not update_baseline and baseline is None:
+            raise CommandError(
+                f"No {connection.vendor} baseline found in {baseline_path}. "
+                f"Run with --update-baseline to create one."
+            )
+
+        results = {}
+        for size in sizes:
+            with benchmarks.test_database():
+                results[str(size)] = benchmarks.run_benchmarks(size, iterations=iterations, seed=options.get("seed", 0))
+            self.report(size, results[str(size)])
+
+        if update_baseline:
+            os.makedirs(os.path.dirname(baseline_path) or ".", exist_ok=True)
+            benchmarks.save_baseline(baseline_path, connection.vendor, results)
+            self.log(self.style.SUCCESS(f"Stored the results as the {connection.vendor} baseline in {baseline_path}."))
+            return
+
+        regressions = benchmarks.find_regressions(
+            results,
+            baseline,
+            options.get("threshold", self.DEFAULT_THRESHOLD),
+            check_latency=options.get("check_latency", False)
+        )
+        if regressions:
+            raise CommandError("Performance regressed:\n" + "\n".join(regressions))
+
+        self.log(self.style.SUCCESS("No regressions against the baseline."))
+
+
+    def report(self, size, results):
+        self.log(self.style.MIGRATE_HEADING(f"{size} products"))
+        self.log("  ".join(["scenario".ljust(20)] + [metric.rjust(16) for metric in benchmarks.METRICS]))
+        for name, metrics in results.items():
+            self.log("  ".join([name.ljust(20)] + [str(metrics[metric]).rjust(16) for metric in benchmarks.METRICS]))
+
+
+    def log(self, message):
+        if not self.silent:
+            self.stdout.write(message)
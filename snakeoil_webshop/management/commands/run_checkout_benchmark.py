@@ -0,0 +1,81 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from snakeoil_webshop import benchmarks
+
+
+class Command(BaseCommand):
+    SILENT = "silent"
+
+    help = (
+        "Have many concurrent workers check out carts of the same few products until the "
+        "stock runs out, and report the checkout throughput. Fails if any product was "
+        "oversold. Runs in a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=8, help="How many workers check out at once.")
+        parser.add_argument("--products", type=int, default=3, help="How many products the workers compete for.")
+        parser.add_argument("--stock", type=int, default=100, help="How many items of each product are in stock.")
+        parser.add_argument(
+            "--orders-per-worker",
+            type=int,
+            default=50,
+            help="How many checkouts each worker attempts."
+        )
+        parser.add_argument(
+            "--shards",
+            type=int,
+            default=0,
+            help="Split the stock of each product over this many shards. Zero keeps it on the product row."
+        )
+        parser.add_argument(
+            "--compare",
+            action="store_true",
+            help="Run once with the stock on the product rows and once sharded, and report the gain."
+        )
+        parser.add_argument("--seed", type=int, default=0, help="Seed for filling the carts.")
+
+
+    def handle(self, *args, **options):
+        self.silent = options.get(self.SILENT, False)
+        num_shards = options.get("shards", 0)
+
+        compare = options.get("compare", False)
+        if compare and num_shards < 1:
+            raise CommandError("Give the number of shards to compare against with --shards.")
+
+        with benchmarks.test_database():
+            if compare:
+                single_row = self.run(options, 0)
+                sharded = self.run(options, num_shards)
+                self.log(self.style.SUCCESS(
+                    f"Sharded stock served {sharded['checkouts_per_second'] / single_row['checkouts_per_second']:.2f}x "
+                    "the checkouts per second of single-row stock."
+                ))
+            else:
+                self.run(options, num_shards)
+
+
+    def run(self, options, num_shards):
+        results = benchmarks.run_checkout_benchmark(
+            num_workers=options.get("workers", 8),
+            num_products=options.get("products", 3),
+            stock_per_product=options.get("stock", 100),
+            orders_per_worker=options.get("orders_per_worker", 50),
+            num_shards=num_shards,
+            seed=options.get("seed", 0)
+        )
+
+        for key, value in results.items():
+            self.log(f"{key.ljust(24)}{value}")
+        self.log("")
+
+        if results["oversold_products"]:
+            raise CommandError(f"{results['oversold_products']} products were oversold.")
+
+        return results
+
+
+    def log(self, message):
+        if not self.silent:
+            self.stdout.write(message)
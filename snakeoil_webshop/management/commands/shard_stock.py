@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from snakeoil_webshop import stock
+from snakeoil_webshop.models import Product
+
+
+class Command(BaseCommand):
+    SILENT = "silent"
+
+    help = (
+        "Split the stock of a product in high demand over several counter rows so that "
+        "concurrent checkouts don't queue up for the same row, or move it back onto the "
+        "product with --shards 0. Also the way to restock a sharded product."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("sku", help="The SKU of the product.")
+        parser.add_argument("--shards", type=int, default=8, help="How many shards to split the stock over.")
+        parser.add_argument(
+            "--stock",
+            type=int,
+            default=None,
+            help="Set the stock to this many items. By default the current stock is kept."
+        )
+
+    def handle(self, *args, **options):
+        num_shards = options.get("shards", 8)
+        num_in_stock = options.get("stock", None)
+        if num_shards < 0 or (num_in_stock is not None and num_in_stock < 0):
+            raise CommandError("The number of shards and the stock must not be negative.")
+
+        try:
+            product = Product.objects.get(sku=options["sku"])
+        except Product.DoesNotExist:
+            raise CommandError(f"There is no product with the SKU {options['sku']}.")
+
+        stock.set_stock_shards(product, num_shards, num_in_stock)
+
+        if not options.get(self.SILENT, False):
+            self.stdout.write(self.style.SUCCESS(
+                f"The stock of {product.sku} is now split over {num_shards} shards."
+            ))
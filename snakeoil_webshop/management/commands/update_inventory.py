@@ -0,0 +1,76 @@
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from snakeoil_webshop import catalog_io, inventory
+
+
+class Command(BaseCommand):
+    SILENT = "silent"
+
+    help = (
+        "Set the stock counts and prices of products from a CSV or JSONL file with the columns "
+        "sku, num_in_stock and price, or from standard input if the path is '-'. Either of the "
+        "last two may be left empty. All the changes are applied in one transaction, a chunk of "
+        "products per statement. Rejected rows are reported."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The file of changes, or '-' for standard input.")
+        parser.add_argument(
+            "--format",
+            choices=catalog_io.FORMATS,
+            help="The file format. Guessed from the file name by default."
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=inventory.DEFAULT_CHUNK_SIZE,
+            help="How many products to update per statement."
+        )
+        parser.add_argument(
+            "--rejects",
+            help="Write the rejected rows and the reasons for rejecting them into this JSONL file."
+        )
+
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options.get("format") or catalog_io.guess_format(path)
+        chunk_size = options.get("chunk_size", inventory.DEFAULT_CHUNK_SIZE)
+        silent = options.get(self.SILENT, False)
+
+        if chunk_size < 1:
+            raise CommandError("The chunk size must be positive.")
+
+        start = time.monotonic()
+        stream = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+        try:
+            valid, rejected = inventory.validate_changes(catalog_io.read_rows(stream, file_format))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        num_updated, unknown = inventory.apply_changes(valid, chunk_size=chunk_size)
+        rejected = sorted(rejected + unknown, key=lambda rejection: rejection[0])
+
+        if options.get("rejects"):
+            with open(options["rejects"], "w", encoding="utf-8") as rejects_file:
+                for row_number, row, errors in rejected:
+                    rejects_file.write(
+                        json.dumps({"row": row_number, "data": row, "errors": errors}, cls=DjangoJSONEncoder) + "\n"
+                    )
+        elif not silent:
+            for row_number, row, errors in rejected:
+                self.stderr.write(f"Row {row_number} rejected: {json.dumps(errors)}")
+
+        if not silent:
+            elapsed = time.monotonic() - start
+            rate = num_updated / elapsed if elapsed > 0 else 0
+            self.stdout.write(self.style.SUCCESS(
+                f"Updated {num_updated} products, rejected {len(rejected)} rows "
+                f"in {elapsed:.1f} s ({rate:.0f} products/s)."
+            ))
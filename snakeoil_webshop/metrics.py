@@ -0,0 +1,361 @@
+import bisect
+import functools
+import glob
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from collections import defaultdict
+
+from django.conf import settings
+
+
+# The exposition format served at /metrics.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), "snakeoil-metrics")
+
+COUNTER = "counter"
+HISTOGRAM = "histogram"
+
+# Metric files start with the number of bytes in use, padded to 8 bytes.
+# Each entry that follows is a 4-byte key length, the UTF-8 key padded so
+# that the value is 8-byte aligned, and the value as an 8-byte double.
+HEADER = struct.Struct("i")
+KEY_LENGTH = struct.Struct("i")
+VALUE = struct.Struct("d")
+FIRST_ENTRY = 8
+INITIAL_FILE_SIZE = 64 * 1024
+
+
+def get_directory():
+    options = getattr(settings, "SNAKEOIL_METRICS", {})
+    return options.get("DIRECTORY") or DEFAULT_DIRECTORY
+
+
+class MetricsFile:
+    """
+    A memory-mapped file of named floating point values written by a single
+    process. Every worker process writes its own file, so increments never
+    have to coordinate with other processes, and /metrics adds the files up.
+    Aligned 8-byte writes are atomic, so readers never see torn values.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a+b")
+        size = os.fstat(self.file.fileno()).st_size
+        if size < INITIAL_FILE_SIZE:
+            self.file.truncate(INITIAL_FILE_SIZE)
+            size = INITIAL_FILE_SIZE
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+        self.used = HEADER.unpack_from(self.map, 0)[0] or FIRST_ENTRY
+        self.positions = {key: position for key, value, position in read_entries(self.map, self.used)}
+
+    def add(self, key, amount):
+        position = self.positions.get(key)
+        if position is None:
+            position = self.append(key)
+        VALUE.pack_into(self.map, position, VALUE.unpack_from(self.map, position)[0] + amount)
+
+    def append(self, key):
+        encoded = key.encode("utf-8")
+        padding = -(KEY_LENGTH.size + len(encoded)) % 8
+        entry_size = KEY_LENGTH.size + len(encoded) + padding + VALUE.size
+
+        if self.used + entry_size > len(self.map):
+            self.grow(self.used + entry_size)
+
+        KEY_LENGTH.pack_into(self.map, self.used, len(encoded))
+        self.map[self.used + KEY_LENGTH.size:self.used + KEY_LENGTH.size + len(encoded)] = encoded
+        position = self.used + entry_size - VALUE.size
+        VALUE.pack_into(self.map, position, 0.0)
+
+        # Publish the entry to readers only once it has been written.
+        self.used += entry_size
+        HEADER.pack_into(self.map, 0, self.used)
+        self.positions[key] = position
+
+        return position
+
+    def grow(self, minimum_size):
+        size = len(self.map)
+        while size < minimum_size:
+            size *= 2
+        self.map.close()
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+
+def read_entries(data, used=None):
+    """
+    Yield the (key, value, value position) entries of the given metrics file contents.
+    """
+    if used is None:
+        used = HEADER.unpack_from(data, 0)[0] if len(data) >= FIRST_ENTRY else 0
+
+    position = FIRST_ENTRY
+    while position + KEY_LENGTH.size <= used:
+        key_length = KEY_LENGTH.unpack_from(data, position)[0]
+        key_start = position + KEY_LENGTH.size
+        value_position = key_start + key_length + (-(KEY_LENGTH.size + key_length) % 8)
+        if value_position + VALUE.size > used:
+            return
+
+        key = bytes(data[key_start:key_start + key_length]).decode("utf-8")
+        yield key, VALUE.unpack_from(data, value_position)[0], value_position
+        position = value_position + VALUE.size
+
+
+# The metrics file of this process. It's opened on the first write so that
+# forked workers each get their own.
+process_file = None
+process_file_pid = None
+process_file_lock = threading.Lock()
+
+
+def add(key, amount):
+    add_many([(key, amount)])
+
+
+def add_many(amounts):
+    """
+    Add amounts to values in this process's metrics file. The lock only
+    guards against the threads of the same process and is hardly ever contended.
+    """
+    global process_file, process_file_pid
+
+    with process_file_lock:
+        if process_file_pid != os.getpid():
+            directory = get_directory()
+            os.makedirs(directory, exist_ok=True)
+            process_file = MetricsFile(os.path.join(directory, f"metrics_{os.getpid()}.db"))
+            process_file_pid = os.getpid()
+
+        for key, amount in amounts:
+            process_file.add(key, amount)
+
+
+def reset_process_file():
+    """
+    Forget the metrics file of this process, e.g. after changing the directory.
+    """
+    global process_file, process_file_pid
+
+    with process_file_lock:
+        if process_file is not None:
+            process_file.close()
+        process_file = None
+        process_file_pid = None
+
+
+
+###########
+# METRICS #
+###########
+
+# All metrics by name, in the order they were defined.
+registry = {}
+
+
+class Counter:
+    """
+    A value that only goes up, e.g. the number of requests served.
+    """
+
+    type = COUNTER
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry[name] = self
+
+    def inc(self, amount=1, **labels):
+        add(sample_key(self.name, "", labels), amount)
+
+
+
+class Histogram:
+    """
+    Counts observations, e.g. request durations, into buckets.
+    Each observation goes into the first bucket it fits in; the
+    buckets are made cumulative when the metrics are served.
+    """
+
+    type = HISTOGRAM
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        registry[name] = self
+
+    def observe(self, value, **labels):
+        bucket = self.buckets[bisect.bisect_left(self.buckets, value)]
+        add_many([
+            (sample_key(self.name, "_bucket", dict(labels, le=format_value(bucket))), 1),
+            (sample_key(self.name, "_sum", labels), value),
+            (sample_key(self.name, "_count", labels), 1),
+        ])
+
+
+
+def sample_key(name, suffix, labels):
+    return encode_key(name, suffix, tuple(sorted(labels.items())))
+
+
+@functools.lru_cache(maxsize=4096)
+def encode_key(name, suffix, labels):
+    return json.dumps([name, suffix, labels], separators=(",", ":"))
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+request_count = Counter(
+    "snakeoil_http_requests_total",
+    "HTTP requests served, by view, method and status code.",
+    ["view", "method", "status"]
+)
+request_duration = Histogram(
+    "snakeoil_http_request_duration_seconds",
+    "Time taken to serve HTTP requests, by view.",
+    ["view"]
+)
+request_queries = Histogram(
+    "snakeoil_db_queries_per_request",
+    "Database queries made per HTTP request, by view.",
+    ["view"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200)
+)
+request_db_duration = Histogram(
+    "snakeoil_db_duration_seconds",
+    "Time spent in database queries per HTTP request, by view.",
+    ["view"]
+)
+cart_mutations = Counter(
+    "snakeoil_cart_mutations_total",
+    "Changes made to shopping carts, by operation.",
+    ["operation"]
+)
+order_transitions = Counter(
+    "snakeoil_order_transitions_total",
+    "Orders placed, confirmed, expired or cancelled, and checkouts refused for lack of stock.",
+    ["status"]
+)
+db_connections = Counter(
+    "snakeoil_db_connections_total",
+    "Database connections opened, reused by a request, closed, waited for, or not got in time, by database.",
+    ["alias", "event"]
+)
+db_connection_wait = Histogram(
+    "snakeoil_db_connection_wait_seconds",
+    "Time spent waiting for a free database connection slot, by database.",
+    ["alias"]
+)
+fragment_cache_lookups = Counter(
+    "snakeoil_fragment_cache_lookups_total",
+    "Lookups of rendered product tables, by outcome.",
+    ["outcome"]
+)
+
+
+
+##############
+# EXPOSITION #
+##############
+
+def collect(directory=None):
+    """
+    Read the metrics files of every worker process and add them up.
+    Returns a dictionary mapping (name, suffix, labels) to values.
+    """
+    totals = defaultdict(float)
+
+    for path in glob.glob(os.path.join(directory or get_directory(), "metrics_*.db")):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue
+
+        for key, value, position in read_entries(data):
+            name, suffix, labels = json.loads(key)
+            totals[(name, suffix, tuple(tuple(label) for label in labels))] += value
+
+    return totals
+
+
+def render(directory=None):
+    """
+    Render the metrics of all worker processes in the Prometheus text format.
+    """
+    samples = defaultdict(list)
+    for (name, suffix, labels), value in sorted(collect(directory).items()):
+        samples[name].append((suffix, labels, value))
+
+    lines = []
+    for name, metric in registry.items():
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.type}")
+
+        if metric.type == HISTOGRAM:
+            lines.extend(render_histogram(metric, samples[name]))
+        else:
+            for suffix, labels, value in samples[name]:
+                lines.append(render_sample(name + suffix, labels, value))
+
+    return "\n".join(lines) + "\n"
+
+
+def render_histogram(metric, samples):
+    """
+    Turn the per-bucket counts into the cumulative counts Prometheus expects.
+    """
+    series = defaultdict(dict)
+    for suffix, labels, value in samples:
+        if suffix == "_bucket":
+            le = dict(labels)["le"]
+            series[tuple(label for label in labels if label[0] != "le")][le] = value
+        else:
+            series[labels][suffix] = value
+
+    lines = []
+    for labels, values in sorted(series.items()):
+        cumulative = 0.0
+        for bucket in metric.buckets:
+            le = format_value(bucket)
+            cumulative += values.get(le, 0.0)
+            lines.append(render_sample(f"{metric.name}_bucket", labels + (("le", le),), cumulative))
+        lines.append(render_sample(f"{metric.name}_sum", labels, values.get("_sum", 0.0)))
+        lines.append(render_sample(f"{metric.name}_count", labels, values.get("_count", 0.0)))
+
+    return lines
+
+
+def render_sample(name, labels, value):
+    if labels:
+        label_string = ",".join(f'{key}="{escape_label_value(label_value)}"' for key, label_value in labels)
+        name = f"{name}{{{label_string}}}"
+
+    return f"{name} {format_value(value)}"
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
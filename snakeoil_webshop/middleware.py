@@ -0,0 +1,169 @@
+import logging
+import random
+import time
+
+from django.conf import settings
+
+from snakeoil_webshop import instrumentation, metrics, routers
+
+
+logger = logging.getLogger("snakeoil_webshop.timing")
+
+# Defaults for the SNAKEOIL_SERVER_TIMING setting.
+DEFAULT_SAMPLE_RATE = 1.0
+DEFAULT_HEADER = True
+DEFAULT_LOG_THRESHOLD_MS = 500
+DEFAULT_LOG_QUERY_THRESHOLD = 50
+
+TOTAL = "total"
+
+# The view label of requests that didn't resolve to a view.
+UNRESOLVED = "unresolved"
+
+
+class ServerTimingMiddleware:
+    """
+    Measures where the time of a sampled request goes: database queries,
+    template rendering and product and cart serialization. The results
+    are sent to the browser in a Server-Timing header, which shows up in
+    the network panel of the developer tools, and logged with structured
+    fields for requests that are slow or make too many queries.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+        options = getattr(settings, "SNAKEOIL_SERVER_TIMING", {})
+        self.sample_rate = options.get("SAMPLE_RATE", DEFAULT_SAMPLE_RATE)
+        self.header = options.get("HEADER", DEFAULT_HEADER)
+        self.log_threshold_ms = options.get("LOG_THRESHOLD_MS", DEFAULT_LOG_THRESHOLD_MS)
+        self.log_query_threshold = options.get("LOG_QUERY_THRESHOLD", DEFAULT_LOG_QUERY_THRESHOLD)
+
+
+    def __call__(self, request):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        with instrumentation.instrument_request() as timings:
+            start = time.perf_counter()
+            response = self.get_response(request)
+            total_ms = (time.perf_counter() - start) * 1000
+
+        if self.header:
+            response.headers["Server-Timing"] = self.server_timing(timings, total_ms)
+        self.log(request, response, timings, total_ms)
+
+        return response
+
+
+    def process_template_response(self, request, response):
+        """
+        Template responses are rendered after the view returns,
+        so time the rendering from here to when it's done.
+        """
+        timings = instrumentation.current_timings.get()
+        if timings is None:
+            return response
+
+        start = time.perf_counter()
+        response.add_post_render_callback(
+            lambda rendered: timings.add(instrumentation.TEMPLATE, time.perf_counter() - start)
+        )
+        return response
+
+
+    @staticmethod
+    def server_timing(timings, total_ms):
+        metrics = [
+            f'{name};dur={duration_ms:.1f};desc="{count} calls"'
+            for name, duration_ms, count in timings.items()
+        ]
+        metrics.append(f"{TOTAL};dur={total_ms:.1f}")
+
+        return ", ".join(metrics)
+
+
+    def log(self, request, response, timings, total_ms):
+        num_queries = timings.count(instrumentation.DB)
+        slow = self.log_threshold_ms is not None and total_ms >= self.log_threshold_ms
+        chatty = self.log_query_threshold is not None and num_queries >= self.log_query_threshold
+        if not (slow or chatty):
+            return
+
+        fields = {
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "duration_ms": round(total_ms, 1),
+            "db_queries": num_queries,
+        }
+        for name, duration_ms, count in timings.items():
+            fields[f"{name}_ms"] = round(duration_ms, 1)
+
+        logger.warning(
+            " ".join(f"{key}={value}" for key, value in fields.items()),
+            extra={"timing": fields}
+        )
+
+
+
+class MetricsMiddleware:
+    """
+    Counts every request and records its latency, number of queries and
+    time spent in the database in the metrics of the worker process.
+    Should come first in MIDDLEWARE so that it sees the whole request.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+
+    def __call__(self, request):
+        with instrumentation.instrument_request() as timings:
+            start = time.perf_counter()
+            response = self.get_response(request)
+            duration = time.perf_counter() - start
+
+        match = request.resolver_match
+        view = match.view_name if match is not None else UNRESOLVED
+        metrics.request_count.inc(view=view, method=request.method, status=str(response.status_code))
+        metrics.request_duration.observe(duration, view=view)
+        metrics.request_queries.observe(timings.count(instrumentation.DB), view=view)
+        metrics.request_db_duration.observe(timings.duration_ms(instrumentation.DB) / 1000, view=view)
+
+        return response
+
+
+
+class ReplicaPinningMiddleware:
+    """
+    Gives read-your-writes consistency on top of PrimaryReplicaRouter.
+    A client whose request wrote to the database gets a short-lived cookie,
+    and while it has the cookie all its reads go to the primary, so that
+    e.g. the page loaded after adding to the cart never shows a replica
+    that hasn't caught up yet.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+        options = routers.get_options()
+        self.pin_seconds = options.get("PIN_SECONDS", routers.DEFAULT_PIN_SECONDS)
+        self.cookie_name = options.get("PIN_COOKIE", routers.DEFAULT_PIN_COOKIE)
+
+
+    def __call__(self, request):
+        with routers.route_request(pinned=self.cookie_name in request.COOKIES) as routing:
+            response = self.get_response(request)
+
+        if routing.wrote:
+            response.set_cookie(
+                self.cookie_name,
+                "1",
+                max_age=self.pin_seconds,
+                httponly=True,
+                samesite="Lax"
+            )
+
+        return response
+
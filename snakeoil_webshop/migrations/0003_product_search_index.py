@@ -0,0 +1,64 @@
+from django.db import migrations
+
+from snakeoil_webshop.search import FTS5_TABLE, MYSQL_FULL_INDEX, MYSQL_NAME_INDEX
+
+
+PRODUCT_TABLE = "snakeoil_webshop_product"
+
+
+def sqlite_has_fts5(schema_editor):
+    """
+    Check whether the SQLite library we're linked against was
+    compiled with the FTS5 extension.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def create_search_index(apps, schema_editor):
+    """
+    Create the full-text index used by the search backend of the database
+    in use. Other databases fall back to substring search.
+    """
+    vendor = schema_editor.connection.vendor
+
+    if vendor == "mysql":
+        schema_editor.execute(
+            f"ALTER TABLE {PRODUCT_TABLE} "
+            f"ADD FULLTEXT INDEX {MYSQL_NAME_INDEX} (sku, name), "
+            f"ADD FULLTEXT INDEX {MYSQL_FULL_INDEX} (sku, name, description)"
+        )
+
+    elif vendor == "sqlite" and sqlite_has_fts5(schema_editor):
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS5_TABLE} USING fts5(sku, name, description)"
+        )
+        schema_editor.execute(
+            f"INSERT INTO {FTS5_TABLE} (rowid, sku, name, description) "
+            f"SELECT id, sku, name, description FROM {PRODUCT_TABLE}"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+
+    if vendor == "mysql":
+        schema_editor.execute(
+            f"ALTER TABLE {PRODUCT_TABLE} "
+            f"DROP INDEX {MYSQL_NAME_INDEX}, DROP INDEX {MYSQL_FULL_INDEX}"
+        )
+
+    elif vendor == "sqlite":
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS5_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snakeoil_webshop', '0002_product_name'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:37
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce
+
+
+def calculate_existing_totals(apps, schema_editor):
+    """
+    Fill in the totals of the carts that existed before the totals were stored.
+    """
+    ShoppingCart = apps.get_model('snakeoil_webshop', 'ShoppingCart')
+
+    carts = ShoppingCart.objects.annotate(
+        actual_num_items=Coalesce(Sum('shopping_cart_items__num_items'), 0),
+        actual_total_price=Coalesce(
+            Sum(F('shopping_cart_items__product__price') * F('shopping_cart_items__num_items')),
+            Decimal('0.00')
+        )
+    )
+    for cart in carts.iterator():
+        cart.num_items = cart.actual_num_items
+        cart.total_price = Decimal(cart.actual_total_price).quantize(Decimal('0.01'))
+        cart.save(update_fields=['num_items', 'total_price'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snakeoil_webshop', '0003_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shoppingcart',
+            name='num_items',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='shoppingcart',
+            name='total_price',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12),
+        ),
+        migrations.RunPython(calculate_existing_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snakeoil_webshop', '0004_shoppingcart_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shoppingcart',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:29
+
+import unicodedata
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+NAME_SORT_KEY_LENGTH = 191
+
+
+def make_name_sort_key(name):
+    """
+    A copy of snakeoil_webshop.models.make_name_sort_key as it was
+    when this migration was written, so that later changes to it
+    don't change what the migration does.
+    """
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+
+    return " ".join(stripped.casefold().split())[:NAME_SORT_KEY_LENGTH]
+
+
+def fill_name_sort_keys(apps, schema_editor):
+    """
+    Compute the sort keys of the existing products in batches,
+    so that large catalogs aren't loaded into memory at once.
+    """
+    Product = apps.get_model('snakeoil_webshop', 'Product')
+    db_alias = schema_editor.connection.alias
+    last_pk = 0
+
+    while True:
+        batch = list(
+            Product.objects.using(db_alias)
+            .filter(pk__gt=last_pk)
+            .order_by('pk')
+            .only('pk', 'name')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+
+        for product in batch:
+            product.name_sort_key = make_name_sort_key(product.name)
+        Product.objects.using(db_alias).bulk_update(batch, ['name_sort_key'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snakeoil_webshop', '0007_stock_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='name_sort_key',
+            field=models.CharField(default='', editable=False, max_length=191),
+        ),
+        # Fill in the keys before indexing them, so the index is built once.
+        migrations.RunPython(fill_name_sort_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['name_sort_key', 'id'], name='product_name_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['price', 'id'], name='product_price_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['updated', 'id'], name='product_updated_sort_idx'),
+        ),
+    ]
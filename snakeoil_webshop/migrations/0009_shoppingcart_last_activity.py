@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:32
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snakeoil_webshop', '0008_product_sort_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shoppingcart',
+            name='last_activity',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='shoppingcart',
+            index=models.Index(fields=['last_activity', 'id'], name='cart_last_activity_idx'),
+        ),
+    ]
@@ -1,7 +1,24 @@
-import json
+import unicodedata
 
+from decimal import Decimal
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+
+# The longest string MySQL can index in full using utf8mb4.
+NAME_SORT_KEY_LENGTH = 191
+
+
+def make_name_sort_key(name):
+    """
+    Return the key products are sorted by when sorting by name:
+    the name without accents, case or repeated whitespace.
+    """
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+
+    return " ".join(stripped.casefold().split())[:NAME_SORT_KEY_LENGTH]
 
 
 class Product(models.Model):
@@ -9,12 +26,26 @@ class Product(models.Model):
     An abstract product definition. To keep things simple, we also include
     price and stock count information right in this model.
     """
+    class Meta:
+        # One index for every ordering of the catalog, with the primary key
+        # as the tie-breaker the keyset paginator appends. Pages are read
+        # straight off an index instead of sorting the whole table.
+        indexes = [
+            models.Index(fields=['name_sort_key', 'id'], name='product_name_sort_idx'),
+            models.Index(fields=['price', 'id'], name='product_price_sort_idx'),
+            models.Index(fields=['updated', 'id'], name='product_updated_sort_idx'),
+        ]
 
     # Text fields for identifying the product.
     sku = models.SlugField(unique=True)
     name = models.TextField()
     description = models.TextField()
 
+    # The name cannot be indexed as a TextField, so products are sorted
+    # by this copy of it. Kept up to date by save(). Code that writes
+    # products in bulk must call refresh_name_sort_key() itself.
+    name_sort_key = models.CharField(max_length=NAME_SORT_KEY_LENGTH, default="", editable=False)
+
     # Timestamps for monitoring the life cycle of the product.
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
@@ -25,9 +56,43 @@ class Product(models.Model):
     price = models.DecimalField(default=0.00, decimal_places=2, max_digits=8)
     num_in_stock = models.IntegerField(default=0)
 
+    # Products in high demand can have their stock split over this many
+    # StockShard rows so that concurrent checkouts don't all queue up for
+    # the same row. Zero keeps the stock in num_in_stock. For sharded
+    # products, num_in_stock is a copy of the total for display that is
+    # refreshed periodically (see stock.py).
+    stock_shards = models.PositiveSmallIntegerField(default=0)
+
     def __str__(self):
         return f"{self.sku} - {self.name}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        product = super().from_db(db, field_names, values)
+        # Remember the stored price, see price_changed().
+        product.stored_price = product.__dict__.get("price")
+        return product
+
+    def save(self, *args, **kwargs):
+        self.refresh_name_sort_key()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "name" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "name_sort_key"}
+        super().save(*args, **kwargs)
+        if update_fields is None or "price" in update_fields:
+            self.stored_price = self.price
+
+    def refresh_name_sort_key(self):
+        self.name_sort_key = make_name_sort_key(self.name)
+
+    def price_changed(self):
+        """
+        Whether the price differs from the one last loaded or saved. Products
+        that weren't loaded from the database count as changed.
+        """
+        stored_price = getattr(self, "stored_price", None)
+        return stored_price is None or Decimal(stored_price) != Decimal(self.price)
+
     def as_json(self):
         raise NotImplementedError("Product.as_json must be overridden by importing the serializers.")
 
@@ -36,11 +101,31 @@ class ShoppingCart(models.Model):
     """
     A collection of shopped items associated with a particular user.
     """
+    class Meta:
+        # Lets purge_stale_carts find the oldest carts without a table scan.
+        indexes = [
+            models.Index(fields=['last_activity', 'id'], name='cart_last_activity_idx'),
+        ]
+
     user = models.OneToOneField(
         User,
         on_delete=models.CASCADE
     )
 
+    # Running totals over the items in the cart. These are updated in
+    # the same transaction as the items themselves (see carts.py) so that
+    # summarizing the cart doesn't require aggregating the items.
+    num_items = models.IntegerField(default=0)
+    total_price = models.DecimalField(default=Decimal("0.00"), decimal_places=2, max_digits=12)
+
+    # Incremented on every change to the cart. Used for telling
+    # clients whether their copy of the cart is still current.
+    version = models.IntegerField(default=0)
+
+    # When the user last changed the cart. Set by carts.py on every change
+    # made by the user, but not by maintenance like reconciling the totals.
+    last_activity = models.DateTimeField(default=timezone.now)
+
     def __str__(self):
         return f"Cart {self.pk} of {self.user.username}"    
 
@@ -70,4 +155,91 @@ class ShoppingCartItem(models.Model):
     num_items = models.IntegerField(default=1)
 
     def __str__(self):
-        return f"{self.num_items} x {self.product.sku}"
\ No newline at end of file
+        return f"{self.num_items} x {self.product.sku}"
+
+class StockShard(models.Model):
+    """
+    One part of the stock of a product whose stock is sharded.
+    """
+    class Meta:
+        unique_together = ['product', 'index']
+
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name="shards"
+    )
+
+    index = models.PositiveSmallIntegerField()
+    num_in_stock = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.product.sku} shard {self.index}: {self.num_in_stock}"
+
+
+class Order(models.Model):
+    """
+    The contents of a shopping cart at checkout. Stock is set aside for
+    the order when it's placed. The hold expires unless the order is
+    confirmed in time, after which the stock is released back for sale.
+    """
+    RESERVED = "reserved"
+    CONFIRMED = "confirmed"
+    EXPIRED = "expired"
+    CANCELLED = "cancelled"
+
+    STATUS_CHOICES = [
+        (RESERVED, "Reserved"),
+        (CONFIRMED, "Confirmed"),
+        (EXPIRED, "Expired"),
+        (CANCELLED, "Cancelled"),
+    ]
+
+    class Meta:
+        # Finding the expired reservations must not scan every order ever placed.
+        indexes = [
+            models.Index(fields=['status', 'expires']),
+        ]
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="orders"
+    )
+
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=RESERVED)
+    created = models.DateTimeField(auto_now_add=True)
+    expires = models.DateTimeField()
+
+    num_items = models.IntegerField(default=0)
+    total_price = models.DecimalField(default=Decimal("0.00"), decimal_places=2, max_digits=12)
+
+    def __str__(self):
+        return f"Order {self.pk} of {self.user.username} ({self.status})"
+
+
+class OrderLine(models.Model):
+    """
+    A product in an order. The product details are copied over so
+    that the order stays intact when the product is edited or deleted.
+    """
+    order = models.ForeignKey(
+        Order,
+        on_delete=models.CASCADE,
+        related_name="lines"
+    )
+
+    product = models.ForeignKey(
+        Product,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name="order_lines"
+    )
+
+    sku = models.SlugField()
+    name = models.TextField()
+    price = models.DecimalField(decimal_places=2, max_digits=8)
+    num_items = models.IntegerField()
+
+    def __str__(self):
+        return f"{self.num_items} x {self.sku}"
@@ -0,0 +1,298 @@
+import base64
+import binascii
+import datetime
+import json
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+
+
+# How many products to show per page unless the settings say otherwise.
+DEFAULT_PAGE_SIZE = 50
+
+# Counting the rows of a filtered query can't be done without scanning them,
+# so we stop counting once this many matches have been found.
+DEFAULT_COUNT_CAP = 1000
+
+# Cursor directions.
+NEXT = "n"
+PREVIOUS = "p"
+
+
+def get_page_size():
+    return getattr(settings, "SNAKEOIL_PAGE_SIZE", DEFAULT_PAGE_SIZE)
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """
+    Encodes sort key values like DjangoJSONEncoder, but keeps the
+    microseconds of times. Rows created in bulk often share the same
+    millisecond, and a cursor rounded to it would skip some of them.
+    """
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+
+        return super().default(o)
+
+
+
+class KeysetPage:
+    """
+    One page of results returned by a KeysetPaginator. Behaves like
+    a list of model instances and knows the cursors of its neighbours.
+    """
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+
+class KeysetPaginator:
+    """
+    Paginates an ordered queryset by remembering the sort key values of
+    the rows at the edges of each page instead of using OFFSET. Every page
+    is fetched with an indexed range condition and a LIMIT, so fetching
+    page 4000 costs as much as fetching page 1, and rows inserted while
+    the user is browsing don't shift the following pages.
+
+    The ordering is taken from the queryset itself. The primary key is
+    appended to it as a tie-breaker to make the ordering total.
+    """
+
+    def __init__(self, queryset, page_size=None):
+        self.queryset = queryset
+        self.page_size = page_size or get_page_size()
+
+        ordering = [str(key) for key in queryset.query.order_by]
+        if not any(key.lstrip("-") in ("pk", "id") for key in ordering):
+            # Break ties in the same direction as the last sort key.
+            descending = bool(ordering) and ordering[-1].startswith("-")
+            ordering.append("-pk" if descending else "pk")
+        self.ordering = ordering
+
+
+    def page(self, cursor=None):
+        """
+        Return the KeysetPage identified by the given cursor string.
+        An empty or unreadable cursor gives the first page.
+        """
+        decoded = self.decode_cursor(cursor)
+        if decoded is None:
+            return self.first_page()
+
+        direction, values = decoded
+        if direction == PREVIOUS:
+            return self.page_before(values)
+
+        return self.page_after(values)
+
+
+    def first_page(self):
+        rows = list(self.queryset.order_by(*self.ordering)[:self.page_size + 1])
+        has_next = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+
+        return KeysetPage(
+            rows,
+            next_cursor=self.cursor_for(rows[-1], NEXT) if has_next else None,
+            previous_cursor=None
+        )
+
+
+    def page_after(self, values):
+        rows = list(
+            self.queryset
+            .filter(self.seek_condition(values, forwards=True))
+            .order_by(*self.ordering)[:self.page_size + 1]
+        )
+        has_next = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+
+        if not rows:
+            # The cursor points past the last row, e.g. because rows were
+            # deleted after the cursor was handed out.
+            return self.first_page()
+
+        return KeysetPage(
+            rows,
+            next_cursor=self.cursor_for(rows[-1], NEXT) if has_next else None,
+            previous_cursor=self.cursor_for(rows[0], PREVIOUS)
+        )
+
+
+    def page_before(self, values):
+        # Walk backwards from the cursor and flip the rows around afterwards.
+        reversed_ordering = [self.flip(key) for key in self.ordering]
+        rows = list(
+            self.queryset
+            .filter(self.seek_condition(values, forwards=False))
+            .order_by(*reversed_ordering)[:self.page_size + 1]
+        )
+        has_previous = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        rows.reverse()
+
+        if not has_previous:
+            # We walked all the way back to the start. Serve the proper
+            # first page so that it is always full.
+            return self.first_page()
+
+        return KeysetPage(
+            rows,
+            next_cursor=self.cursor_for(rows[-1], NEXT),
+            previous_cursor=self.cursor_for(rows[0], PREVIOUS)
+        )
+
+
+    def seek_condition(self, values, forwards):
+        """
+        Build the condition matching the rows that come after (or before)
+        the row having the given sort key values. For an ordering (a, b)
+        moving forwards this is: a > va OR (a = va AND b > vb).
+
+        The redundant bound a >= va is added in front, so that the database
+        can scan the index of the ordering from the cursor onwards instead
+        of merging one index scan per alternative and sorting the result.
+        """
+        condition = Q()
+        equal_so_far = Q()
+        leading_bound = Q()
+
+        for key, value in zip(self.ordering, values):
+            name = key.lstrip("-")
+            descending = key.startswith("-")
+            lookup = "lt" if descending == forwards else "gt"
+
+            if not leading_bound:
+                leading_bound = Q(**{f"{name}__{lookup}e": value})
+            condition |= equal_so_far & Q(**{f"{name}__{lookup}": value})
+            equal_so_far &= Q(**{name: value})
+
+        return leading_bound & condition
+
+
+    def cursor_for(self, row, direction):
+        values = [getattr(row, key.lstrip("-")) for key in self.ordering]
+        payload = json.dumps([direction, values], cls=CursorEncoder)
+
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+    def decode_cursor(self, cursor):
+        """
+        Turn a cursor string back into a direction and a list of sort key
+        values. Returns None if the cursor can't be used with this paginator.
+        """
+        if not cursor:
+            return None
+
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            direction, raw_values = json.loads(base64.urlsafe_b64decode(padded))
+        except (binascii.Error, ValueError, TypeError):
+            return None
+
+        if direction not in (NEXT, PREVIOUS) or not isinstance(raw_values, list):
+            return None
+        if len(raw_values) != len(self.ordering):
+            return None
+
+        try:
+            values = [
+                self.parse_value(key.lstrip("-"), raw_value)
+                for key, raw_value in zip(self.ordering, raw_values)
+            ]
+        except (ValidationError, TypeError, ValueError):
+            # Values of the wrong type, e.g. from a tampered cursor.
+            return None
+
+        return direction, values
+
+
+    def parse_value(self, name, raw_value):
+        """
+        Convert a sort key value read from a cursor into the Python type
+        of the corresponding model field.
+        """
+        model = self.queryset.model
+        try:
+            field = model._meta.pk if name == "pk" else model._meta.get_field(name)
+        except FieldDoesNotExist:
+            # Annotations and other computed values are passed on as they are.
+            return raw_value
+
+        return field.to_python(raw_value)
+
+
+    @staticmethod
+    def flip(key):
+        return key[1:] if key.startswith("-") else f"-{key}"
+
+
+
+def count_results(queryset, cap=None):
+    """
+    Return a human-readable count of the rows in the given queryset
+    without scanning the whole table. An unfiltered queryset is counted
+    using the table statistics of the database if it keeps them. Other
+    querysets are counted up to a cap, e.g. "1000+".
+    """
+    cap = cap or DEFAULT_COUNT_CAP
+
+    if not queryset.query.where:
+        estimate = estimate_table_rows(queryset.model, queryset.db)
+        if estimate is not None and estimate > cap:
+            return f"About {estimate}"
+
+    count = queryset.order_by()[:cap + 1].count()
+    if count > cap:
+        return f"{cap}+"
+
+    return str(count)
+
+
+def estimate_table_rows(model, using="default"):
+    """
+    Read the approximate number of rows in the model's table from
+    the database statistics. Returns None if no estimate is available.
+    """
+    connection = connections[using]
+    if connection.vendor != "mysql":
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT TABLE_ROWS FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+            [model._meta.db_table]
+        )
+        row = cursor.fetchone()
+
+    if row is None or row[0] is None:
+        return None
+
+    return int(row[0])
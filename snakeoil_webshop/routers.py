@@ -0,0 +1,151 @@
+import contextlib
+import contextvars
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+# Defaults for the SNAKEOIL_REPLICAS setting.
+DEFAULT_PIN_SECONDS = 5
+DEFAULT_PIN_COOKIE = "snakeoil_primary"
+
+# Batch jobs waiting for the replicas to catch up give up after this many seconds.
+DEFAULT_REPLICA_WAIT_TIMEOUT = 60
+
+# Models whose reads may be served by a replica. Everything else, carts and
+# orders in particular, is always read from the primary.
+CATALOG_MODELS = {"snakeoil_webshop.product"}
+
+# The routing state of the request being handled in the current thread or
+# task, or None outside requests. Reads only go to replicas during requests,
+# so management commands always see their own writes.
+current_routing = contextvars.ContextVar("snakeoil_db_routing", default=None)
+
+
+def get_options():
+    return getattr(settings, "SNAKEOIL_REPLICAS", {})
+
+
+def get_replica_aliases():
+    return get_options().get("ALIASES", [])
+
+
+def replica_lag(alias):
+    """
+    Return how many seconds the given replica is behind the primary,
+    or None if the database doesn't report it, e.g. if it isn't a replica.
+    """
+    connection = connections[alias]
+    if connection.vendor != "mysql":
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute("SHOW REPLICA STATUS")
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        columns = [column[0] for column in cursor.description]
+
+    return row[columns.index("Seconds_Behind_Source")]
+
+
+def wait_for_replicas(max_lag, timeout=DEFAULT_REPLICA_WAIT_TIMEOUT, interval=1.0):
+    """
+    Wait until every replica is at most max_lag seconds behind the primary,
+    or until timeout seconds have passed. Used by batch jobs to keep their
+    writes from piling up on the replicas. Returns the number of seconds waited.
+    """
+    start = time.monotonic()
+    for alias in get_replica_aliases():
+        while time.monotonic() - start < timeout:
+            lag = replica_lag(alias)
+            if lag is None or lag <= max_lag:
+                break
+            time.sleep(interval)
+
+    return time.monotonic() - start
+
+
+class RequestRouting:
+    """
+    Tracks whether the current request must read from the primary,
+    either because the client wrote something moments ago or because
+    the request itself has written something.
+    """
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+
+@contextlib.contextmanager
+def route_request(pinned=False):
+    """
+    Route the reads made inside the block as reads of a single request.
+    """
+    routing = RequestRouting(pinned)
+    token = current_routing.set(routing)
+    try:
+        yield routing
+    finally:
+        current_routing.reset(token)
+
+
+@contextlib.contextmanager
+def read_from_primary():
+    """
+    Send the reads made inside the block to the primary. Use this while
+    filling caches keyed by the catalog version: a lagging replica could
+    still return the catalog of the previous version, and the cached copy
+    would outlive both the lag and the pin of the client that wrote it.
+    """
+    routing = current_routing.get()
+    if routing is None:
+        yield
+        return
+
+    pinned = routing.pinned
+    routing.pinned = True
+    try:
+        yield
+    finally:
+        routing.pinned = pinned
+
+
+class PrimaryReplicaRouter:
+    """
+    Sends catalog reads to a randomly chosen replica and everything else
+    to the primary. Reads go to the primary as well when the client has
+    recently written something (see ReplicaPinningMiddleware), when the
+    request has written something itself, and inside transactions.
+    """
+
+    def db_for_read(self, model, **hints):
+        routing = current_routing.get()
+        replicas = get_replica_aliases()
+        if routing is None or routing.pinned or routing.wrote or not replicas:
+            return DEFAULT_DB_ALIAS
+        if model._meta.label_lower not in CATALOG_MODELS:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        routing = current_routing.get()
+        if routing is not None:
+            routing.wrote = True
+
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same data as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replicas get their schema from the primary.
+        return db not in get_replica_aliases()
@@ -0,0 +1,205 @@
+import functools
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, FloatField, Q, Value, When
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from snakeoil_webshop.models import Product
+
+
+# The name of the annotation carrying the relevance score of each search hit.
+# Higher is better.
+RELEVANCE = "relevance"
+
+# The table backing the SQLite full-text index.
+FTS5_TABLE = "snakeoil_webshop_product_fts"
+
+# Names of the MySQL full-text indexes. A MATCH clause must name exactly
+# the columns of one of these.
+MYSQL_NAME_INDEX = "product_fts_sku_name"
+MYSQL_FULL_INDEX = "product_fts_sku_name_description"
+
+# Splits a search string into words for the full-text query syntaxes.
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+class SubstringSearchBackend:
+    """
+    Finds products whose SKU or name contains the search string.
+    This is the original search behaviour of the shop and works on any
+    database, but it has to scan the whole product table.
+    """
+
+    def search(self, queryset, search_string, include_description=False):
+        """
+        Filter the given Product queryset down to the rows matching
+        the search string and annotate each with its relevance.
+        """
+        q = Q(sku__icontains=search_string) | Q(name__icontains=search_string)
+        if include_description:
+            q |= Q(description__icontains=search_string)
+
+        # Rank exact product code hits first and names starting
+        # with the search string second.
+        relevance = Case(
+            When(sku__iexact=search_string, then=Value(2.0)),
+            When(name__istartswith=search_string, then=Value(1.0)),
+            default=Value(0.0),
+            output_field=FloatField()
+        )
+
+        return queryset.filter(q).annotate(**{RELEVANCE: relevance})
+
+    def index_products(self, products):
+        """
+        Bring the index entries of the given products up to date.
+        """
+        pass
+
+    def remove_products(self, product_ids):
+        """
+        Drop the index entries of the products with the given IDs.
+        """
+        pass
+
+    def rebuild_index(self):
+        """
+        Rebuild the whole index from the product table.
+        Returns the number of products indexed.
+        """
+        return 0
+
+
+
+class SQLiteFTS5SearchBackend(SubstringSearchBackend):
+    """
+    Searches an FTS5 virtual table holding a copy of the searchable
+    columns of every product, ranked by BM25. The copy is kept in sync
+    by the Product save and delete signals.
+    """
+
+    def search(self, queryset, search_string, include_description=False):
+        match = self.build_match_expression(search_string, include_description)
+        if match is None:
+            return super().search(queryset, search_string, include_description)
+
+        product_table = Product._meta.db_table
+        matching_ids = RawSQL(
+            f"SELECT rowid FROM {FTS5_TABLE} WHERE {FTS5_TABLE} MATCH %s",
+            [match]
+        )
+        # bm25() gives smaller values to better matches.
+        relevance = RawSQL(
+            f"SELECT -bm25({FTS5_TABLE}) FROM {FTS5_TABLE} "
+            f"WHERE {FTS5_TABLE} MATCH %s AND rowid = {product_table}.id",
+            [match],
+            output_field=FloatField()
+        )
+
+        return queryset.filter(pk__in=matching_ids).annotate(**{RELEVANCE: relevance})
+
+    @staticmethod
+    def build_match_expression(search_string, include_description):
+        """
+        Turn the user's search string into an FTS5 query matching
+        every word as a prefix, e.g. 'snake oi' -> "snake"* "oi"*.
+        Returns None if the search string has no searchable words.
+        """
+        words = WORD_PATTERN.findall(search_string)
+        if not words:
+            return None
+
+        phrases = " ".join(f'"{word}"*' for word in words)
+        if include_description:
+            return phrases
+
+        return f"{{sku name}} : ({phrases})"
+
+    def index_products(self, products):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO {FTS5_TABLE} (rowid, sku, name, description) "
+                "VALUES (%s, %s, %s, %s)",
+                [
+                    (product.pk, product.sku, product.name, product.description)
+                    for product in products
+                ]
+            )
+
+    def remove_products(self, product_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"DELETE FROM {FTS5_TABLE} WHERE rowid = %s",
+                [(product_id,) for product_id in product_ids]
+            )
+
+    def rebuild_index(self):
+        product_table = Product._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS5_TABLE}")
+            cursor.execute(
+                f"INSERT INTO {FTS5_TABLE} (rowid, sku, name, description) "
+                f"SELECT id, sku, name, description FROM {product_table}"
+            )
+            cursor.execute(f"INSERT INTO {FTS5_TABLE} ({FTS5_TABLE}) VALUES ('optimize')")
+
+        return Product.objects.count()
+
+
+
+class MySQLFulltextSearchBackend(SubstringSearchBackend):
+    """
+    Searches the InnoDB FULLTEXT indexes on the product table in boolean
+    mode. InnoDB keeps the indexes up to date by itself.
+    """
+
+    def search(self, queryset, search_string, include_description=False):
+        words = WORD_PATTERN.findall(search_string)
+        if not words:
+            return super().search(queryset, search_string, include_description)
+
+        # Require every word, allowing it to be the start of a longer word.
+        against = " ".join(f"+{word}*" for word in words)
+        column_names = ["sku", "name", "description"] if include_description else ["sku", "name"]
+        product_table = Product._meta.db_table
+        columns = ", ".join(f"{product_table}.{name}" for name in column_names)
+        relevance = RawSQL(
+            f"MATCH ({columns}) AGAINST (%s IN BOOLEAN MODE)",
+            [against],
+            output_field=FloatField()
+        )
+
+        return queryset.annotate(**{RELEVANCE: relevance}).filter(**{f"{RELEVANCE}__gt": 0})
+
+    def rebuild_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"OPTIMIZE TABLE {Product._meta.db_table}")
+
+        return Product.objects.count()
+
+
+
+def fts5_table_exists():
+    return FTS5_TABLE in connection.introspection.table_names()
+
+
+@functools.lru_cache(maxsize=None)
+def get_search_backend():
+    """
+    Return the search backend chosen in the SNAKEOIL_SEARCH_BACKEND setting.
+    The default, "auto", picks the full-text backend of the database in use
+    and falls back to substring search if the index is not available.
+    """
+    backend_path = getattr(settings, "SNAKEOIL_SEARCH_BACKEND", "auto")
+    if backend_path != "auto":
+        return import_string(backend_path)()
+
+    if connection.vendor == "mysql":
+        return MySQLFulltextSearchBackend()
+    if connection.vendor == "sqlite" and fts5_table_exists():
+        return SQLiteFTS5SearchBackend()
+
+    return SubstringSearchBackend()
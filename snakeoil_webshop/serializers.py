@@ -1,8 +1,8 @@
 import json
 
-from decimal import Decimal
-from django.db.models import Sum, F
 from rest_framework.serializers import ModelSerializer
+from snakeoil_webshop import instrumentation
+from snakeoil_webshop.caching import ProductJSONCache
 from snakeoil_webshop.models import Product, ShoppingCart
 
 
@@ -21,16 +21,28 @@ class ProductSerializer(ModelSerializer):
         ]
 
 
-# Extend the Product model with an 'as_json' convenience method.
-def product_as_json(self):
+def serialize_product(product):
     """
-    Return a JSON repesentation of the Product.
+    Return a JSON repesentation of the given Product.
     """
-    serializer = ProductSerializer(self)
+    serializer = ProductSerializer(product)
     json_string = json.dumps(serializer.data, ensure_ascii=False)
 
     return json_string
 
+
+# Products are serialized once per version and then served from this cache.
+product_json_cache = ProductJSONCache.from_settings(serialize_product)
+
+
+# Extend the Product model with an 'as_json' convenience method.
+def product_as_json(self):
+    """
+    Return a JSON repesentation of the Product.
+    """
+    with instrumentation.timed(instrumentation.JSON):
+        return product_json_cache.get(self)
+
 setattr(Product, 'as_json', product_as_json)
 
 
@@ -38,24 +50,11 @@ setattr(Product, 'as_json', product_as_json)
 def cart_summary_as_string(self):
     """
     Return a short string representing the contents
-    of the shopping cart.
+    of the shopping cart. Uses the running totals stored
+    on the cart, so no queries are needed.
     """
-    total_num_items = self.shopping_cart_items.aggregate(
-            total_num_items=Sum('num_items'),
-        ).get('total_num_items', 0)
-
-    total_price = self.shopping_cart_items.aggregate(
-            total_price=Sum(
-                F('product__price')*F('num_items')
-            )
-        ).get('total_price', 0.00)
-
-    if total_num_items is None:
-        total_num_items = 0
-    if total_price is None:
-        total_price = Decimal("0.00")
-
-    summary_string = f"{total_num_items} items | {total_price} €"
+    with instrumentation.timed(instrumentation.CART_SUMMARY):
+        summary_string = f"{self.num_items} items | {self.total_price} €"
     return summary_string
 
 setattr(ShoppingCart, 'summarize', cart_summary_as_string)
\ No newline at end of file
@@ -0,0 +1,77 @@
+from django.contrib.auth.models import Group, Permission, User
+from django.core.signals import request_started
+from django.db import connections
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from snakeoil_webshop import auth, backends, caching, carts, metrics
+from snakeoil_webshop.models import Product, ShoppingCartItem
+from snakeoil_webshop.search import get_search_backend
+
+
+@receiver(post_save, sender=Product)
+def index_saved_product(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Keep the search index, the caches and the totals of the
+    carts holding the product in sync with product edits.
+    """
+    get_search_backend().index_products([instance])
+    carts.forget_product(instance.pk)
+    # Runs before save() records the new price as stored.
+    price_saved = update_fields is None or "price" in update_fields
+    if not created and price_saved and instance.price_changed():
+        carts.reprice_carts([instance.pk])
+    caching.bump_catalog_version()
+
+
+@receiver(pre_delete, sender=Product)
+def find_carts_of_deleted_product(sender, instance, **kwargs):
+    """
+    Deleting the product cascades to the cart items holding it, so note
+    which carts those are while the items still exist.
+    """
+    instance.affected_cart_ids = list(
+        ShoppingCartItem.objects.filter(product=instance).values_list('shopping_cart_id', flat=True)
+    )
+
+
+@receiver(post_delete, sender=Product)
+def unindex_deleted_product(sender, instance, **kwargs):
+    """
+    Recount the carts that held the product. The deletion runs in a
+    transaction, so the totals change together with the items.
+    """
+    carts.recount_carts(getattr(instance, "affected_cart_ids", []))
+    get_search_backend().remove_products([instance.pk])
+    carts.forget_product(instance.pk)
+    caching.bump_catalog_version()
+
+
+@receiver(request_started)
+def count_reused_connections(sender, **kwargs):
+    """
+    Django closes the obsolete connections when a request starts, before
+    this runs, so the connections still open get reused by the request.
+    """
+    for connection in connections.all(initialized_only=True):
+        if connection.connection is not None:
+            metrics.db_connections.inc(alias=connection.alias, event=backends.REUSED)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_changed_user(sender, instance, **kwargs):
+    """
+    Drop the cached copy of the user kept for authenticated sessions.
+    """
+    auth.forget_user(instance.pk)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Permission)
+def forget_cached_permissions(sender, **kwargs):
+    auth.bump_permissions_version()
+
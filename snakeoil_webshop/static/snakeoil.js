@@ -70,20 +70,47 @@ snakeoil.flashTextOnButton = function(button, textToFlash, flashTimeMillisecs=15
 };
 
 
+// Clicks on "add to cart" buttons are collected for this long
+// and then sent to the server together in a single request.
+snakeoil.addToCartBatchWindowMillisecs = 400;
+snakeoil.pendingCartAdditions = {};
+snakeoil.pendingCartTimer = null;
+
+
 snakeoil.addToCart = function(button, productId) {
     /* Add a product with the given primary key to the cart. */
     snakeoil.flashTextOnButton(button, "Added!");
 
+    snakeoil.pendingCartAdditions[productId] = (snakeoil.pendingCartAdditions[productId] || 0) + 1;
+    if (snakeoil.pendingCartTimer === null) {
+        snakeoil.pendingCartTimer = setTimeout(snakeoil.flushCartAdditions, snakeoil.addToCartBatchWindowMillisecs);
+    }
+};
+
+
+snakeoil.flushCartAdditions = function(keepalive=false) {
+    /* Send all the additions collected so far to the server. */
+    clearTimeout(snakeoil.pendingCartTimer);
+    snakeoil.pendingCartTimer = null;
+
+    let items = [];
+    for (let productId in snakeoil.pendingCartAdditions) {
+        items.push({pk: Number(productId), num_items: snakeoil.pendingCartAdditions[productId]});
+    }
+    snakeoil.pendingCartAdditions = {};
+    if (items.length == 0) return;
+
     const request = new Request(
-        webShopUrls.addToCart,
+        webShopUrls.addToCartBatch,
         {
             method: 'POST',
             mode: 'same-origin',
+            keepalive: keepalive,
             headers: {
                 'X-CSRFToken': csrftoken,
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify({pk: productId})
+            body: JSON.stringify({items: items})
         }
     );
 
@@ -105,6 +132,12 @@ snakeoil.addToCart = function(button, productId) {
 };
 
 
+// Don't lose the last clicks if the user leaves the page right away.
+window.addEventListener("pagehide", function() {
+    snakeoil.flushCartAdditions(true);
+});
+
+
 snakeoil.showProductDetails = function(product) {
     /* Populate the product details modal with the correct information
     *  and open the modal. This version is for the web shop view.
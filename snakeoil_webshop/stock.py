@@ -0,0 +1,365 @@
+import datetime
+import random
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Now
+from django.utils import timezone
+
+from snakeoil_webshop import caching, carts, metrics
+from snakeoil_webshop.models import Order, OrderLine, Product, ShoppingCart, ShoppingCartItem, StockShard
+
+
+# How long placed orders hold their stock unless the settings say otherwise.
+DEFAULT_RESERVATION_TIMEOUT = 15 * 60
+
+# How many expired reservations a checkout releases on its way.
+LAZY_SWEEP_LIMIT = 10
+
+
+class CheckoutError(Exception):
+    """
+    Raised when an order can't be placed or changed.
+    """
+    pass
+
+
+
+class EmptyCartError(CheckoutError):
+    pass
+
+
+
+class InsufficientStockError(CheckoutError):
+    """
+    Raised when there isn't enough stock left for some of the products
+    in the cart. Nothing is reserved in that case.
+    """
+
+    def __init__(self, products):
+        self.products = products
+        super().__init__(f"Not enough stock left of: {', '.join(product.name for product in products)}")
+
+
+
+class InvalidQuantityError(CheckoutError):
+    """
+    Raised when the cart has lines for no items or a negative number of
+    them. Nothing is reserved in that case.
+    """
+
+    def __init__(self, products):
+        self.products = products
+        super().__init__(f"Invalid number of items of: {', '.join(product.name for product in products)}")
+
+
+
+class OrderNotReservedError(CheckoutError):
+    """
+    Raised when confirming an order whose reservation has expired
+    or that has already been confirmed or cancelled.
+    """
+    pass
+
+
+
+def get_reservation_timeout():
+    return datetime.timedelta(
+        seconds=getattr(settings, "SNAKEOIL_RESERVATION_TIMEOUT", DEFAULT_RESERVATION_TIMEOUT)
+    )
+
+
+def take_stock(product, num_items):
+    """
+    Decrement the stock of a product if it has enough items left. The check
+    and the decrement are a single conditional statement, so concurrent
+    checkouts can never sell the same items twice.
+
+    Returns True if the stock was taken.
+    """
+    if product.stock_shards:
+        return take_sharded_stock(product, num_items)
+
+    return Product.objects.filter(pk=product.pk, num_in_stock__gte=num_items).update(
+        num_in_stock=F('num_in_stock') - num_items,
+        updated=Now()
+    ) == 1
+
+
+def take_sharded_stock(product, num_items):
+    """
+    Take the items from one of the product's stock shards, trying them
+    from a random one onwards so that concurrent checkouts spread over the
+    shards. If no single shard has enough items left, lock all of them and
+    take the items from several. The product row itself isn't touched.
+    """
+    start = random.randrange(product.stock_shards)
+    for offset in range(product.stock_shards):
+        index = (start + offset) % product.stock_shards
+        taken = StockShard.objects.filter(product=product, index=index, num_in_stock__gte=num_items).update(
+            num_in_stock=F('num_in_stock') - num_items
+        )
+        if taken:
+            return True
+
+    shards = list(StockShard.objects.select_for_update().filter(product=product).order_by('index'))
+    if sum(shard.num_in_stock for shard in shards) < num_items:
+        return False
+
+    remaining = num_items
+    for shard in shards:
+        taken = min(max(shard.num_in_stock, 0), remaining)
+        if taken:
+            StockShard.objects.filter(pk=shard.pk).update(num_in_stock=F('num_in_stock') - taken)
+            remaining -= taken
+        if not remaining:
+            break
+
+    return True
+
+
+def return_stock(product_id, num_shards, num_items):
+    if num_shards:
+        StockShard.objects.filter(product_id=product_id, index=random.randrange(num_shards)).update(
+            num_in_stock=F('num_in_stock') + num_items
+        )
+        return
+
+    Product.objects.filter(pk=product_id).update(
+        num_in_stock=F('num_in_stock') + num_items,
+        updated=Now()
+    )
+
+
+def available_stock(product):
+    """
+    Return the exact number of items of the product left in stock.
+    """
+    if product.stock_shards:
+        return StockShard.objects.filter(product=product).aggregate(
+            total=Sum('num_in_stock')
+        )['total'] or 0
+
+    return Product.objects.filter(pk=product.pk).values_list('num_in_stock', flat=True).get()
+
+
+def set_stock_shards(product, num_shards, num_in_stock=None):
+    """
+    Split the stock of the product over the given number of shards, or
+    move it back onto the product row if the number is zero. The stock is
+    kept as it is unless a new total is given.
+    """
+    with transaction.atomic():
+        product = Product.objects.select_for_update().get(pk=product.pk)
+        if num_in_stock is None:
+            num_in_stock = available_stock(product)
+
+        StockShard.objects.filter(product=product).delete()
+        StockShard.objects.bulk_create([
+            StockShard(product=product, index=index, num_in_stock=share)
+            for index, share in enumerate(split_evenly(num_in_stock, num_shards))
+        ])
+        Product.objects.filter(pk=product.pk).update(
+            stock_shards=num_shards,
+            num_in_stock=num_in_stock,
+            updated=Now()
+        )
+
+    stock_changed([product.pk])
+
+
+def fold_stock_shards():
+    """
+    Copy the total stock of every sharded product into its num_in_stock
+    for display, and spread the stock evenly over the shards again so
+    that no checkout has to fall back to taking items from several.
+
+    Returns the number of products whose displayed stock changed.
+    """
+    changed = []
+
+    for product_id in Product.objects.filter(stock_shards__gt=0).values_list('pk', flat=True):
+        with transaction.atomic():
+            shards = list(StockShard.objects.select_for_update().filter(product_id=product_id).order_by('index'))
+            total = sum(shard.num_in_stock for shard in shards)
+
+            for shard, share in zip(shards, split_evenly(total, len(shards))):
+                if shard.num_in_stock != share:
+                    StockShard.objects.filter(pk=shard.pk).update(num_in_stock=share)
+
+            if Product.objects.filter(pk=product_id).exclude(num_in_stock=total).update(
+                num_in_stock=total,
+                updated=Now()
+            ):
+                changed.append(product_id)
+
+    if changed:
+        stock_changed(changed)
+
+    return len(changed)
+
+
+def split_evenly(total, num_parts):
+    return [total // num_parts + (1 if index < total % num_parts else 0) for index in range(num_parts)]
+
+
+def stock_changed(product_ids):
+    """
+    The product pages show the stock counts, so update the caches
+    that have the changed products in them.
+    """
+    if not product_ids:
+        return
+
+    carts.forget_products(product_ids)
+    caching.bump_catalog_version()
+
+
+def place_order(user):
+    """
+    Turn the user's shopping cart into an order, reserving stock for every
+    item in it, and empty the cart. Either everything is reserved or, if
+    any product runs short, nothing is and InsufficientStockError is raised.
+
+    Returns the new Order.
+    """
+    release_expired_reservations(limit=LAZY_SWEEP_LIMIT)
+
+    with transaction.atomic():
+        shopping_cart = ShoppingCart.objects.select_for_update().filter(user=user).first()
+        # Take the stock in the order of the product IDs so that concurrent
+        # checkouts lock the product rows in the same order and can't deadlock.
+        items = [] if shopping_cart is None else list(
+            ShoppingCartItem.objects
+            .filter(shopping_cart=shopping_cart)
+            .select_related('product')
+            .order_by('product_id')
+        )
+        if not items:
+            raise EmptyCartError("The shopping cart is empty.")
+
+        # Taking a negative number of items would add to the stock.
+        invalid = [item.product for item in items if item.num_items <= 0]
+        if invalid:
+            raise InvalidQuantityError(invalid)
+
+        short = [item.product for item in items if not take_stock(item.product, item.num_items)]
+        if short:
+            metrics.order_transitions.inc(status="out_of_stock")
+            raise InsufficientStockError(short)
+
+        order = Order.objects.create(
+            user=user,
+            expires=timezone.now() + get_reservation_timeout(),
+            num_items=sum(item.num_items for item in items),
+            total_price=sum((item.product.price * item.num_items for item in items), Decimal("0.00"))
+        )
+        OrderLine.objects.bulk_create([
+            OrderLine(
+                order=order,
+                product=item.product,
+                sku=item.product.sku,
+                name=item.product.name,
+                price=item.product.price,
+                num_items=item.num_items
+            )
+            for item in items
+        ])
+        carts.clear_cart(shopping_cart)
+
+    # The displayed stock of sharded products only changes when they're folded.
+    stock_changed([item.product_id for item in items if not item.product.stock_shards])
+    metrics.order_transitions.inc(status=Order.RESERVED)
+
+    return order
+
+
+def confirm_order(order):
+    """
+    Make the reservation of the given order permanent, provided it hasn't expired.
+    """
+    confirmed = Order.objects.filter(
+        pk=order.pk,
+        status=Order.RESERVED,
+        expires__gt=timezone.now()
+    ).update(status=Order.CONFIRMED)
+
+    if not confirmed:
+        raise OrderNotReservedError("The order is no longer reserved.")
+
+    order.status = Order.CONFIRMED
+    metrics.order_transitions.inc(status=Order.CONFIRMED)
+
+
+def release_order(order_id, status):
+    """
+    End the reservation of an order, moving it to the given status and
+    returning its stock. Only the caller that moves the order out of the
+    reserved status returns the stock, however many try at once.
+
+    Returns the IDs of the products whose displayed stock changed, or None
+    if the order wasn't reserved.
+    """
+    with transaction.atomic():
+        if not Order.objects.filter(pk=order_id, status=Order.RESERVED).update(status=status):
+            return None
+
+        lines = list(
+            OrderLine.objects
+            .filter(order_id=order_id, product__isnull=False)
+            .order_by('product_id')
+            .values_list('product_id', 'product__stock_shards', 'num_items')
+        )
+        for product_id, num_shards, num_items in lines:
+            return_stock(product_id, num_shards, num_items)
+
+    metrics.order_transitions.inc(status=status)
+
+    return [product_id for product_id, num_shards, num_items in lines if not num_shards]
+
+
+def cancel_order(order):
+    product_ids = release_order(order.pk, Order.CANCELLED)
+    if product_ids is None:
+        raise OrderNotReservedError("The order is no longer reserved.")
+
+    order.status = Order.CANCELLED
+    stock_changed(product_ids)
+
+
+def release_expired_reservations(limit=None, batch_size=100):
+    """
+    Return the stock of reserved orders that have not been confirmed in
+    time, oldest first. Runs periodically as a management command, and
+    every checkout sweeps a few on its way so that stock is released
+    even when the command isn't run.
+
+    Returns the number of orders released.
+    """
+    num_released = 0
+    product_ids = set()
+
+    while limit is None or num_released < limit:
+        size = batch_size if limit is None else min(batch_size, limit - num_released)
+        expired = list(
+            Order.objects
+            .filter(status=Order.RESERVED, expires__lte=timezone.now())
+            .order_by('expires')
+            .values_list('pk', flat=True)[:size]
+        )
+        if not expired:
+            break
+
+        for order_id in expired:
+            released = release_order(order_id, Order.EXPIRED)
+            if released is not None:
+                product_ids.update(released)
+                num_released += 1
+
+    if product_ids:
+        stock_changed(product_ids)
+
+    return num_released
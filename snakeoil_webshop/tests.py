@@ -1,12 +1,44 @@
+import base64
+import contextlib
+import datetime
 import decimal
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 
-from snakeoil_webshop.models import Product
-from snakeoil_webshop import helpers
-from django.test import TestCase, Client
-from django.contrib.auth.models import User
+from snakeoil_webshop.models import Order, Product, ShoppingCart, ShoppingCartItem
+from snakeoil_webshop import assets, backends, benchmarks, caching, carts, catalog_io, helpers, inventory, metrics, routers, serializers, stock
+from snakeoil_webshop.backends.sqlite3 import base as sqlite3_backend
+from snakeoil_webshop.caching import ProductJSONCache
+from snakeoil_webshop.forms import ProductCreationForm, ProductSearchForm
+from snakeoil_webshop.pagination import KeysetPaginator
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import Group, User
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
 
-from snakeoil_webshop.management.commands import add_demo_users, add_demo_products
+from snakeoil_webshop.management.commands import (
+    add_demo_users,
+    add_demo_products,
+    export_products,
+    generate_load_fixture,
+    import_products,
+    purge_stale_carts,
+    reconcile_cart_totals,
+    run_benchmarks,
+    update_inventory
+)
 
 
 class PermissionsTestCase(TestCase):
@@ -325,4 +357,1909 @@ class ProductManagementTestCase(TestCase):
         except Product.DoesNotExist:
             pass
 
-        self.client.logout()
\ No newline at end of file
+        self.client.logout()
+
+class PaginationTestCase(TestCase):
+    """
+    Verify that the product listings can be browsed page by page
+    and that the pages stay stable while new products are added.
+    """
+
+    NUM_PRODUCTS = 25
+    PAGE_SIZE = 10
+
+    def setUp(self):
+        add_demo_users.Command().handle(silent=True)
+
+        self.customer = User.objects.get(username=add_demo_users.Command.CUSTOMER_X_USERNAME)
+        self.client = Client()
+
+        for i in range(self.NUM_PRODUCTS):
+            Product.objects.create(
+                sku=f"PAGE{i:03}",
+                name=f"Paged snake oil {i % 7}",
+                description="A product for pagination tests.",
+                price=decimal.Decimal(f"{i % 5}.99"),
+                num_in_stock=i
+            )
+
+
+    def test_can_walk_pages_forwards_and_backwards(self):
+        """
+        Walk through every supported ordering page by page and check that
+        each product is seen exactly once, in order, both ways.
+        """
+        for sort_by, _ in ProductSearchForm.SORTING_CHOICES:
+            form = ProductSearchForm({"search_string": "snake", "sort_by": sort_by})
+            products = form.filter_results()
+            paginator = KeysetPaginator(products, page_size=self.PAGE_SIZE)
+            expected = list(products.order_by(*paginator.ordering))
+
+            pages = [paginator.page()]
+            while pages[-1].has_next:
+                pages.append(paginator.page(pages[-1].next_cursor))
+
+            seen = [product for page in pages for product in page]
+            self.assertEqual(seen, expected)
+
+            # Walk back from the last page.
+            page = pages[-1]
+            for earlier_page in reversed(pages[:-1]):
+                page = paginator.page(page.previous_cursor)
+                self.assertEqual(list(page), list(earlier_page))
+            self.assertFalse(page.has_previous)
+
+
+    def test_pages_survive_concurrent_inserts(self):
+        """
+        A product added in front of the current page must not make
+        the next page repeat products the user has already seen.
+        """
+        products = Product.objects.all().order_by(ProductSearchForm.ORDERINGS[ProductSearchForm.NAME_ASC])
+        paginator = KeysetPaginator(products, page_size=self.PAGE_SIZE)
+        first_page = paginator.page()
+
+        Product.objects.create(sku="PAGE999", name="AAA first of all", description="-")
+
+        second_page = paginator.page(first_page.next_cursor)
+        self.assertFalse(set(first_page) & set(second_page))
+
+
+    def test_sub_millisecond_timestamps_are_not_skipped(self):
+        """
+        Rows updated within the same millisecond, e.g. by a bulk import,
+        must all be seen when paging by the update time.
+        """
+        moment = timezone.now().replace(microsecond=123000)
+        for i, product in enumerate(Product.objects.order_by('pk')[:6]):
+            Product.objects.filter(pk=product.pk).update(updated=moment + datetime.timedelta(microseconds=100 * i))
+        products = Product.objects.filter(updated__gte=moment).order_by('-updated')
+        paginator = KeysetPaginator(products, page_size=2)
+
+        pages = [paginator.page()]
+        while pages[-1].has_next:
+            pages.append(paginator.page(pages[-1].next_cursor))
+
+        self.assertEqual([product for page in pages for product in page], list(products.order_by('-updated', '-pk')))
+
+
+    def test_malformed_cursors_give_the_first_page(self):
+        products = Product.objects.all().order_by('-updated')
+        paginator = KeysetPaginator(products, page_size=self.PAGE_SIZE)
+        first_page = list(paginator.page())
+
+        for payload in ['["n",[5,1]]', '["n",5]', '["p",["yesterday","x"]]', '{"n": 1, "p": 2}', 'null']:
+            cursor = base64.urlsafe_b64encode(payload.encode()).decode()
+            with self.subTest(payload=payload):
+                self.assertEqual(list(paginator.page(cursor)), first_page)
+
+
+    def test_shop_view_links_to_next_page(self):
+        """
+        The shop view shows one page at a time and links to the next one.
+        """
+        self.client.force_login(self.customer)
+        with self.settings(SNAKEOIL_PAGE_SIZE=self.PAGE_SIZE):
+            response = self.client.get(reverse("shop"))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.context["products"]), self.PAGE_SIZE)
+
+            next_page_url = response.context["next_page_url"]
+            self.assertIsNotNone(next_page_url)
+
+            response = self.client.get(next_page_url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.context["products"]), self.PAGE_SIZE)
+            self.assertIsNotNone(response.context["previous_page_url"])
+
+        self.client.logout()
+
+
+class ProductSearchTestCase(TestCase):
+    """
+    Verify that the product search finds the right products
+    and stays in sync with product edits.
+    """
+
+    def setUp(self):
+        add_demo_products.Command().handle(silent=True)
+
+
+    def search(self, search_string, **extra):
+        data = {"search_string": search_string, "sort_by": ProductSearchForm.BEST_MATCH}
+        data.update(extra)
+        return list(ProductSearchForm(data).filter_results())
+
+
+    def test_finds_products_by_name_and_sku(self):
+        """
+        Searching by a word of the name or by the product code finds the product.
+        """
+        turbid = Product.objects.get(sku=add_demo_products.Command.SKU002)
+
+        self.assertEqual(self.search("turbid"), [turbid])
+        self.assertEqual(self.search(add_demo_products.Command.SKU002), [turbid])
+        self.assertEqual(len(self.search("snake oil")), 4)
+
+
+    def test_searches_descriptions_only_when_asked(self):
+        """
+        Words that only appear in a description are found only
+        when the user asks to search the descriptions too.
+        """
+        thick = Product.objects.get(sku=add_demo_products.Command.SKU003)
+
+        self.assertEqual(self.search("flammable"), [])
+        self.assertEqual(self.search("flammable", search_description=True), [thick])
+
+
+    def test_index_follows_product_edits(self):
+        """
+        Renamed and deleted products are found by their new names only.
+        """
+        product = Product.objects.get(sku=add_demo_products.Command.SKU001)
+        product.name = "Sparkling serpent tonic"
+        product.save()
+
+        self.assertEqual(self.search("sparkling"), [product])
+        self.assertNotIn(product, self.search("clear"))
+
+        product.delete()
+        self.assertEqual(self.search("sparkling"), [])
+
+
+class CartTotalsTestCase(TestCase):
+    """
+    Verify that the running totals stored on the shopping cart
+    follow the items in the cart.
+    """
+
+    def setUp(self):
+        add_demo_users.Command().handle(silent=True)
+        add_demo_products.Command().handle(silent=True)
+
+        self.customer = User.objects.get(username=add_demo_users.Command.CUSTOMER_X_USERNAME)
+        self.client = Client()
+
+
+    def add_to_cart(self, sku, num_items):
+        product = Product.objects.get(sku=sku)
+        response = self.client.post(
+            reverse("add-to-cart"),
+            {'pk': product.pk, 'num_items': num_items}
+        )
+        self.assertEqual(response.status_code, 200)
+
+        return product
+
+
+    def test_totals_follow_cart_changes(self):
+        """
+        Adding items updates the totals, and clearing the cart resets them.
+        """
+        self.client.force_login(self.customer)
+        first = self.add_to_cart(add_demo_products.Command.SKU001, 2)
+        second = self.add_to_cart(add_demo_products.Command.SKU002, 3)
+
+        cart = helpers.find_active_cart_for_user(self.customer)
+        self.assertEqual(cart.num_items, 5)
+        self.assertEqual(cart.total_price, 2*first.price + 3*second.price)
+
+        # Summarizing the cart must not cost any queries.
+        with self.assertNumQueries(0):
+            summary = cart.summarize()
+        self.assertEqual(summary, f"5 items | {cart.total_price} €")
+
+        self.client.get(reverse("clear-cart"))
+        cart = helpers.find_active_cart_for_user(self.customer)
+        self.assertEqual(cart.num_items, 0)
+        self.assertEqual(cart.total_price, decimal.Decimal("0.00"))
+
+        self.client.logout()
+
+
+    def test_non_positive_counts_are_refused(self):
+        self.client.force_login(self.customer)
+        self.add_to_cart(add_demo_products.Command.SKU001, 2)
+        product = Product.objects.get(sku=add_demo_products.Command.SKU002)
+
+        for num_items in [-10, 0]:
+            with self.subTest(num_items=num_items):
+                response = self.client.post(reverse("add-to-cart"), {'pk': product.pk, 'num_items': num_items})
+                self.assertEqual(response.status_code, 400)
+
+                snapshot = carts.lookup_product(product.pk)
+                with self.assertRaises(ValueError):
+                    carts.add_to_cart(self.customer, snapshot, num_items)
+
+        # Neither the totals nor the lines changed.
+        cart = helpers.find_active_cart_for_user(self.customer)
+        self.assertEqual(cart.num_items, 2)
+        self.assertFalse(cart.shopping_cart_items.filter(product=product).exists())
+
+        self.client.logout()
+
+
+    def test_totals_follow_price_changes(self):
+        """
+        Changing the price of a product in any way reprices the carts holding it,
+        so the cart page agrees with its own lines and with the checkout.
+        """
+        self.client.force_login(self.customer)
+        first = self.add_to_cart(add_demo_products.Command.SKU001, 2)
+        second = self.add_to_cart(add_demo_products.Command.SKU002, 1)
+
+        def total():
+            return helpers.find_active_cart_for_user(self.customer).total_price
+
+        first.price = decimal.Decimal("1.00")
+        first.save()
+        self.assertEqual(total(), 2 * first.price + second.price)
+
+        inventory.apply_changes(inventory.validate_changes([(1, {"sku": second.sku, "price": "2.00"})])[0])
+        self.assertEqual(total(), decimal.Decimal("4.00"))
+
+        inventory.adjust_prices(Product.objects.filter(pk=first.pk), percent=50)
+        self.assertEqual(total(), decimal.Decimal("5.00"))
+
+        response = self.client.get(reverse("shopping-cart"))
+        self.assertEqual(response.context["total_price"], decimal.Decimal("5.00"))
+        self.assertEqual(stock.place_order(self.customer).total_price, decimal.Decimal("5.00"))
+
+        self.client.logout()
+
+
+    def test_only_price_changes_reprice_carts(self):
+        """
+        Saving a product rewrites the carts holding it only if its price changed.
+        """
+        self.client.force_login(self.customer)
+        product = self.add_to_cart(add_demo_products.Command.SKU001, 2)
+        product = Product.objects.get(pk=product.pk)
+
+        def cart_version():
+            return helpers.find_active_cart_for_user(self.customer).version
+
+        version = cart_version()
+        product.num_in_stock += 10
+        product.save()
+        product.save(update_fields=["num_in_stock"])
+        self.assertEqual(cart_version(), version)
+
+        product.price += 1
+        product.save()
+        self.assertEqual(cart_version(), version + 1)
+        self.assertEqual(helpers.find_active_cart_for_user(self.customer).total_price, 2 * product.price)
+
+        # The new price is now the stored one.
+        product.save()
+        self.assertEqual(cart_version(), version + 1)
+
+        self.client.logout()
+
+
+    def test_totals_follow_product_deletion(self):
+        """
+        Deleting a product drops it from the carts holding it,
+        and the totals follow in the same transaction.
+        """
+        self.client.force_login(self.customer)
+        first = self.add_to_cart(add_demo_products.Command.SKU001, 2)
+        second = self.add_to_cart(add_demo_products.Command.SKU002, 1)
+        first.delete()
+
+        cart = helpers.find_active_cart_for_user(self.customer)
+        self.assertEqual(cart.num_items, 1)
+        self.assertEqual(cart.total_price, second.price)
+        self.assertEqual(list(carts.reconcile_totals()), [(1, 0)])
+
+        self.client.logout()
+
+
+    def test_reconciliation_fixes_drift(self):
+        """
+        Items written behind the back of the totals make them drift.
+        Reconciliation should notice and fix that.
+        """
+        self.client.force_login(self.customer)
+        first = self.add_to_cart(add_demo_products.Command.SKU001, 2)
+        second = self.add_to_cart(add_demo_products.Command.SKU002, 1)
+        ShoppingCartItem.objects.filter(product=first).delete()
+
+        reconcile_cart_totals.Command().handle(silent=True)
+
+        cart = helpers.find_active_cart_for_user(self.customer)
+        self.assertEqual(cart.num_items, 1)
+        self.assertEqual(cart.total_price, second.price)
+
+        self.client.logout()
+
+
+class ProductJSONCacheTestCase(TestCase):
+    """
+    Verify that product JSON is serialized once per product version.
+    """
+
+    def setUp(self):
+        add_demo_products.Command().handle(silent=True)
+        self.products = list(Product.objects.all())
+        self.serialized = []
+
+
+    def serialize(self, product):
+        self.serialized.append(product.pk)
+        return serializers.serialize_product(product)
+
+
+    def test_serializes_each_version_once(self):
+        cache = ProductJSONCache(self.serialize, max_entries=100, shared_cache="default")
+
+        first = cache.get_many(self.products)
+        second = cache.get_many(self.products)
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.serialized), len(self.products))
+
+        # A fresh worker finds the entries in the shared tier.
+        other_worker_cache = ProductJSONCache(self.serialize, max_entries=100, shared_cache="default")
+        self.assertEqual(other_worker_cache.get_many(self.products), first)
+        self.assertEqual(len(self.serialized), len(self.products))
+
+        # Editing a product gives it a new version.
+        product = self.products[0]
+        product.name = "Renamed snake oil"
+        product.save()
+        self.assertIn("Renamed snake oil", cache.get(product))
+        self.assertEqual(len(self.serialized), len(self.products) + 1)
+
+
+    def test_local_tier_is_bounded(self):
+        cache = ProductJSONCache(self.serialize, max_entries=2)
+        cache.get_many(self.products)
+        self.assertEqual(len(cache.local), 2)
+
+
+class AtomicAddToCartTestCase(TransactionTestCase):
+    """
+    Verify that adding items to the cart takes a minimal number of
+    statements and loses no updates when requests race each other.
+    """
+
+    NUM_THREADS = 8
+    NUM_ADDITIONS_PER_THREAD = 10
+
+    def setUp(self):
+        cache.clear()
+        add_demo_products.Command().handle(silent=True)
+
+        self.customer = User.objects.create(username="racing.customer")
+        self.product = carts.lookup_product(
+            Product.objects.get(sku=add_demo_products.Command.SKU001).pk
+        )
+
+
+    def test_add_to_cart_request_statement_count(self):
+        """
+        With the session, the user and the product snapshot cached, an add
+        to cart request costs two statements: the cart upsert reading back
+        the new totals, and the item upsert. Databases without INSERT ...
+        RETURNING, i.e. MySQL, need a third to read the totals.
+        """
+        client = Client()
+        client.force_login(self.customer)
+        url = reverse("add-to-cart")
+        # The first request fills the caches.
+        client.post(url, {"pk": self.product.pk, "num_items": 1})
+        expected_num_statements = 2 if connection.features.can_return_columns_from_insert else 3
+
+        with CaptureQueriesContext(connection) as context:
+            response = client.post(url, {"pk": self.product.pk, "num_items": 2})
+        self.assertEqual(response.status_code, 200)
+
+        # Leave out the transaction control statements.
+        statements = [
+            query["sql"] for query in context.captured_queries
+            if query["sql"].split(" ", 1)[0].upper() not in ("BEGIN", "COMMIT", "SAVEPOINT", "RELEASE")
+        ]
+        self.assertEqual(len(statements), expected_num_statements, statements)
+
+        cart = helpers.find_active_cart_for_user(self.customer)
+        self.assertEqual(cart.num_items, 3)
+        self.assertEqual(cart.total_price, 3*self.product.price)
+
+
+    def test_concurrent_additions_lose_no_updates(self):
+        """
+        Hammer the same cart item from several threads at once
+        and check that every single addition was counted.
+        """
+        errors = []
+
+        def add_items():
+            try:
+                for _ in range(self.NUM_ADDITIONS_PER_THREAD):
+                    self.add_with_retry()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=add_items) for _ in range(self.NUM_THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+        expected_num_items = self.NUM_THREADS * self.NUM_ADDITIONS_PER_THREAD
+        cart = helpers.find_active_cart_for_user(self.customer)
+        self.assertEqual(cart.num_items, expected_num_items)
+        self.assertEqual(cart.total_price, expected_num_items * self.product.price)
+        self.assertEqual(cart.shopping_cart_items.get().num_items, expected_num_items)
+
+
+
+    def add_with_retry(self, max_attempts=100):
+        """
+        Add one item to the cart, retrying if the database refuses to wait
+        for a lock. In-memory SQLite test databases do that instead of
+        queueing the writers. A failed attempt is rolled back completely.
+        """
+        for attempt in range(max_attempts):
+            try:
+                return carts.add_to_cart(self.customer, self.product, 1)
+            except OperationalError as e:
+                if "locked" not in str(e) or attempt == max_attempts - 1:
+                    raise
+                time.sleep(0.001 * (attempt + 1))
+
+
+class AddToCartBatchTestCase(TestCase):
+    """
+    Verify that a batch of additions is validated and applied together.
+    """
+
+    def setUp(self):
+        add_demo_users.Command().handle(silent=True)
+        add_demo_products.Command().handle(silent=True)
+
+        self.customer = User.objects.get(username=add_demo_users.Command.CUSTOMER_X_USERNAME)
+        self.first = Product.objects.get(sku=add_demo_products.Command.SKU001)
+        self.second = Product.objects.get(sku=add_demo_products.Command.SKU002)
+        self.client = Client()
+
+
+    def post_batch(self, items):
+        return self.client.post(
+            reverse("add-to-cart-batch"),
+            {"items": items},
+            content_type="application/json"
+        )
+
+
+    def test_can_add_batch_of_products(self):
+        """
+        Several products, one of them twice, go into the cart in one request.
+        """
+        self.client.force_login(self.customer)
+        response = self.post_batch([
+            {"pk": self.first.pk, "num_items": 2},
+            {"pk": self.second.pk},
+            {"pk": self.first.pk, "num_items": 1},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["num_items_added"], 4)
+
+        cart = helpers.find_active_cart_for_user(self.customer)
+        self.assertEqual(cart.shopping_cart_items.get(product=self.first).num_items, 3)
+        self.assertEqual(cart.shopping_cart_items.get(product=self.second).num_items, 1)
+        self.assertEqual(cart.num_items, 4)
+        self.assertEqual(cart.total_price, 3*self.first.price + self.second.price)
+        self.assertEqual(response.json()["cart_summary"], cart.summarize())
+
+        self.client.logout()
+
+
+    def test_batch_with_missing_product_changes_nothing(self):
+        """
+        If any product in the batch doesn't exist, none of the batch is applied.
+        """
+        self.client.force_login(self.customer)
+        response = self.post_batch([
+            {"pk": self.first.pk},
+            {"pk": self.second.pk + 1000},
+        ])
+        self.assertEqual(response.status_code, 404)
+
+        cart = helpers.find_active_cart_for_user(self.customer)
+        self.assertFalse(helpers.get_cart_items(cart))
+
+        response = self.post_batch([{"pk": "not a number"}])
+        self.assertEqual(response.status_code, 400)
+
+        self.client.logout()
+
+
+    def test_batch_with_non_positive_count_changes_nothing(self):
+        """
+        A single entry for no items or a negative number of them
+        rejects the whole batch.
+        """
+        self.client.force_login(self.customer)
+        for num_items in [-10, 0]:
+            with self.subTest(num_items=num_items):
+                response = self.post_batch([
+                    {"pk": self.first.pk, "num_items": 2},
+                    {"pk": self.second.pk, "num_items": num_items},
+                ])
+                self.assertEqual(response.status_code, 400)
+
+                cart = helpers.find_active_cart_for_user(self.customer)
+                self.assertFalse(helpers.get_cart_items(cart))
+                self.assertEqual(cart.num_items, 0)
+
+        self.client.logout()
+
+
+class FragmentCacheTestCase(TestCase):
+    """
+    Verify that rendered product tables are reused until the catalog changes.
+    """
+
+    def setUp(self):
+        cache.clear()
+        add_demo_users.Command().handle(silent=True)
+        add_demo_products.Command().handle(silent=True)
+
+        self.customer = User.objects.get(username=add_demo_users.Command.CUSTOMER_X_USERNAME)
+        self.client = Client()
+
+
+    def test_product_table_is_cached_per_catalog_version(self):
+        self.client.force_login(self.customer)
+
+        misses = caching.fragment_cache_stats[caching.MISSES]
+        hits = caching.fragment_cache_stats[caching.HITS]
+
+        self.client.get(reverse("shop"))
+        response = self.client.get(reverse("shop"))
+        self.assertEqual(caching.fragment_cache_stats[caching.MISSES], misses + 1)
+        self.assertEqual(caching.fragment_cache_stats[caching.HITS], hits + 1)
+        self.assertContains(response, "Clear snake oil")
+
+        # Editing a product must show up on the next page load.
+        product = Product.objects.get(sku=add_demo_products.Command.SKU001)
+        product.name = "Crystal clear snake oil"
+        product.save()
+
+        response = self.client.get(reverse("shop"))
+        self.assertEqual(caching.fragment_cache_stats[caching.MISSES], misses + 2)
+        self.assertContains(response, "Crystal clear snake oil")
+
+        self.client.logout()
+
+
+class ConditionalGetTestCase(TestCase):
+    """
+    Verify that the catalog and cart pages answer repeated requests
+    with 304 Not Modified until something on the page changes.
+    """
+
+    def setUp(self):
+        cache.clear()
+        add_demo_users.Command().handle(silent=True)
+        add_demo_products.Command().handle(silent=True)
+
+        self.customer = User.objects.get(username=add_demo_users.Command.CUSTOMER_X_USERNAME)
+        self.client = Client()
+        self.client.force_login(self.customer)
+
+
+    def get_revalidated(self, url_name):
+        """
+        GET the page, then GET it again with the validators received.
+        Returns the second response.
+        """
+        # The first visit hands out the CSRF cookie, which is part of the ETag.
+        self.client.get(reverse(url_name))
+
+        response = self.client.get(reverse(url_name))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header("ETag"))
+
+        return self.client.get(
+            reverse(url_name),
+            HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+
+
+    def test_unchanged_pages_are_not_modified(self):
+        for url_name in ["shop", "shopping-cart"]:
+            response = self.get_revalidated(url_name)
+            self.assertEqual(response.status_code, 304)
+
+
+    def test_cart_change_invalidates_pages(self):
+        self.client.get(reverse("shop"))
+        shop_etag = self.client.get(reverse("shop"))["ETag"]
+        cart_etag = self.client.get(reverse("shopping-cart"))["ETag"]
+
+        product = Product.objects.get(sku=add_demo_products.Command.SKU001)
+        self.client.post(reverse("add-to-cart"), {'pk': product.pk})
+
+        response = self.client.get(reverse("shop"), HTTP_IF_NONE_MATCH=shop_etag)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse("shopping-cart"), HTTP_IF_NONE_MATCH=cart_etag)
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_catalog_change_invalidates_shop(self):
+        self.client.get(reverse("shop"))
+        etag = self.client.get(reverse("shop"))["ETag"]
+
+        Product.objects.get(sku=add_demo_products.Command.SKU001).delete()
+
+        response = self.client.get(reverse("shop"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_pages_cannot_be_revalidated_by_date(self):
+        """
+        The pages show the user's cart, which the catalog's modification
+        date knows nothing about, so they only come with an ETag.
+        """
+        self.client.get(reverse("shop"))
+        response = self.client.get(reverse("shop"))
+        self.assertFalse(response.has_header("Last-Modified"))
+
+        product = Product.objects.get(sku=add_demo_products.Command.SKU001)
+        self.client.post(reverse("add-to-cart"), {'pk': product.pk})
+
+        for url_name in ["shop", "shopping-cart"]:
+            response = self.client.get(reverse(url_name), HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60))
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, "1 items")
+
+
+    def test_permission_change_invalidates_pages(self):
+        """
+        The navigation bar links to product management for managers
+        only, so granting the permission must change the pages.
+        """
+        self.client.get(reverse("shop"))
+        etag = self.client.get(reverse("shop"))["ETag"]
+
+        self.customer.groups.add(Group.objects.get(name=add_demo_users.Command.MANAGERS_GROUP_NAME))
+
+        response = self.client.get(reverse("shop"), HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, reverse("product-management"))
+
+
+class ImportProductsTestCase(TestCase):
+    """
+    Verify that products can be imported in bulk from CSV and JSONL files.
+    """
+
+    def setUp(self):
+        add_demo_products.Command().handle(silent=True)
+        self.directory = tempfile.TemporaryDirectory()
+
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+    def write_file(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        return path
+
+
+    def import_file(self, path, **options):
+        rejects = os.path.join(self.directory.name, "rejects.jsonl")
+        import_products.Command().handle(path=path, rejects=rejects, silent=True, **options)
+        with open(rejects, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+
+    def test_can_import_csv(self):
+        """
+        Valid rows are inserted or update the product with the same SKU.
+        Invalid rows are rejected with the form's error messages.
+        """
+        path = self.write_file("products.csv", (
+            "sku,name,description,price,num_in_stock\n"
+            "IMP001,Imported oil,Fresh from the file.,5.00,10\n"
+            f"{add_demo_products.Command.SKU001},Updated clear oil,Now even clearer.,12.99,5\n"
+            "IMP002,Overpriced oil,Negative price.,-1.00,10\n"
+            "IMP003,Negative stock,Negative stock.,1.00,-10\n"
+        ))
+        rejects = self.import_file(path, batch_size=2)
+
+        imported = Product.objects.get(sku="IMP001")
+        self.assertEqual(imported.price, decimal.Decimal("5.00"))
+        self.assertEqual(imported.num_in_stock, 10)
+
+        updated = Product.objects.get(sku=add_demo_products.Command.SKU001)
+        self.assertEqual(updated.name, "Updated clear oil")
+        self.assertEqual(updated.num_in_stock, 5)
+
+        self.assertEqual([reject["row"] for reject in rejects], [3, 4])
+        self.assertIn("price", rejects[0]["errors"])
+        self.assertIn("num_in_stock", rejects[1]["errors"])
+        self.assertFalse(Product.objects.filter(sku__in=["IMP002", "IMP003"]).exists())
+
+        # The imported products can be found by searching.
+        form = ProductSearchForm({"search_string": "imported", "sort_by": ProductSearchForm.NAME_ASC})
+        self.assertEqual(list(form.filter_results()), [imported])
+
+
+    def test_can_import_jsonl_with_worker_processes(self):
+        lines = [
+            json.dumps({"sku": f"JSON{i:03}", "name": f"Oil {i}", "description": "-", "price": "1.50", "num_in_stock": i})
+            for i in range(20)
+        ]
+        lines.append("this is not JSON")
+        path = self.write_file("products.jsonl", "\n".join(lines) + "\n")
+
+        rejects = self.import_file(path, batch_size=3, workers=2)
+
+        self.assertEqual(Product.objects.filter(sku__startswith="JSON").count(), 20)
+        self.assertEqual([reject["row"] for reject in rejects], [21])
+
+
+    def test_import_spreads_stock_over_shards(self):
+        product = Product.objects.get(sku=add_demo_products.Command.SKU001)
+        stock.set_stock_shards(product, 3)
+
+        path = self.write_file("products.csv", (
+            "sku,name,description,price,num_in_stock\n"
+            f"{product.sku},{product.name},{product.description},{product.price},40\n"
+        ))
+        self.import_file(path)
+
+        product.refresh_from_db()
+        self.assertEqual(product.num_in_stock, 40)
+        self.assertEqual(stock.available_stock(product), 40)
+        self.assertEqual(sorted(product.shards.values_list('num_in_stock', flat=True)), [13, 13, 14])
+
+
+class LoadFixtureTestCase(TestCase):
+    """
+    Verify that the load test fixture generator builds a consistent data set.
+    """
+
+    def test_generates_consistent_data(self):
+        generate_load_fixture.Command().handle(
+            products=50, users=20, cart_items=60, seed=1, batch_size=7, silent=True
+        )
+
+        self.assertEqual(Product.objects.filter(sku__startswith="LOAD").count(), 50)
+        customers = User.objects.filter(username__startswith="load.customer.")
+        self.assertEqual(customers.count(), 20)
+        self.assertTrue(self.client.login(
+            username=customers.first().username,
+            password=generate_load_fixture.Command.DEFAULT_PASSWORD
+        ))
+
+        # All the requested cart items were generated, and the stored
+        # cart totals agree with them.
+        self.assertEqual(ShoppingCartItem.objects.count(), 60)
+        checked, fixed = map(sum, zip(*carts.reconcile_totals()))
+        self.assertGreater(checked, 0)
+        self.assertEqual(fixed, 0)
+
+        # The generated products can be found by searching.
+        name = Product.objects.filter(sku__startswith="LOAD").first().name
+        form = ProductSearchForm({"search_string": name, "sort_by": ProductSearchForm.NAME_ASC})
+        self.assertTrue(form.filter_results().exists())
+
+
+    def test_reports_the_rows_actually_generated(self):
+        """
+        With only a few users, the carts get bigger to hold all the items,
+        and rows that already exist aren't reported as generated again.
+        """
+        out = io.StringIO()
+        command = generate_load_fixture.Command(stdout=out)
+        command.handle(products=50, users=3, cart_items=60, seed=2)
+        self.assertEqual(ShoppingCartItem.objects.count(), 60)
+        self.assertIn("Generated 60 cart items", out.getvalue())
+
+        out.truncate(0)
+        command.handle(products=50, users=3, seed=2)
+        self.assertIn("Generated 0 products", out.getvalue())
+        self.assertIn("Generated 0 users", out.getvalue())
+
+
+class BenchmarkTestCase(TestCase):
+    """
+    Verify that the benchmark scenarios run and that regressions
+    against a baseline are caught.
+    """
+
+    def test_benchmarks_run_and_catch_regressions(self):
+        results = {"50": benchmarks.run_benchmarks(50, iterations=2)}
+        self.assertEqual(
+            set(results["50"]),
+            {name for name, request, prepare in benchmarks.SCENARIOS}
+        )
+        self.assertEqual(benchmarks.find_regressions(results, results, threshold=0), [])
+
+        # One more query per page load is a regression, whatever the threshold.
+        baseline = json.loads(json.dumps(results))
+        baseline["50"]["shop"][benchmarks.QUERIES] -= 1
+        regressions = benchmarks.find_regressions(results, baseline, threshold=10)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn("shop at size 50", regressions[0])
+
+        # Latencies depend on the machine, so they are only compared if asked to.
+        baseline = json.loads(json.dumps(results))
+        baseline["50"]["shop"][benchmarks.P95] = 0
+        self.assertEqual(benchmarks.find_regressions(results, baseline, threshold=0), [])
+        self.assertEqual(len(benchmarks.find_regressions(results, baseline, threshold=0, check_latency=True)), 1)
+
+
+    def test_missing_baseline_fails(self):
+        """
+        Each kind of database has its own baseline, since the query
+        counts differ between them.
+        """
+        path = os.path.join(tempfile.mkdtemp(), "baseline.json")
+        with self.assertRaises(CommandError):
+            run_benchmarks.Command().handle(sizes="20", iterations=1, baseline=path, silent=True)
+
+        benchmarks.save_baseline(path, "some other database", {"20": {}})
+        with self.assertRaises(CommandError):
+            run_benchmarks.Command().handle(sizes="20", iterations=1, baseline=path, silent=True)
+        self.assertEqual(benchmarks.load_baseline(path, "some other database"), {"20": {}})
+
+
+class ServerTimingTestCase(TestCase):
+    """
+    Verify that sampled requests report where their time went.
+    """
+
+    def setUp(self):
+        cache.clear()
+        add_demo_users.Command().handle(silent=True)
+        add_demo_products.Command().handle(silent=True)
+
+        self.customer = User.objects.get(username=add_demo_users.Command.CUSTOMER_X_USERNAME)
+
+
+    def test_shop_reports_server_timing(self):
+        client = Client()
+        client.force_login(self.customer)
+
+        response = client.get(reverse("shop"))
+        metrics = {metric.split(";")[0].strip() for metric in response.headers["Server-Timing"].split(",")}
+        self.assertTrue({"db", "template", "json", "cart_summary", "total"} <= metrics)
+
+
+    def test_unsampled_requests_are_left_alone(self):
+        with override_settings(SNAKEOIL_SERVER_TIMING={"SAMPLE_RATE": 0}):
+            client = Client()
+            client.force_login(self.customer)
+            response = client.get(reverse("shop"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Server-Timing", response.headers)
+
+
+    def test_chatty_requests_are_logged(self):
+        client = Client()
+        client.force_login(self.customer)
+
+        with override_settings(SNAKEOIL_SERVER_TIMING={"LOG_THRESHOLD_MS": None, "LOG_QUERY_THRESHOLD": 1}):
+            with self.assertLogs("snakeoil_webshop.timing") as logs:
+                client.get(reverse("shop"))
+
+        fields = logs.records[-1].timing
+        self.assertEqual(fields["path"], reverse("shop"))
+        self.assertGreater(fields["db_queries"], 0)
+
+
+class MetricsTestCase(TestCase):
+    """
+    Verify that the metrics of all worker processes are served at /metrics.
+    """
+
+    def setUp(self):
+        cache.clear()
+        add_demo_users.Command().handle(silent=True)
+        add_demo_products.Command().handle(silent=True)
+
+        self.customer = User.objects.get(username=add_demo_users.Command.CUSTOMER_X_USERNAME)
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(SNAKEOIL_METRICS={"DIRECTORY": self.directory.name})
+        self.settings_override.enable()
+        metrics.reset_process_file()
+
+
+    def tearDown(self):
+        metrics.reset_process_file()
+        self.settings_override.disable()
+        self.directory.cleanup()
+
+
+    def test_metrics_are_recorded_and_served(self):
+        client = Client()
+        client.force_login(self.customer)
+        client.get(reverse("shop"))
+        client.get(reverse("shop"))
+        product = Product.objects.get(sku=add_demo_products.Command.SKU001)
+        client.post(reverse("add-to-cart"), {"pk": product.pk})
+
+        response = Client().get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('snakeoil_http_requests_total{method="GET",status="200",view="shop"} 2.0', body)
+        self.assertIn('snakeoil_http_request_duration_seconds_bucket{view="shop",le="+Inf"} 2.0', body)
+        self.assertIn('snakeoil_cart_mutations_total{operation="add"} 1.0', body)
+        self.assertIn('snakeoil_fragment_cache_lookups_total{outcome="hits"} 1.0', body)
+
+
+    def test_metrics_of_all_processes_are_added_up(self):
+        metrics.cart_mutations.inc(operation="clear")
+
+        # Pretend that another worker has written its own file.
+        other_worker = metrics.MetricsFile(os.path.join(self.directory.name, "metrics_999999.db"))
+        other_worker.add(metrics.sample_key(metrics.cart_mutations.name, "", {"operation": "clear"}), 2)
+        # Enough series to make the file grow past its initial size.
+        for i in range(1000):
+            other_worker.add(metrics.sample_key(metrics.request_count.name, "", {"view": f"view-{i}"}), 1)
+        other_worker.close()
+
+        body = metrics.render()
+        self.assertIn('snakeoil_cart_mutations_total{operation="clear"} 3.0', body)
+        self.assertIn('snakeoil_http_requests_total{view="view-999"} 1.0', body)
+
+
+class CheckoutTestCase(TestCase):
+    """
+    Verify that checking out reserves stock for a limited time.
+    """
+
+    def setUp(self):
+        cache.clear()
+        add_demo_users.Command().handle(silent=True)
+        add_demo_products.Command().handle(silent=True)
+
+        self.customer = User.objects.get(username=add_demo_users.Command.CUSTOMER_X_USERNAME)
+        self.product = Product.objects.get(sku=add_demo_products.Command.SKU001)
+        self.product.num_in_stock = 5
+        self.product.save()
+
+        self.client = Client()
+        self.client.force_login(self.customer)
+
+
+    def test_can_check_out_and_confirm(self):
+        self.client.post(reverse("add-to-cart"), {"pk": self.product.pk, "num_items": 3})
+
+        response = self.client.post(reverse("checkout"))
+        order = Order.objects.get(user=self.customer)
+        self.assertRedirects(response, reverse("order", kwargs={"pk": order.pk}))
+        self.assertEqual(order.status, Order.RESERVED)
+        self.assertEqual(order.num_items, 3)
+        self.assertEqual(order.total_price, 3 * self.product.price)
+
+        # The stock is set aside and the cart is emptied.
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.num_in_stock, 2)
+        self.assertEqual(helpers.find_active_cart_for_user(self.customer).num_items, 0)
+
+        response = self.client.post(reverse("confirm-order", kwargs={"pk": order.pk}), follow=True)
+        self.assertContains(response, "This order has been confirmed.")
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.CONFIRMED)
+
+
+    def test_cannot_check_out_more_than_in_stock(self):
+        other_product = Product.objects.get(sku=add_demo_products.Command.SKU002)
+        self.client.post(reverse("add-to-cart"), {"pk": other_product.pk, "num_items": 1})
+        self.client.post(reverse("add-to-cart"), {"pk": self.product.pk, "num_items": 6})
+
+        response = self.client.post(reverse("checkout"), follow=True)
+        self.assertContains(response, "Not enough stock left of: Clear snake oil")
+
+        # Nothing was reserved, not even the product that was in stock.
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(Product.objects.get(pk=other_product.pk).num_in_stock, other_product.num_in_stock)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).num_in_stock, 5)
+
+
+    def test_cannot_check_out_non_positive_counts(self):
+        """
+        Lines for no items or a negative number of them, however they got
+        into the cart, are refused instead of adding to the stock.
+        """
+        other_product = Product.objects.get(sku=add_demo_products.Command.SKU002)
+        self.client.post(reverse("add-to-cart"), {"pk": other_product.pk, "num_items": 1})
+        cart = helpers.find_active_cart_for_user(self.customer)
+
+        for num_items in [-10, 0]:
+            with self.subTest(num_items=num_items):
+                ShoppingCartItem.objects.update_or_create(
+                    shopping_cart=cart,
+                    product=self.product,
+                    defaults={"num_items": num_items}
+                )
+
+                response = self.client.post(reverse("checkout"), follow=True)
+                self.assertContains(response, "Invalid number of items of: Clear snake oil")
+                self.assertFalse(Order.objects.exists())
+                self.assertEqual(Product.objects.get(pk=self.product.pk).num_in_stock, 5)
+                self.assertEqual(Product.objects.get(pk=other_product.pk).num_in_stock, other_product.num_in_stock)
+
+
+    def test_expired_reservations_return_stock(self):
+        self.client.post(reverse("add-to-cart"), {"pk": self.product.pk, "num_items": 5})
+        self.client.post(reverse("checkout"))
+        order = Order.objects.get(user=self.customer)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).num_in_stock, 0)
+
+        order.expires = order.expires - stock.get_reservation_timeout()
+        order.save()
+
+        response = self.client.post(reverse("confirm-order", kwargs={"pk": order.pk}), follow=True)
+        self.assertContains(response, "The order is no longer reserved.")
+        self.assertContains(response, "This order was not confirmed in time")
+        self.assertEqual(Product.objects.get(pk=self.product.pk).num_in_stock, 5)
+
+        # Releasing again doesn't return the stock twice.
+        self.assertEqual(stock.release_expired_reservations(), 0)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).num_in_stock, 5)
+
+
+    def test_viewing_an_expired_order_releases_only_that_order(self):
+        other_customer = User.objects.get(username=add_demo_users.Command.CUSTOMER_Y_USERNAME)
+        snapshot = carts.lookup_products([self.product.pk])[self.product.pk]
+        orders = []
+        for user in [self.customer, other_customer]:
+            carts.add_to_cart(user, snapshot, 2)
+            orders.append(stock.place_order(user))
+        Order.objects.update(expires=timezone.now() - datetime.timedelta(minutes=1))
+
+        response = self.client.get(reverse("order", kwargs={"pk": orders[0].pk}))
+        self.assertContains(response, "This order was not confirmed in time")
+        self.assertEqual(Order.objects.get(pk=orders[0].pk).status, Order.EXPIRED)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).num_in_stock, 3)
+
+        # The order of the other customer is left for the sweep.
+        self.assertEqual(Order.objects.get(pk=orders[1].pk).status, Order.RESERVED)
+        self.assertEqual(stock.release_expired_reservations(), 1)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).num_in_stock, 5)
+
+
+    def test_sharded_stock_is_taken_and_folded(self):
+        stock.set_stock_shards(self.product, 4)
+        self.assertEqual(self.product.shards.count(), 4)
+        self.assertEqual(stock.available_stock(Product.objects.get(pk=self.product.pk)), 5)
+
+        # The shards hold at most two items each, so this has to take from several.
+        self.client.post(reverse("add-to-cart"), {"pk": self.product.pk, "num_items": 4})
+        self.client.post(reverse("checkout"))
+        order = Order.objects.get(user=self.customer)
+        product = Product.objects.get(pk=self.product.pk)
+        self.assertEqual(stock.available_stock(product), 1)
+        self.assertEqual(product.num_in_stock, 5)
+
+        self.assertEqual(stock.fold_stock_shards(), 1)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).num_in_stock, 1)
+        self.assertEqual(sorted(product.shards.values_list('num_in_stock', flat=True)), [0, 0, 0, 1])
+
+        stock.cancel_order(order)
+        self.assertEqual(stock.available_stock(product), 5)
+        stock.fold_stock_shards()
+        self.assertEqual(Product.objects.get(pk=self.product.pk).num_in_stock, 5)
+
+
+class ConcurrentCheckoutTestCase(TransactionTestCase):
+    """
+    Verify that concurrent checkouts of the same products never oversell.
+    """
+
+    def test_no_overselling(self):
+        results = benchmarks.run_checkout_benchmark(
+            num_workers=4,
+            num_products=2,
+            stock_per_product=10,
+            orders_per_worker=8
+        )
+
+        self.assertEqual(results["oversold_products"], 0)
+        self.assertGreater(results["orders_placed"], 0)
+        self.assertGreater(results["orders_refused"], 0)
+        self.assertEqual(results["checkouts"], 32)
+
+
+    def test_no_overselling_sharded_stock(self):
+        results = benchmarks.run_checkout_benchmark(
+            num_workers=4,
+            num_products=2,
+            stock_per_product=10,
+            orders_per_worker=8,
+            num_shards=4
+        )
+
+        self.assertEqual(results["oversold_products"], 0)
+        self.assertGreater(results["orders_placed"], 0)
+        self.assertEqual(results["checkouts"], 32)
+
+
+class LazyCartTestCase(TestCase):
+    """
+    Verify that viewing pages never creates a shopping cart
+    and that each request loads the cart at most once.
+    """
+
+    def setUp(self):
+        cache.clear()
+        add_demo_users.Command().handle(silent=True)
+        add_demo_products.Command().handle(silent=True)
+
+        # The manager may visit the product management page too.
+        self.customer = User.objects.get(username=add_demo_users.Command.MANAGER_USERNAME)
+        self.client = Client()
+        self.client.force_login(self.customer)
+
+
+    def test_page_views_do_not_create_a_cart(self):
+        for url_name in ["shop", "product-management", "shopping-cart", "clear-cart"]:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse(url_name), follow=True)
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(ShoppingCart.objects.filter(user=self.customer).exists())
+            self.assertFalse(any(
+                query["sql"].startswith("INSERT") for query in queries.captured_queries
+            ))
+
+        self.assertContains(self.client.get(reverse("shop")), "0 items | 0.00 €")
+
+
+    def test_cart_is_loaded_once_per_request(self):
+        product = Product.objects.get(sku=add_demo_products.Command.SKU001)
+        self.client.post(reverse("add-to-cart"), {'pk': product.pk})
+        self.client.get(reverse("shop"))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("shop"))
+        self.assertContains(response, "1 items")
+        cart_queries = [
+            query for query in queries.captured_queries
+            if f'FROM "{ShoppingCart._meta.db_table}"' in query["sql"]
+        ]
+        self.assertEqual(len(cart_queries), 1)
+
+
+class AdminTestCase(TestCase):
+    """
+    Verify that the admin changelists don't query per row
+    and that product search uses the search backend.
+    """
+
+    def setUp(self):
+        cache.clear()
+        add_demo_users.Command().handle(silent=True)
+        add_demo_products.Command().handle(silent=True)
+
+        self.client = Client()
+        self.client.force_login(User.objects.get(username=add_demo_users.Command.STAFF_USERNAME))
+
+
+    def fill_carts(self, usernames):
+        product = carts.lookup_product(Product.objects.get(sku=add_demo_products.Command.SKU001).pk)
+        for username in usernames:
+            carts.add_to_cart(User.objects.create(username=username), product, 2)
+
+
+    def test_cart_changelist_queries_do_not_grow_with_carts(self):
+        url = reverse("admin:snakeoil_webshop_shoppingcart_changelist")
+        self.fill_carts([f"admin.customer.{i}" for i in range(3)])
+        # The first request caches the user and their permissions.
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as few:
+            self.assertContains(self.client.get(url), "admin.customer.2")
+
+        self.fill_carts([f"admin.customer.{i}" for i in range(3, 10)])
+        with CaptureQueriesContext(connection) as many:
+            self.assertContains(self.client.get(url), "admin.customer.9")
+
+        self.assertEqual(len(few.captured_queries), len(many.captured_queries))
+
+
+    def test_product_search(self):
+        response = self.client.get(
+            reverse("admin:snakeoil_webshop_product_changelist"),
+            {"q": add_demo_products.Command.SKU001}
+        )
+        self.assertContains(response, add_demo_products.Command.SKU001)
+        self.assertNotContains(response, add_demo_products.Command.SKU002)
+
+        response = self.client.get(reverse("admin:autocomplete"), {
+            "app_label": "snakeoil_webshop",
+            "model_name": "shoppingcartitem",
+            "field_name": "product",
+            "term": add_demo_products.Command.SKU001,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["results"]), 1)
+
+
+    def test_sharded_stock_is_read_only(self):
+        product = Product.objects.get(sku=add_demo_products.Command.SKU001)
+        url = reverse("admin:snakeoil_webshop_product_change", kwargs={"object_id": product.pk})
+        self.assertContains(self.client.get(url), 'name="num_in_stock"')
+
+        stock.set_stock_shards(product, 2)
+        self.assertNotContains(self.client.get(url), 'name="num_in_stock"')
+
+
+
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """
+    Verify that catalog reads go to the replicas unless the client
+    has just written something. Without replicas in SNAKEOIL_REPLICAS,
+    a replica mirroring the test database of the primary is added for
+    the duration of these tests.
+    """
+
+    MIRROR_ALIAS = "test_replica"
+
+    databases = "__all__"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.added_mirror = not routers.get_replica_aliases()
+        if cls.added_mirror:
+            connections.settings[cls.MIRROR_ALIAS] = dict(
+                connections["default"].settings_dict,
+                TEST=dict(connections["default"].settings_dict["TEST"], MIRROR="default")
+            )
+            cls.replicas_override = override_settings(SNAKEOIL_REPLICAS={"ALIASES": [cls.MIRROR_ALIAS]})
+            cls.replicas_override.enable()
+        super().setUpClass()
+
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if cls.added_mirror:
+            cls.replicas_override.disable()
+            connections[cls.MIRROR_ALIAS].close()
+            del connections[cls.MIRROR_ALIAS]
+            del connections.settings[cls.MIRROR_ALIAS]
+
+
+    def setUp(self):
+        cache.clear()
+        add_demo_users.Command().handle(silent=True)
+        add_demo_products.Command().handle(silent=True)
+
+        self.manager = User.objects.get(username=add_demo_users.Command.MANAGER_USERNAME)
+        self.client = Client()
+        self.client.force_login(self.manager)
+        self.replicas = routers.get_replica_aliases()
+
+
+    def count_queries_per_database(self, method, *args, **kwargs):
+        """
+        Request the given URL and return the response and the
+        number of queries it made in each database.
+        """
+        with contextlib.ExitStack() as stack:
+            captured = {
+                alias: stack.enter_context(CaptureQueriesContext(connections[alias]))
+                for alias in connections
+            }
+            response = getattr(self.client, method)(*args, **kwargs)
+            if response.streaming:
+                b"".join(response.streaming_content)
+
+        return response, {alias: len(context.captured_queries) for alias, context in captured.items()}
+
+
+    def replica_queries(self, queries):
+        return sum(queries[alias] for alias in self.replicas)
+
+
+    def test_router_picks_database(self):
+        router = routers.PrimaryReplicaRouter()
+
+        with override_settings(SNAKEOIL_REPLICAS={"ALIASES": ["replica"]}):
+            # Outside requests, every read goes to the primary.
+            self.assertEqual(router.db_for_read(Product), "default")
+
+            with routers.route_request():
+                self.assertEqual(router.db_for_read(Product), "replica")
+                self.assertEqual(router.db_for_read(ShoppingCart), "default")
+                with routers.read_from_primary():
+                    self.assertEqual(router.db_for_read(Product), "default")
+                self.assertEqual(router.db_for_read(Product), "replica")
+                # Once the request has written something, it reads its writes.
+                self.assertEqual(router.db_for_write(ShoppingCart), "default")
+                self.assertEqual(router.db_for_read(Product), "default")
+
+            with routers.route_request(pinned=True):
+                self.assertEqual(router.db_for_read(Product), "default")
+
+            self.assertFalse(router.allow_migrate("replica", "snakeoil_webshop"))
+            self.assertTrue(router.allow_migrate("default", "snakeoil_webshop"))
+
+
+    def test_client_is_pinned_to_primary_after_writing(self):
+        export_url = reverse("catalog-export")
+        response, queries = self.count_queries_per_database("get", export_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(self.replica_queries(queries), 0)
+
+        product = Product.objects.get(sku=add_demo_products.Command.SKU001)
+        response = self.client.post(reverse("add-to-cart"), {'pk': product.pk})
+        self.assertIn(routers.DEFAULT_PIN_COOKIE, response.cookies)
+
+        response, queries = self.count_queries_per_database("get", reverse("shop"))
+        self.assertContains(response, "1 items")
+        self.assertEqual(self.replica_queries(queries), 0)
+        response, queries = self.count_queries_per_database("get", export_url)
+        self.assertEqual(self.replica_queries(queries), 0)
+
+        # Once the pin expires, the catalog is read from the replicas again.
+        del self.client.cookies[routers.DEFAULT_PIN_COOKIE]
+        response, queries = self.count_queries_per_database("get", export_url)
+        self.assertGreater(self.replica_queries(queries), 0)
+
+
+    def test_version_keyed_caches_are_filled_from_the_primary(self):
+        """
+        A replica may lag behind the catalog version, so the cached tables and
+        timestamps, which outlive the pin of the writer, come from the primary.
+        """
+        caching.bump_catalog_version()
+        response, queries = self.count_queries_per_database("get", reverse("shop"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.replica_queries(queries), 0)
+        self.assertGreater(queries["default"], 0)
+
+
+class DatabaseConnectionsTestCase(TestCase):
+    """
+    Verify that the connections of a worker are limited and counted.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(
+            SNAKEOIL_METRICS={"DIRECTORY": self.directory.name},
+            SNAKEOIL_DB_CONNECTIONS={"MAX_PER_WORKER": 1, "WAIT_TIMEOUT": 0.05}
+        )
+        self.settings_override.enable()
+        metrics.reset_process_file()
+        backends.reset_slots()
+
+
+    def tearDown(self):
+        backends.reset_slots()
+        metrics.reset_process_file()
+        self.settings_override.disable()
+        self.directory.cleanup()
+
+
+    def open_connection(self, alias):
+        wrapper = sqlite3_backend.DatabaseWrapper(
+            dict(connections.settings["default"], NAME=os.path.join(self.directory.name, "slots.sqlite3")),
+            alias
+        )
+        wrapper.ensure_connection()
+        return wrapper
+
+
+    def test_connections_per_worker_are_limited(self):
+        first = self.open_connection("first")
+        with self.assertRaises(OperationalError):
+            self.open_connection("second")
+
+        # Closing a connection frees its slot for a waiting thread.
+        waiter = threading.Thread(target=lambda: self.open_connection("second").close())
+        with override_settings(SNAKEOIL_DB_CONNECTIONS={"MAX_PER_WORKER": 1, "WAIT_TIMEOUT": 5}):
+            waiter.start()
+            time.sleep(0.05)
+            first.close()
+            waiter.join()
+
+        body = metrics.render()
+        self.assertIn('snakeoil_db_connections_total{alias="first",event="opened"} 1.0', body)
+        self.assertIn('snakeoil_db_connections_total{alias="first",event="closed"} 1.0', body)
+        self.assertIn('snakeoil_db_connections_total{alias="second",event="opened"} 1.0', body)
+        self.assertIn('snakeoil_db_connections_total{alias="second",event="timed_out"} 1.0', body)
+        self.assertIn('snakeoil_db_connections_total{alias="second",event="waited"} 1.0', body)
+
+
+    def test_reused_connections_are_counted(self):
+        add_demo_users.Command().handle(silent=True)
+        client = Client()
+        client.force_login(User.objects.get(username=add_demo_users.Command.CUSTOMER_X_USERNAME))
+        client.get(reverse("shop"))
+        client.get(reverse("shop"))
+
+        self.assertIn('snakeoil_db_connections_total{alias="default",event="reused"} 2.0', metrics.render())
+
+
+class AuthCacheTestCase(TestCase):
+    """
+    Verify that authenticated requests reach the view without querying
+    sessions, users or permissions, and that permission changes apply.
+    """
+
+    AUTH_TABLES = ["django_session", "auth_user", "auth_group", "auth_permission"]
+
+    def setUp(self):
+        cache.clear()
+        add_demo_users.Command().handle(silent=True)
+        self.manager = User.objects.get(username=add_demo_users.Command.MANAGER_USERNAME)
+
+
+    def count_auth_queries(self, client, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+
+        return response, len([
+            query for query in queries.captured_queries
+            if any(f'"{table}' in query["sql"] for table in self.AUTH_TABLES)
+        ])
+
+
+    def test_requests_make_no_auth_queries(self):
+        for session_engine in [
+            "django.contrib.sessions.backends.cached_db",
+            "django.contrib.sessions.backends.signed_cookies",
+        ]:
+            with self.subTest(session_engine=session_engine), override_settings(SESSION_ENGINE=session_engine):
+                client = Client()
+                client.force_login(self.manager)
+                client.get(reverse("product-management"))
+
+                response, num_auth_queries = self.count_auth_queries(client, reverse("product-management"))
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(num_auth_queries, 0)
+
+
+    def test_permission_changes_apply(self):
+        client = Client()
+        client.force_login(self.manager)
+        self.assertEqual(client.get(reverse("product-management")).status_code, 200)
+
+        self.manager.groups.clear()
+        self.assertEqual(client.get(reverse("product-management")).status_code, 302)
+
+        # Running the demo user setup again restores the permissions.
+        add_demo_users.Command().handle(silent=True)
+        client.force_login(User.objects.get(username=add_demo_users.Command.MANAGER_USERNAME))
+        self.assertEqual(client.get(reverse("product-management")).status_code, 200)
+
+
+class StaticAssetsTestCase(TestCase):
+    """
+    Verify that the static files are bundled, hashed and precompressed.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(
+            STATIC_ROOT=os.path.join(self.directory.name, "static"),
+            SNAKEOIL_STATIC_BUNDLES=dict(
+                settings.SNAKEOIL_STATIC_BUNDLES,
+                DIRECTORY=os.path.join(self.directory.name, "bundles")
+            )
+        )
+        self.settings_override.enable()
+
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.directory.cleanup()
+
+
+    def test_collected_files_are_hashed_and_compressed(self):
+        bundle_path = finders.find("snakeoil.bundle.js")
+        with open(bundle_path, "rb") as f:
+            bundle = f.read()
+        with open(finders.find("snakeoil.js"), "rb") as f:
+            self.assertTrue(bundle.endswith(f.read().rstrip() + b"\n"))
+
+        call_command("collectstatic", interactive=False, verbosity=0)
+        # A storage created after collecting reads the new manifest.
+        storage = assets.CompressedManifestStaticFilesStorage()
+        hashed_name = storage.stored_name("snakeoil.bundle.js")
+        self.assertRegex(hashed_name, r"^snakeoil\.bundle\.[0-9a-f]{12}\.js$")
+
+        with gzip.open(storage.path(hashed_name + ".gz")) as f:
+            self.assertEqual(f.read(), bundle)
+        # Web fonts other than the legacy formats are compressed already.
+        font = storage.stored_name("fonts/glyphicons-halflings-regular.woff2")
+        self.assertFalse(storage.exists(font + ".gz"))
+        # Hashed names are rewritten into the stylesheets.
+        with storage.open(storage.stored_name("bootstrap/bootstrap.min.css")) as f:
+            self.assertIn(font.split("/")[-1], f.read().decode())
+
+
+class CatalogSortingTestCase(TestCase):
+    """
+    Verify that the catalog is sorted by the indexed sort keys, that the
+    price and stock filters work, and that no supported way of browsing
+    the catalog makes the database sort the whole table.
+    """
+
+    # How EXPLAIN reports sorting rows outside of an index, and reading
+    # every row of the table, per database. A range of an index, e.g. the
+    # products in a price range, may be sorted, but never the whole table.
+    PLAN_MARKERS = {
+        "sqlite": (["USE TEMP B-TREE FOR ORDER BY"], ["SCAN snakeoil_webshop_product"]),
+        "mysql": (['"using_filesort": true'], ['"access_type": "ALL"', '"access_type": "index"']),
+    }
+
+    def setUp(self):
+        for i, name in enumerate(["Émulsion de serpent", "adder  Oil", "Boa balm", "cobra CREAM"]):
+            Product.objects.create(
+                sku=f"SORT{i:03}",
+                name=name,
+                description="A product for sorting tests.",
+                price=decimal.Decimal(f"{i + 1}.50"),
+                num_in_stock=i % 2
+            )
+
+
+    def filter(self, **data):
+        data.setdefault("sort_by", ProductSearchForm.NAME_ASC)
+        form = ProductSearchForm(data)
+        self.assertTrue(form.is_valid(), form.errors)
+        return form.filter_results()
+
+
+    def test_names_sort_without_accents_or_case(self):
+        self.assertEqual(Product.objects.get(sku="SORT001").name_sort_key, "adder oil")
+        self.assertEqual(
+            [product.sku for product in self.filter()],
+            ["SORT001", "SORT002", "SORT003", "SORT000"]
+        )
+
+        product = Product.objects.get(sku="SORT002")
+        product.name = "Zebra balm"
+        product.save(update_fields=["name"])
+        self.assertEqual(self.filter(sort_by=ProductSearchForm.NAME_DESC)[0], product)
+
+
+    def test_price_and_stock_filters(self):
+        self.assertEqual(
+            [product.sku for product in self.filter(min_price="2.00", max_price="3.50")],
+            ["SORT001", "SORT002"]
+        )
+        self.assertEqual(
+            [product.sku for product in self.filter(in_stock_only=True, sort_by=ProductSearchForm.PRICE_DESC)],
+            ["SORT003", "SORT001"]
+        )
+        self.assertFalse(ProductSearchForm({"sort_by": ProductSearchForm.NAME_ASC, "min_price": "-1"}).is_valid())
+
+
+    def test_no_supported_ordering_sorts_the_table(self):
+        """
+        Check the query plans of the first and a following page of every
+        ordering, with and without the filters.
+        """
+        if connection.vendor not in self.PLAN_MARKERS:
+            self.skipTest(f"No known query plan markers for {connection.vendor}.")
+        sort_markers, full_scan_markers = self.PLAN_MARKERS[connection.vendor]
+
+        filters = [
+            {},
+            {"min_price": "2.00", "max_price": "3.50"},
+            {"in_stock_only": True},
+        ]
+        querysets = [ProductCreationForm().give_all_results(), ProductSearchForm().give_all_results()]
+        for sort_by, _ in ProductSearchForm.SORTING_CHOICES:
+            querysets.extend(self.filter(sort_by=sort_by, **data) for data in filters)
+
+        for queryset in querysets:
+            paginator = KeysetPaginator(queryset, page_size=1)
+            first_page = paginator.page()
+            values = paginator.decode_cursor(first_page.next_cursor)[1]
+
+            for query in [
+                queryset.order_by(*paginator.ordering)[:3],
+                queryset.filter(paginator.seek_condition(values, forwards=True)).order_by(*paginator.ordering)[:3],
+            ]:
+                with self.subTest(ordering=paginator.ordering, where=str(query.query.where)):
+                    plan = query.explain(format="json") if connection.vendor == "mysql" else query.explain()
+                    sorted_rows = any(marker in plan for marker in sort_markers)
+                    scanned_table = any(marker in plan for marker in full_scan_markers)
+                    self.assertFalse(sorted_rows and scanned_table, plan)
+
+
+class StaleCartPurgeTestCase(TestCase):
+    """
+    Verify that carts remember when they were last changed and that
+    the purge job removes the stale ones, and only those.
+    """
+
+    def setUp(self):
+        add_demo_users.Command().handle(silent=True)
+        add_demo_products.Command().handle(silent=True)
+
+        self.customer = User.objects.get(username=add_demo_users.Command.CUSTOMER_X_USERNAME)
+        self.product = carts.lookup_product(Product.objects.get(sku=add_demo_products.Command.SKU001).pk)
+
+        # A dozen abandoned carts, two months old.
+        long_ago = timezone.now() - datetime.timedelta(days=60)
+        for i in range(12):
+            user = User.objects.create(username=f"abandoner{i}")
+            carts.add_to_cart(user, self.product, 2)
+        ShoppingCart.objects.update(last_activity=long_ago)
+
+
+    def test_changes_to_the_cart_are_activity(self):
+        before = timezone.now()
+        cart = carts.add_to_cart(self.customer, self.product, 1)
+        self.assertGreaterEqual(ShoppingCart.objects.get(pk=cart.pk).last_activity, before)
+
+        ShoppingCart.objects.filter(pk=cart.pk).update(last_activity=before - datetime.timedelta(days=60))
+        carts.clear_cart(cart)
+        self.assertGreaterEqual(ShoppingCart.objects.get(pk=cart.pk).last_activity, before)
+
+
+    def test_purges_only_stale_carts_in_batches(self):
+        active_cart = carts.add_to_cart(self.customer, self.product, 1)
+
+        with tempfile.TemporaryDirectory() as directory:
+            archive_path = os.path.join(directory, "carts.jsonl")
+            purge_stale_carts.Command().handle(
+                silent=True, days=30, batch_size=5, pause=0, archive=archive_path
+            )
+            with open(archive_path, encoding="utf-8") as f:
+                archived = [json.loads(line) for line in f]
+
+        self.assertEqual(list(ShoppingCart.objects.all()), [ShoppingCart.objects.get(pk=active_cart.pk)])
+        self.assertEqual(ShoppingCartItem.objects.exclude(shopping_cart=active_cart).count(), 0)
+        self.assertEqual(len(archived), 12)
+        self.assertEqual(archived[0]["items"], [{"sku": add_demo_products.Command.SKU001, "num_items": 2}])
+
+        # Running it again finds nothing left to do.
+        batches = list(carts.purge_stale_carts(timezone.now() - datetime.timedelta(days=30), pause=0))
+        self.assertEqual(batches, [])
+
+
+    def test_stopped_purge_resumes(self):
+        cutoff = timezone.now() - datetime.timedelta(days=30)
+        purge = carts.purge_stale_carts(cutoff, batch_size=5, pause=0)
+        self.assertEqual(next(purge), (5, 5))
+        purge.close()
+
+        self.assertEqual(ShoppingCart.objects.count(), 7)
+        self.assertEqual(
+            list(carts.purge_stale_carts(cutoff, batch_size=5, pause=0)),
+            [(5, 5), (2, 2)]
+        )
+
+
+class CatalogExportTestCase(TestCase):
+    """
+    Verify that managers can download the catalog and that it is
+    read a chunk at a time instead of all at once.
+    """
+
+    def setUp(self):
+        add_demo_users.Command().handle(silent=True)
+        add_demo_products.Command().handle(silent=True)
+
+        self.manager = User.objects.get(username=add_demo_users.Command.MANAGER_USERNAME)
+        self.customer = User.objects.get(username=add_demo_users.Command.CUSTOMER_X_USERNAME)
+        self.client = Client()
+
+
+    def test_managers_can_download_the_catalog(self):
+        url = reverse("catalog-export")
+        self.client.force_login(self.customer)
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        self.client.force_login(self.manager)
+        response = self.client.get(url, {"fields": "sku,price"})
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], "sku,price")
+        self.assertEqual(len(lines), Product.objects.count() + 1)
+
+        response = self.client.get(url, {"format": "jsonl"}, HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        rows = [json.loads(line) for line in gzip.decompress(b"".join(response.streaming_content)).splitlines()]
+        self.assertEqual(
+            [row["sku"] for row in rows],
+            list(Product.objects.order_by('pk').values_list('sku', flat=True))
+        )
+        self.assertEqual(set(rows[0]), set(catalog_io.DEFAULT_EXPORT_FIELDS))
+
+        self.assertEqual(self.client.get(url, {"fields": "sku,password"}).status_code, 400)
+        self.assertEqual(self.client.get(url, {"format": "xml"}).status_code, 400)
+
+
+    def test_catalog_is_read_in_chunks(self):
+        num_products = Product.objects.count()
+        with CaptureQueriesContext(connection) as queries:
+            pieces = list(catalog_io.export_products(catalog_io.CSV, ["sku"], chunk_size=2))
+
+        # One query per chunk and one to find out there are no more.
+        num_chunks = -(-num_products // 2)
+        self.assertEqual(len(queries), num_chunks + 1)
+        self.assertEqual(len(pieces), num_chunks + 1)
+        for query in queries:
+            self.assertIn("LIMIT 2", query["sql"])
+
+
+    def test_command_writes_compressed_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "catalog.jsonl.gz")
+            export_products.Command().handle(path=path, fields="sku,num_in_stock", silent=True)
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                rows = [json.loads(line) for line in f]
+
+        self.assertEqual(len(rows), Product.objects.count())
+        self.assertEqual(set(rows[0]), {"sku", "num_in_stock"})
+
+
+def is_product_update(query):
+    # Repricing the carts holding the products takes UPDATEs of its own.
+    return query["sql"].startswith("UPDATE") and Product._meta.db_table in query["sql"].split(" SET ")[0]
+
+
+class InventoryUpdateTestCase(TestCase):
+    """
+    Verify that stock counts and prices can be changed in bulk,
+    a chunk of products per statement, and that the caches follow.
+    """
+
+    def setUp(self):
+        add_demo_users.Command().handle(silent=True)
+        add_demo_products.Command().handle(silent=True)
+
+        self.manager = User.objects.get(username=add_demo_users.Command.MANAGER_USERNAME)
+        self.customer = User.objects.get(username=add_demo_users.Command.CUSTOMER_X_USERNAME)
+        self.client = Client()
+
+
+    def product(self, sku):
+        return Product.objects.get(sku=sku)
+
+
+    def test_changes_are_applied_and_rejects_reported(self):
+        url = reverse("inventory-update")
+        changes = [
+            {"sku": add_demo_products.Command.SKU001, "num_in_stock": 5, "price": "1.99"},
+            {"sku": add_demo_products.Command.SKU002, "price": "-1.00"},
+            {"sku": "NOSUCHSKU", "num_in_stock": 1},
+            {"sku": add_demo_products.Command.SKU003},
+            {"sku": add_demo_products.Command.SKU004, "num_in_stock": 0},
+        ]
+        # The cart snapshot of the product must not keep the old price.
+        carts.lookup_product(self.product(add_demo_products.Command.SKU001).pk)
+
+        self.client.force_login(self.customer)
+        self.assertEqual(self.client.post(url, {"changes": changes}, content_type="application/json").status_code, 403)
+
+        self.client.force_login(self.manager)
+        response = self.client.post(url, {"changes": changes}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["num_updated"], 2)
+        self.assertEqual([rejection["index"] for rejection in response.json()["rejected"]], [1, 2, 3])
+
+        clear = self.product(add_demo_products.Command.SKU001)
+        self.assertEqual((clear.num_in_stock, clear.price), (5, decimal.Decimal("1.99")))
+        self.assertEqual(carts.lookup_product(clear.pk).price, decimal.Decimal("1.99"))
+        self.assertEqual(self.product(add_demo_products.Command.SKU004).num_in_stock, 0)
+        self.assertEqual(self.product(add_demo_products.Command.SKU002).price, decimal.Decimal("16.99"))
+
+
+    def test_updates_a_chunk_per_statement(self):
+        skus = [f"BULK{i:04}" for i in range(50)]
+        for sku in skus:
+            Product.objects.create(sku=sku, name="Bulk oil", description="-", price="1.00", num_in_stock=1)
+
+        valid, rejected = inventory.validate_changes(
+            enumerate({"sku": sku, "num_in_stock": i, "price": f"{i}.50"} for i, sku in enumerate(skus))
+        )
+        with CaptureQueriesContext(connection) as queries:
+            num_updated, unknown = inventory.apply_changes(valid, chunk_size=20)
+
+        self.assertEqual((num_updated, rejected, unknown), (50, [], []))
+        updates = [query for query in queries if is_product_update(query)]
+        self.assertEqual(len(updates), 3)
+        self.assertEqual(self.product("BULK0042").num_in_stock, 42)
+        self.assertEqual(self.product("BULK0042").price, decimal.Decimal("42.50"))
+
+
+    def test_sharded_stock_is_spread_over_the_shards(self):
+        thick = self.product(add_demo_products.Command.SKU003)
+        stock.set_stock_shards(thick, 4)
+
+        inventory.apply_changes(inventory.validate_changes([(1, {"sku": thick.sku, "num_in_stock": 10})])[0])
+        self.assertEqual(stock.available_stock(thick), 10)
+        self.assertEqual(self.product(thick.sku).num_in_stock, 10)
+
+
+    def test_prices_matching_a_search_change_in_one_statement(self):
+        url = reverse("price-adjustment")
+        before = {product.sku: product.price for product in Product.objects.all()}
+        self.client.force_login(self.manager)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                url,
+                {"percent": "5", "search": {"search_string": "snake oil", "min_price": "20"}},
+                content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([query for query in queries if is_product_update(query)]), 1)
+
+        for product in Product.objects.all():
+            expected = before[product.sku]
+            if expected >= 20 and "snake oil" in product.name.lower():
+                expected = (expected * decimal.Decimal("1.05")).quantize(decimal.Decimal("0.01"))
+            self.assertEqual(product.price, expected)
+        self.assertEqual(response.json()["num_updated"], len([p for p in before.values() if p >= 20]))
+
+        response = self.client.post(url, {"amount": "-1000", "search": {}}, content_type="application/json")
+        self.assertEqual(response.json()["num_updated"], len(before))
+        self.assertEqual(set(Product.objects.values_list('price', flat=True)), {decimal.Decimal("0.00")})
+
+        response = self.client.post(url, {"percent": "5", "amount": "1", "search": {}}, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+
+    def test_prices_are_kept_within_the_column(self):
+        url = reverse("price-adjustment")
+        self.client.force_login(self.manager)
+
+        for adjustment in [{"percent": "1000"}, {"amount": "999999.99"}]:
+            with self.subTest(**adjustment):
+                Product.objects.update(price=decimal.Decimal("500000.00"))
+                response = self.client.post(url, dict(adjustment, search={}), content_type="application/json")
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(set(Product.objects.values_list('price', flat=True)), {inventory.MAX_PRICE})
+
+
+    def test_command_reads_changes_from_csv(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "inventory.csv")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(
+                    "sku,num_in_stock,price\n"
+                    f"{add_demo_products.Command.SKU001},7,\n"
+                    f"{add_demo_products.Command.SKU002},,3.00\n"
+                    "NOSUCHSKU,1,1.00\n"
+                )
+            rejects = os.path.join(directory, "rejects.jsonl")
+            update_inventory.Command().handle(path=path, rejects=rejects, silent=True)
+            with open(rejects, encoding="utf-8") as f:
+                self.assertEqual([json.loads(line)["row"] for line in f], [3])
+
+        self.assertEqual(self.product(add_demo_products.Command.SKU001).num_in_stock, 7)
+        self.assertEqual(self.product(add_demo_products.Command.SKU002).price, decimal.Decimal("3.00"))
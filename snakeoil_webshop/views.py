@@ -1,17 +1,31 @@
+import hashlib
 import json
+import os
 
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db import router
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect
+from django.template.loader import render_to_string
 from django.urls import reverse
-from django.views.generic import TemplateView, RedirectView
-from django.db.models import Sum, F
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from django.utils.text import compress_sequence
+from django.utils import timezone
+from django.views.generic import TemplateView, RedirectView, View
 
 from rest_framework.views import APIView
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import BasePermission, IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
-from snakeoil_webshop import helpers
-from snakeoil_webshop.forms import ProductSearchForm, AddToCartForm, ProductCreationForm
-from snakeoil_webshop.models import Product, ShoppingCart, ShoppingCartItem
+from snakeoil_webshop import caching, carts, catalog_io, helpers, instrumentation, inventory, metrics, stock
+from snakeoil_webshop.forms import ProductSearchForm, AddToCartForm, ProductCreationForm, PriceAdjustmentForm
+from snakeoil_webshop.models import Order, Product
+from snakeoil_webshop.pagination import KeysetPaginator, count_results, get_page_size
 
 # Import the whole serializers module to extend Product with the as_json method.
 import snakeoil_webshop.serializers  # type: ignore
@@ -22,9 +36,135 @@ SHOP = "SHOP"
 PRODUCT_MANAGEMENT = "PRODUCT_MANAGEMENT"
 SHOPPING_CART = "SHOPPING_CART"
 
+# The query parameter carrying the pagination cursor.
+CURSOR = "cursor"
+
+
+def get_cart_version(request):
+    """
+    Return the version number of the requesting user's cart. The cart
+    is loaded once per request, so the page rendered afterwards reuses it.
+    """
+    return helpers.get_request_cart(request).version
+
+
+def render_products_table(request, template_name, products, query_parameters=None, cacheable=True):
+    """
+    Render the table of products for the page requested by the cursor.
+    The rendered table only depends on the catalog and the search, so it
+    is cached per catalog version, search parameters and page.
+    """
+    def render():
+        context = paginate_products(request, products, query_parameters)
+        with instrumentation.timed(instrumentation.TEMPLATE):
+            return render_to_string(template_name, context)
+
+    if not cacheable:
+        return render()
+
+    key = caching.fragment_key(
+        template_name,
+        search=query_parameters or {},
+        cursor=request.GET.get(CURSOR),
+        page_size=get_page_size()
+    )
+    return caching.get_or_render_fragment(key, render)
+
+
+def paginate_products(request, products, query_parameters=None):
+    """
+    Return the page of the given products requested by the cursor in
+    the query string, along with the context needed to render links
+    to the neighbouring pages.
+    """
+    page = KeysetPaginator(products).page(request.GET.get(CURSOR))
+
+    # Look up the JSON of every product on the page at once
+    # so that rendering the rows won't serialize them one by one.
+    with instrumentation.timed(instrumentation.JSON):
+        snakeoil_webshop.serializers.product_json_cache.get_many(page)
+
+    def page_url(cursor):
+        if cursor is None:
+            return None
+        parameters = dict(query_parameters or {})
+        parameters[CURSOR] = cursor
+        return f"{request.path}?{urlencode(parameters)}"
 
+    return {
+        "products": page,
+        "num_results": count_results(products),
+        "next_page_url": page_url(page.next_cursor),
+        "previous_page_url": page_url(page.previous_cursor),
+    }
 
-class ShopView(LoginRequiredMixin, TemplateView):
+
+
+class ConditionalGetMixin:
+    """
+    Adds validators (ETag, Last-Modified) to GET responses and answers
+    requests carrying matching validators with 304 Not Modified without
+    rendering the page. Subclasses compute the validators from cheap
+    version numbers instead of from the page content.
+    """
+
+    def get_etag_parts(self):
+        """
+        Return a list of values that together identify the version of
+        the page that would be rendered.
+        """
+        user = self.request.user
+        return [
+            user.pk,
+            # The navigation bar shows links depending on what the user may
+            # do. The permissions are cached, so checking them is cheap.
+            user.is_staff,
+            user.has_perm('snakeoil_webshop.add_product'),
+            # The page embeds a CSRF token, which changes with the cookie.
+            self.request.COOKIES.get(settings.CSRF_COOKIE_NAME),
+            sorted(self.request.GET.lists()),
+            get_page_size(),
+            # Pages carrying a one-off message must not be served from the cache.
+            len(messages.get_messages(self.request)),
+        ]
+
+    def get_last_modified(self):
+        """
+        Return when the page last changed, or None to rely on the ETag
+        alone. Clients may revalidate with the date only, so it has to
+        cover everything on the page. The pages showing the user's cart
+        have no such date: the cart doesn't change the catalog's, and
+        the catalog's moves backwards when the newest product is deleted.
+        """
+        return None
+
+    def get(self, request, *args, **kwargs):
+        etag = quote_etag(hashlib.md5(
+            json.dumps(self.get_etag_parts(), default=str).encode()
+        ).hexdigest())
+        last_modified = self.get_last_modified()
+        last_modified_timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(
+            request,
+            etag=etag,
+            last_modified=last_modified_timestamp
+        )
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+
+        response.headers["ETag"] = etag
+        if last_modified_timestamp is not None:
+            response.headers["Last-Modified"] = http_date(last_modified_timestamp)
+        # Browsers may keep the page but must check back before using it.
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ["Cookie"])
+
+        return response
+
+
+
+class ShopView(ConditionalGetMixin, LoginRequiredMixin, TemplateView):
     
     template_name = "shop.html"
 
@@ -39,17 +179,27 @@ class ShopView(LoginRequiredMixin, TemplateView):
             # We received a filled product search form from the user.
             form = ProductSearchForm(self.request.POST)
             products = form.filter_results()
+        elif ProductSearchForm.SORT_BY in self.request.GET:
+            # The user is browsing through the pages of earlier search results.
+            form = ProductSearchForm(self.request.GET)
+            products = form.filter_results()
         else:
             # We're serving the shop page out for the first time with an empty search form.
             form = ProductSearchForm()
             products = form.give_all_results()
 
-        active_shopping_cart = helpers.find_active_cart_for_user(self.request.user)
+        active_shopping_cart = helpers.get_request_cart(self.request)
 
         added_context = {
             "form": form,
-            "products": products,
-            "num_results": len(products),
+            "products_table": render_products_table(
+                self.request,
+                "components/shop_products.html",
+                products,
+                form.search_parameters(),
+                # Don't cache the empty results of an invalid search.
+                cacheable=not form.is_bound or form.is_valid()
+            ),
             "active_view": SHOP,
             "shopping_cart_string": active_shopping_cart.summarize()
         }
@@ -59,7 +209,20 @@ class ShopView(LoginRequiredMixin, TemplateView):
 
 
     def post(self, request, *args, **kwargs):
-        return self.get(request, *args, **kwargs)
+        # Skip the conditional GET handling, a search always renders.
+        return super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+
+
+    def get_etag_parts(self):
+        """
+        The shop page depends on the catalog and on the user's cart.
+        """
+        return super().get_etag_parts() + [
+            self.__class__.__name__,
+            caching.get_catalog_version(),
+            caching.get_catalog_last_modified(),
+            get_cart_version(self.request),
+        ]
 
 
 
@@ -87,13 +250,16 @@ class ProductManagementView(ShopView):
             form = ProductCreationForm()
 
         products = form.give_all_results()
-        active_shopping_cart = helpers.find_active_cart_for_user(self.request.user)
+        active_shopping_cart = helpers.get_request_cart(self.request)
 
         added_context = {
             "form": form,
-            "products": products,
-            "num_results": len(products),
             "new_product": new_product,
+            "products_table": render_products_table(
+                self.request,
+                "components/managed_products.html",
+                products
+            ),
             "active_view": PRODUCT_MANAGEMENT,
             "shopping_cart_string": active_shopping_cart.summarize()
         }
@@ -103,7 +269,7 @@ class ProductManagementView(ShopView):
 
 
     def post(self, request, *args, **kwargs):
-        return self.get(request, *args, **kwargs)
+        return super(ConditionalGetMixin, self).get(request, *args, **kwargs)
 
 
     def create_new_product(self, cleaned_data):
@@ -115,7 +281,133 @@ class ProductManagementView(ShopView):
         return product
 
 
-class ShoppingCartView(LoginRequiredMixin, TemplateView):
+
+class CatalogExportView(LoginRequiredMixin, View):
+    """
+    Streams the whole catalog as a CSV or JSONL download, e.g.
+    /manage/products/export/?format=jsonl&fields=sku,price. The products
+    are read and written a chunk at a time, so the memory use of the
+    worker doesn't grow with the catalog. Compressed with gzip if the
+    client accepts it.
+    """
+
+    login_url = '/login/'
+    redirect_field_name = 'next'
+
+
+    def get(self, request, *args, **kwargs):
+        file_format = request.GET.get("format", catalog_io.CSV)
+        if file_format not in catalog_io.FORMATS:
+            return HttpResponseBadRequest(f"The format must be one of: {', '.join(catalog_io.FORMATS)}.")
+
+        try:
+            fields = catalog_io.parse_export_fields(request.GET.get("fields"))
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        # The response is streamed after the request has been routed,
+        # so pick the database now. Exports may be served by a replica.
+        pieces = catalog_io.export_products(file_format, fields, using=router.db_for_read(Product))
+
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            response = StreamingHttpResponse(
+                compress_sequence(piece.encode("utf-8") for piece in pieces),
+                content_type=catalog_io.CONTENT_TYPES[file_format]
+            )
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = StreamingHttpResponse(pieces, content_type=catalog_io.CONTENT_TYPES[file_format])
+
+        filename = f"catalog-{timezone.now():%Y%m%d-%H%M%S}.{file_format}"
+        response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        # Pass the pieces on as they come instead of buffering them in nginx.
+        response.headers["X-Accel-Buffering"] = "no"
+        patch_vary_headers(response, ["Accept-Encoding"])
+        patch_cache_control(response, private=True, no_store=True)
+
+        return response
+
+
+class CanChangeProducts(BasePermission):
+    """
+    Lets through the users allowed to change existing products.
+    """
+
+    def has_permission(self, request, view):
+        return request.user.has_perm('snakeoil_webshop.change_product')
+
+
+
+class InventoryUpdateView(APIView):
+    """
+    Sets the stock counts and prices of many products at once, e.g. for
+    a nightly inventory sync. The body is expected to look like
+    {"changes": [{"sku": "SKU001", "num_in_stock": 10, "price": "9.99"}, ...]},
+    where either num_in_stock or price may be left out. Valid changes are
+    applied and invalid ones are reported by their index in the list.
+    """
+
+    permission_classes = [IsAuthenticated, CanChangeProducts]
+
+    # Refuse to process unreasonably large batches.
+    MAX_CHANGES_PER_CALL = 10000
+
+    def post(self, request, *args, **kwargs):
+        changes = request.data.get("changes") if hasattr(request.data, "get") else None
+        if not isinstance(changes, list) or not 0 < len(changes) <= self.MAX_CHANGES_PER_CALL:
+            return Response(
+                f"Expected a list of 1 to {self.MAX_CHANGES_PER_CALL} changes.",
+                status=400
+            )
+
+        valid, rejected = inventory.validate_changes(enumerate(changes))
+        num_updated, unknown = inventory.apply_changes(valid)
+
+        response_data = {
+            "num_updated": num_updated,
+            "rejected": [
+                {"index": index, "errors": errors}
+                for index, _, errors in sorted(rejected + unknown, key=lambda rejection: rejection[0])
+            ],
+        }
+
+        return Response(response_data, status=200)
+
+
+
+class PriceAdjustmentView(APIView):
+    """
+    Changes the prices of every product matching a search by a percentage
+    or an amount in one statement. The body is expected to look like
+    {"percent": 5, "search": {"search_string": "snake", "min_price": "10"}}
+    with the fields of the product search form in "search". An empty
+    search matches the whole catalog.
+    """
+
+    permission_classes = [IsAuthenticated, CanChangeProducts]
+
+    def post(self, request, *args, **kwargs):
+        data = request.data if hasattr(request.data, "get") else {}
+        adjustment_form = PriceAdjustmentForm(data)
+        search = data.get("search")
+        if not isinstance(search, dict):
+            return Response({"search": ["Give the search matching the products to change."]}, status=400)
+
+        search_form = ProductSearchForm(dict({ProductSearchForm.SORT_BY: ProductSearchForm.NAME_ASC}, **search))
+        if not adjustment_form.is_valid() or not search_form.is_valid():
+            return Response(dict(adjustment_form.errors, **search_form.errors), status=400)
+
+        num_updated = inventory.adjust_prices(
+            search_form.filter_results(),
+            percent=adjustment_form.cleaned_data["percent"],
+            amount=adjustment_form.cleaned_data["amount"]
+        )
+
+        return Response({"num_updated": num_updated}, status=200)
+
+
+
+class ShoppingCartView(ConditionalGetMixin, LoginRequiredMixin, TemplateView):
 
     template_name = "shopping_cart.html"
 
@@ -123,26 +415,29 @@ class ShoppingCartView(LoginRequiredMixin, TemplateView):
     redirect_field_name = 'next'
 
 
-    def get_context_data(self, *args, **kwargs):
-        context = super(ShoppingCartView, self).get_context_data(*args, **kwargs)
+    def get_etag_parts(self):
+        """
+        The cart page shows the products in the cart, so it depends
+        on the catalog as well as the cart itself.
+        """
+        return super().get_etag_parts() + [
+            self.__class__.__name__,
+            caching.get_catalog_version(),
+            get_cart_version(self.request),
+        ]
 
-        active_shopping_cart = helpers.find_active_cart_for_user(self.request.user)
-        items_in_cart = active_shopping_cart.shopping_cart_items.select_related("product")
 
-        total_num_items = active_shopping_cart.shopping_cart_items.aggregate(
-                total_num_items=Sum('num_items'),
-            ).get('total_num_items', 0)
 
-        total_price = active_shopping_cart.shopping_cart_items.aggregate(
-                total_price=Sum(
-                    F('product__price')*F('num_items')
-                )
-            ).get('total_price', 0.00)        
+    def get_context_data(self, *args, **kwargs):
+        context = super(ShoppingCartView, self).get_context_data(*args, **kwargs)
+
+        active_shopping_cart = helpers.get_request_cart(self.request)
+        items_in_cart = helpers.get_cart_items(active_shopping_cart)
 
         additional_context = {
             "items_in_cart": items_in_cart,
-            "num_items": total_num_items,
-            "total_price": total_price,
+            "num_items": active_shopping_cart.num_items,
+            "total_price": active_shopping_cart.total_price,
             "active_view": SHOPPING_CART,
             "shopping_cart_string": active_shopping_cart.summarize()
         }
@@ -176,32 +471,18 @@ class AddToCartView(APIView):
 
         # Looks like we have an integer for the product identifier.
         # Does it correspond to an existing Product?
-        try:
-            product = Product.objects.get(pk=product_id)
-        except Product.DoesNotExist:
+        product = carts.lookup_product(product_id)
+        if product is None:
             return Response(
                 f"The indicated product (ID: {product_id}) does not exist.",
                 status=404
             )
 
         # We have a product, let's put it into the acting user's cart.
-        shopping_cart, cart_created = ShoppingCart.objects.get_or_create(
-            user=request.user
-        )
-        cart_item, item_created = ShoppingCartItem.objects.get_or_create(
-            shopping_cart=shopping_cart,
-            product=product
-        )
-
-        # Update the number of carted items corresponding to the added product.
-        if item_created:
-            cart_item.num_items = num_items_to_add
-        else:
-            cart_item.num_items += num_items_to_add
-        cart_item.save()
+        shopping_cart = carts.add_to_cart(request.user, product, num_items_to_add)
 
         response_data = {
-            "product": product.as_json(),
+            "product": product.json,
             "num_items_added": num_items_to_add,
             "cart_summary": shopping_cart.summarize()
         }
@@ -210,6 +491,64 @@ class AddToCartView(APIView):
 
 
 
+class AddToCartBatchView(APIView):
+    """
+    Adds several products to the cart at once. The shop page collects
+    the clicks of the user for a moment and sends them here together.
+    The body is expected to look like {"items": [{"pk": 1, "num_items": 2}, ...]}.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    # Refuse to process unreasonably large batches.
+    MAX_ITEMS_PER_BATCH = 100
+
+    def post(self, request, *args, **kwargs):
+
+        items = request.data.get("items") if hasattr(request.data, "get") else None
+        if not isinstance(items, list) or not 0 < len(items) <= self.MAX_ITEMS_PER_BATCH:
+            return Response(
+                "Bad request.",
+                status=400
+            )
+
+        # Validate every entry before touching the cart.
+        requested = []
+        for item in items:
+            validation_form = AddToCartForm(item if isinstance(item, dict) else {})
+            if not validation_form.is_valid():
+                return Response(
+                    "Bad request.",
+                    status=400
+                )
+
+            num_items_to_add = validation_form.cleaned_data.get("num_items", None)
+            if num_items_to_add is None:
+                num_items_to_add = 1
+            requested.append((validation_form.cleaned_data.get("pk"), num_items_to_add))
+
+        products = carts.lookup_products({product_id for product_id, _ in requested})
+        missing_ids = sorted({product_id for product_id, _ in requested} - set(products))
+        if missing_ids:
+            return Response(
+                f"The indicated products (IDs: {', '.join(map(str, missing_ids))}) do not exist.",
+                status=404
+            )
+
+        shopping_cart = carts.add_many_to_cart(
+            request.user,
+            [(products[product_id], num_items) for product_id, num_items in requested]
+        )
+
+        response_data = {
+            "num_items_added": sum(num_items for _, num_items in requested),
+            "cart_summary": shopping_cart.summarize()
+        }
+
+        return Response(response_data, status=200)
+
+
+
 class ClearCartView(RedirectView):
     """
     A view that clears the requesting user's shopping cart
@@ -224,7 +563,134 @@ class ClearCartView(RedirectView):
         """
         Clear the requesting user's cart before redirecting.
         """
-        active_shopping_cart = helpers.find_active_cart_for_user(self.request.user)
-        active_shopping_cart.shopping_cart_items.all().delete()
+        active_shopping_cart = helpers.get_request_cart(self.request)
+        carts.clear_cart(active_shopping_cart)
+
+        return super().get_redirect_url(*args, **kwargs)
+
+
+
+class CheckoutView(LoginRequiredMixin, View):
+    """
+    Turns the requesting user's shopping cart into an order and
+    reserves stock for it, then shows the user the new order.
+    """
+    login_url = '/login/'
+    redirect_field_name = 'next'
+
+
+    def post(self, request, *args, **kwargs):
+        try:
+            order = stock.place_order(request.user)
+        except stock.CheckoutError as e:
+            messages.error(request, str(e))
+            return redirect("shopping-cart")
+
+        return redirect("order", pk=order.pk)
+
+
+
+class OrderView(LoginRequiredMixin, TemplateView):
+
+    template_name = "order.html"
+
+    login_url = '/login/'
+    redirect_field_name = 'next'
+
+
+    def get_context_data(self, *args, **kwargs):
+        context = super(OrderView, self).get_context_data(*args, **kwargs)
+
+        order = get_object_or_404(Order, pk=self.kwargs["pk"], user=self.request.user)
+        if order.status == Order.RESERVED and order.expires <= timezone.now():
+            # Release the stock of the order right away instead of waiting
+            # for the next sweep. Only this order: a page view shouldn't
+            # pay for the backlog of everybody else's expired orders.
+            stock.stock_changed(stock.release_order(order.pk, Order.EXPIRED))
+            order.refresh_from_db()
+
+        active_shopping_cart = helpers.get_request_cart(self.request)
+
+        additional_context = {
+            "order": order,
+            "order_lines": order.lines.all(),
+            "active_view": SHOPPING_CART,
+            "shopping_cart_string": active_shopping_cart.summarize()
+        }
+        context.update(additional_context)
+
+        return context
+
+
+
+class OrderActionView(LoginRequiredMixin, View):
+    """
+    Base class for views changing the status of one of
+    the requesting user's orders and then showing it.
+    """
+    login_url = '/login/'
+    redirect_field_name = 'next'
+
+
+    def post(self, request, *args, **kwargs):
+        order = get_object_or_404(Order, pk=self.kwargs["pk"], user=request.user)
+        try:
+            self.act(order)
+        except stock.CheckoutError as e:
+            messages.error(request, str(e))
+
+        return redirect("order", pk=order.pk)
+
+
+    def act(self, order):
+        raise NotImplementedError
+
+
+
+class ConfirmOrderView(OrderActionView):
+
+    def act(self, order):
+        stock.confirm_order(order)
+        messages.success(self.request, "Thank you for your order!")
+
+
+
+class CancelOrderView(OrderActionView):
+
+    def act(self, order):
+        stock.cancel_order(order)
+        messages.info(self.request, "The order has been cancelled.")
+
+
+
+class CacheStatsView(APIView):
+    """
+    Reports how well the caches of the answering worker process
+    are doing, for tuning their sizes and timeouts.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        response_data = {
+            "pid": os.getpid(),
+            "catalog_version": caching.get_catalog_version(),
+            "fragments": {
+                caching.HITS: caching.fragment_cache_stats[caching.HITS],
+                caching.MISSES: caching.fragment_cache_stats[caching.MISSES],
+            },
+            "product_json_entries": len(snakeoil_webshop.serializers.product_json_cache.local),
+        }
+
+        return Response(response_data, status=200)
+
+
+
+class MetricsView(View):
+    """
+    Serves the metrics of all worker processes to Prometheus.
+    Access to this is restricted in the web server configuration.
+    """
 
-        return super().get_redirect_url(*args, **kwargs)
\ No newline at end of file
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)